@@ -0,0 +1,6 @@
+# Age bands shared by the statistics report and the visit data cube, so
+# their age-group counts agree. Bands are right-closed, as pd.cut makes
+# them: (0, 18], (18, 35], ..., (65, 100]. Ages outside them (0, over 100,
+# or missing) fall in no band.
+AGE_BINS = [0, 18, 35, 50, 65, 100]
+AGE_LABELS = ["0-18", "19-35", "36-50", "51-65", "66+"]
@@ -0,0 +1,496 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+import pandas as pd
+import hospital_statistics
+import patient_repository
+import snapshot
+from data_cube import cube_file, load_cube
+from datagen import generate_visits, generate_credentials, generate_dataset, dataset_paths
+from notes import load_notes, get_notes_by_date
+from note_search import NoteSearchIndex, tokenize
+from storage import CsvStorage
+from users import authenticate_user
+from visit_index import VisitDateIndex, parse_visit_date
+from visit_trends import rollup_file
+
+SEARCH_QUERIES = ['csf', 'meningitis antibiotics', '"csf leak"', 'csf OR meningitis', 'infection -fever',
+                  '"spinal fluid" drain']
+SUITE_SAMPLES = 1000  # random dates / patients per lookup benchmark
+REGRESSION_TOLERANCE = 0.10  # --compare flags benchmarks more than 10% slower than the baseline
+STARTUP_BUDGET = 0.75  # seconds from launching the desktop app to its drawn login window
+STARTUP_MODULES = ["ui", "main"]
+DEFERRED_MODULES = ["pandas", "matplotlib"]  # only statistics need these; they must not load at startup
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter: opens the app, draws the login window and reports what got imported
+LOGIN_WINDOW_SCRIPT = """
+import json, sys
+import tkinter as tk
+import ui
+root = tk.Tk()
+app = ui.App(root)
+root.update()
+print(json.dumps(sorted(%r & {name.split('.')[0] for name in sys.modules})), flush=True)
+"""
+
+
+# -------------------- Benchmarks --------------------
+
+def _baseline_read(path):
+    # The loader as it was before column pruning and explicit dtypes
+    df = pd.read_csv(path)
+    df['Visit_time'] = pd.to_datetime(df['Visit_time'], errors='coerce')
+    return df[df['Visit_time'] >= pd.to_datetime("2020-01-01")]
+
+
+def _timed(label, func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<32} {best:8.2f} s  ({len(result):,} rows kept)")
+    return best
+
+
+def bench_ingest(path, repeat=1):
+    """Compare the original statistics loader with the pruned, typed readers."""
+    print(f"Ingesting {path} ({os.path.getsize(path) / 1e6:,.0f} MB)")
+    results = {"baseline": _timed("baseline read_csv + inference", lambda: _baseline_read(path), repeat)}
+    results["c"] = _timed("pruned + dtypes (c engine)",
+                          lambda: hospital_statistics.read_statistics_csv(path, engine="c"), repeat)
+    results["c_chunked"] = _timed("pruned + dtypes (c, chunked)",
+                                  lambda: hospital_statistics.read_statistics_csv(path, engine="c", chunksize=1_000_000), repeat)
+    if hospital_statistics.default_csv_engine() == "pyarrow":
+        results["pyarrow"] = _timed("pruned + dtypes (pyarrow)",
+                                    lambda: hospital_statistics.read_statistics_csv(path, engine="pyarrow"), repeat)
+    for name, seconds in results.items():
+        if name != "baseline":
+            print(f"speedup {name:<24} {results['baseline'] / seconds:8.1f}x")
+    return results
+
+
+def _linear_scan(notes_path, tokens):
+    # What a search costs without the index: tokenise every note for a phrase match
+    phrase = " ".join(tokens)
+    hits = 0
+    with open(notes_path, newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            if phrase in " ".join(tokenize(row["Note_text"])):
+                hits += 1
+    return hits
+
+
+def bench_search(notes_path, data_path, repeat=20):
+    """Time building, saving and loading the note index, then per-query latency."""
+    start = time.perf_counter()
+    index = NoteSearchIndex.build(notes_path, data_path)
+    print(f"{'build index':<32} {time.perf_counter() - start:8.2f} s  ({len(index):,} notes)")
+    index_path = notes_path + ".idx"
+    start = time.perf_counter()
+    index.save(index_path)
+    print(f"{'save index':<32} {time.perf_counter() - start:8.2f} s  ({os.path.getsize(index_path) / 1e6:,.1f} MB)")
+    start = time.perf_counter()
+    index = NoteSearchIndex.load(notes_path, index_path)
+    print(f"{'load index':<32} {time.perf_counter() - start:8.2f} s")
+
+    results = {}
+    for query in SEARCH_QUERIES:
+        index.search(query)  # first use decodes the postings from the file
+        timings = []
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            hits = index.search(query)
+            timings.append(time.perf_counter() - begin)
+        timings.sort()
+        results[query] = {"p50_ms": statistics.median(timings) * 1000,
+                          "p95_ms": timings[int(len(timings) * 0.95) - 1] * 1000, "hits": len(hits)}
+        print(f"query {query:<26} p50 {results[query]['p50_ms']:8.2f} ms  p95 {results[query]['p95_ms']:8.2f} ms"
+              f"  ({len(hits):,} hits)")
+
+    start = time.perf_counter()
+    _linear_scan(notes_path, ["csf", "leak"])
+    print(f"{'linear scan for csf leak':<32} {(time.perf_counter() - start) * 1000:8.2f} ms")
+    return results
+
+
+def _best_of(repeat, func, setup=None):
+    best, result = None, None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _record(results, name, seconds, ops):
+    results[name] = {"seconds": seconds, "ops": ops, "us_per_op": seconds / ops * 1e6 if ops else None}
+    print(f"{name:<32} {seconds:10.4f} s  {ops:>12,} ops  {results[name]['us_per_op'] or 0:12.2f} us/op")
+
+
+def bench_suite(paths, repeat=3, samples=SUITE_SAMPLES, seed=0):
+    """Time the main read paths against a generated dataset; returns {name: {seconds, ops, us_per_op}}.
+
+    paths is what datagen.generate_dataset returns. Each benchmark reports
+    the best of `repeat` runs.
+    """
+    rng = random.Random(seed)
+    results = {}
+
+    def build_note_index():
+        store = load_notes(paths["notes_file"])
+        store.build_index()
+        count = len(store)
+        store.close()
+        return count
+
+    def remove_note_snapshot():
+        if os.path.exists(snapshot.snapshot_file(paths["notes_file"])):
+            os.remove(snapshot.snapshot_file(paths["notes_file"]))
+
+    seconds, count = _best_of(repeat, build_note_index, setup=remove_note_snapshot)
+    _record(results, "load_notes", seconds, count)
+
+    def load_graph():
+        date_index = VisitDateIndex()
+        return patient_repository.load_patient_data(paths["data_file"], load_notes(paths["notes_file"]),
+                                                    date_index), date_index
+
+    seconds, (patients, date_index) = _best_of(repeat, load_graph)
+    _record(results, "load_patient_data", seconds, date_index.total())
+
+    # Startup from a snapshot of the same graph instead of the CSV
+    snapshot.save_patients(paths["data_file"], patients, date_index,
+                           patient_repository.file_signature(paths["data_file"]))
+
+    def load_storage():
+        storage = CsvStorage(paths["data_file"], paths["notes_file"])
+        storage.load()
+        return storage
+
+    seconds, storage = _best_of(repeat, load_storage)
+    _record(results, "load_snapshot", seconds, storage.date_index.total())
+    storage.close()
+
+    # Logins: cold ones re-read Credentials.csv and run the password hash,
+    # warm ones hit the remembered session
+    credentials_file = paths["credentials_file"]
+    accounts = rng.sample(paths["accounts"], min(len(paths["accounts"]), samples // 20 or 1))
+    mtime = os.stat(credentials_file).st_mtime_ns
+
+    def login_all():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [authenticate_user(credentials_file, username, password) for username, password, _ in accounts]
+
+    def touch_credentials():
+        nonlocal mtime
+        mtime += 1
+        os.utime(credentials_file, ns=(mtime, mtime))
+
+    def login_cold():
+        users = []
+        for account in accounts:
+            touch_credentials()
+            with contextlib.redirect_stdout(io.StringIO()):
+                users.append(authenticate_user(credentials_file, account[0], account[1]))
+        return users
+
+    seconds, users = _best_of(repeat, login_cold)
+    if not all(users):
+        raise RuntimeError("benchmark logins failed; was Credentials.csv generated with these accounts?")
+    _record(results, "authenticate_user (cold)", seconds, len(accounts))
+    seconds, _ = _best_of(repeat, login_all)
+    _record(results, "authenticate_user (warm)", seconds, len(accounts))
+
+    days = sorted(date_index.counts)
+    if days:
+        sample_days = [date.fromordinal(rng.choice(days)) for _ in range(samples)]
+        seconds, _ = _best_of(repeat, lambda: [date_index.count_on(day) for day in sample_days])
+        _record(results, "count_visits", seconds, samples)
+        ranges = [sorted(rng.sample(sample_days, 2)) for _ in range(samples)]
+        seconds, _ = _best_of(repeat, lambda: [date_index.count_between(start, end) for start, end in ranges])
+        _record(results, "count_visits_between", seconds, samples)
+
+    patient_list = list(patients.values())
+    if patient_list:
+        lookups = []
+        for patient in rng.choices(patient_list, k=samples):
+            day = parse_visit_date(rng.choice(patient.visits).visit_time)
+            lookups.append((patient, day.strftime("%m/%d/%Y")))
+        seconds, _ = _best_of(repeat, lambda: [get_notes_by_date(patient, day) for patient, day in lookups])
+        _record(results, "get_notes_by_date", seconds, samples)
+    del patients, patient_list
+
+    # generate_statistics writes its charts to the working directory. Cold
+    # runs start without the chart cache and visit rollups; warm runs reuse them.
+    def generate_statistics():
+        with contextlib.redirect_stdout(io.StringIO()):
+            hospital_statistics.generate_statistics(paths["data_file"])
+
+    def clear_statistics_caches():
+        for path in (hospital_statistics.CHART_CACHE_FILE, rollup_file(paths["data_file"])):
+            if os.path.exists(path):
+                os.remove(path)
+
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(paths["data_file"])))
+    try:
+        seconds, _ = _best_of(repeat, generate_statistics, setup=clear_statistics_caches)
+        _record(results, "generate_statistics (cold)", seconds, date_index.total())
+        seconds, _ = _best_of(repeat, generate_statistics)
+        _record(results, "generate_statistics (warm)", seconds, date_index.total())
+    finally:
+        os.chdir(cwd)
+
+    # The cold cube build reads the whole CSV; loading it back only reads the saved npz
+    def clear_cube():
+        if os.path.exists(cube_file(paths["data_file"])):
+            os.remove(cube_file(paths["data_file"]))
+
+    seconds, cube = _best_of(repeat, lambda: load_cube(paths["data_file"]), setup=clear_cube)
+    _record(results, "build_cube (cold)", seconds, cube.total())
+    seconds, cube = _best_of(repeat, lambda: load_cube(paths["data_file"]))
+    _record(results, "load_cube (warm)", seconds, cube.total())
+    seconds, _ = _best_of(repeat, lambda: cube.crosstab("Department", "Quarter", {"Gender": ["Female"]}))
+    _record(results, "cube_crosstab", seconds, cube.total())
+    return results
+
+
+def compare_results(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Print each benchmark against a baseline results file; returns the names that regressed."""
+    if baseline.get("metadata", {}).get("visits") != results["metadata"]["visits"]:
+        print("warning: the baseline was run on a different number of visits")
+    regressions = []
+    print(f"{'benchmark':<32} {'baseline s':>12} {'current s':>12} {'change':>9}")
+    for name, current in results["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before is None or not before["seconds"]:
+            print(f"{name:<32} {'-':>12} {current['seconds']:12.4f}")
+            continue
+        change = current["seconds"] / before["seconds"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<32} {before['seconds']:12.4f} {current['seconds']:12.4f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def run_suite(args):
+    def run(directory):
+        if args.data_dir and os.path.exists(os.path.join(directory, "Patient_data.csv")):
+            print(f"Reusing the dataset in {directory}; its accounts are regenerated from --seed")
+            paths = dataset_paths(directory)
+            paths["accounts"] = generate_credentials(paths["credentials_file"], args.users, args.seed,
+                                                     args.hash_iterations)
+        else:
+            start = time.perf_counter()
+            paths = generate_dataset(directory, args.visits, args.seed, args.users, args.note_words,
+                                     args.hash_iterations)
+            print(f"Generated {args.visits:,} visits and {args.users:,} users in {time.perf_counter() - start:.1f} s")
+        data_mb = (os.path.getsize(paths["data_file"]) + os.path.getsize(paths["notes_file"])) / 1e6
+        results = {
+            "metadata": {
+                "visits": args.visits, "users": args.users, "note_words": args.note_words, "seed": args.seed,
+                "hash_iterations": args.hash_iterations, "repeat": args.repeat, "data_mb": round(data_mb, 1),
+                "python": platform.python_version(), "pandas": pd.__version__, "platform": platform.platform(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "results": bench_suite(paths, args.repeat, seed=args.seed),
+        }
+        return results
+
+    if args.data_dir:
+        results = run(args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run(tmp)
+
+    if args.out:
+        with open(args.out, mode='w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmark(s) slower than the baseline: {', '.join(regressions)}")
+
+
+# -------------------- Startup --------------------
+
+def _child_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SRC_DIR, env.get("PYTHONPATH")]))
+    return env
+
+
+def import_times(module, cwd):
+    """Import module in a fresh interpreter under -X importtime.
+
+    Returns (seconds, [(cumulative_us, self_us, name)]) where name keeps the
+    indentation that shows what imported what.
+    """
+    start = time.perf_counter()
+    child = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd,
+                           env=_child_env(), capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    entries = []
+    for line in child.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        if own.strip().isdigit():
+            entries.append((int(cumulative), int(own), name.rstrip()[1:]))
+    return elapsed, entries
+
+
+def login_window_time(cwd, timeout=60):
+    """Seconds from launching the desktop app until its login window is drawn, with the modules it
+    had imported by then from DEFERRED_MODULES; None if there is no display to draw on."""
+    start = time.perf_counter()
+    child = subprocess.Popen([sys.executable, "-c", LOGIN_WINDOW_SCRIPT % (set(DEFERRED_MODULES),)], cwd=cwd,
+                             env=_child_env(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        line = child.stdout.readline()
+        elapsed = time.perf_counter() - start
+        if not line:
+            child.wait(timeout)
+            if "TclError" in child.stderr.read():
+                return None
+            raise RuntimeError("the app exited before drawing its login window")
+        return elapsed, json.loads(line)
+    finally:
+        child.kill()
+        child.wait()
+
+
+def bench_startup(directory, repeat=3, top=15):
+    """Time startup in fresh interpreters, run in directory (which should hold a dataset).
+
+    Returns ({name: seconds}, [deferred modules imported at startup]); each
+    time is the best of `repeat` launches.
+    """
+    results, loaded = {}, set()
+    for module in STARTUP_MODULES:
+        runs = [import_times(module, directory) for _ in range(repeat)]
+        seconds, entries = min(runs, key=lambda run: run[0])
+        results[f"import {module}"] = seconds
+        loaded.update({name.strip().split(".")[0] for _, _, name in entries} & set(DEFERRED_MODULES))
+        print(f"\nimport {module}: {seconds:.3f} s wall, slowest imports by cumulative time:")
+        print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+        for cumulative, own, name in sorted(entries, reverse=True)[:top]:
+            print(f"{cumulative / 1000:14.1f} {own / 1000:9.1f}  {name}")
+
+    windows = [login_window_time(directory) for _ in range(repeat)]
+    if None in windows:
+        print("\nlogin window: skipped, no display")
+    else:
+        seconds, modules = min(windows)
+        results["login window"] = seconds
+        loaded.update(modules)
+        print(f"\nlogin window drawn after {seconds:.3f} s")
+    return results, sorted(loaded)
+
+
+def run_startup(args):
+    def run(directory):
+        if not os.path.exists(os.path.join(directory, "Patient_data.csv")):
+            generate_dataset(directory, args.visits, users=10, note_words=50)
+        return bench_startup(directory, args.repeat, args.top)
+
+    if args.data_dir:
+        results, loaded = run(args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            results, loaded = run(tmp)
+
+    failures = []
+    window = results.get("login window")
+    if window is not None and window > args.budget:
+        failures.append(f"login window took {window:.3f} s, over the {args.budget:.3f} s budget")
+    if loaded:
+        failures.append(f"imported at startup: {', '.join(loaded)}")
+    if failures:
+        raise SystemExit("Startup regressed: " + "; ".join(failures))
+    if window is None:
+        print(f"login window: SKIPPED, no display; the {args.budget:.3f} s budget was not checked")
+    else:
+        print(f"login window: {window:.3f} s, within the {args.budget:.3f} s budget")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the hospital data pipeline.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    ingest = sub.add_parser("ingest", help="statistics CSV ingestion")
+    ingest.add_argument("--rows", type=int, default=10_000_000)
+    ingest.add_argument("--file", help="existing Patient_data.csv to read instead of a synthetic one")
+    ingest.add_argument("--repeat", type=int, default=1)
+    search = sub.add_parser("search", help="note search index build time and query latency")
+    search.add_argument("--notes", type=int, default=100_000)
+    search.add_argument("--repeat", type=int, default=20)
+    suite = sub.add_parser("suite", help="load, login and lookup timings on a generated dataset, as JSON")
+    suite.add_argument("--visits", type=lambda value: int(float(value)), default=100_000, help="e.g. 1e6")
+    suite.add_argument("--users", type=int, default=2000)
+    suite.add_argument("--note-words", type=int, default=400, help="mean words per note")
+    suite.add_argument("--hash-iterations", type=int, default=1000,
+                       help="PBKDF2 iterations for the generated passwords")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("--data-dir", help="generate the dataset here (or reuse it) instead of a temporary directory")
+    suite.add_argument("--out", help="write the results as JSON to this file")
+    suite.add_argument("--compare", help="baseline JSON from an earlier --out; exits non-zero on regressions")
+    suite.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                       help="slowdown that counts as a regression (0.10 = 10%%)")
+    startup = sub.add_parser("startup", help="import-time report and time to the login window; exits non-zero "
+                                             "if over budget or if pandas/matplotlib load at startup")
+    startup.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="seconds")
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.add_argument("--top", type=int, default=15, help="slowest imports listed per module")
+    startup.add_argument("--visits", type=lambda value: int(float(value)), default=10_000,
+                         help="size of the dataset the app opens")
+    startup.add_argument("--data-dir", help="run the app here (a dataset is generated if there is none)")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        if args.file:
+            bench_ingest(args.file, args.repeat)
+            return
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Patient_data.csv")
+            start = time.perf_counter()
+            generate_visits(path, args.rows)
+            print(f"Generated {args.rows:,} visits in {time.perf_counter() - start:.1f} s")
+            bench_ingest(path, args.repeat)
+
+    elif args.command == "search":
+        with tempfile.TemporaryDirectory() as tmp:
+            notes_path, data_path = os.path.join(tmp, "Notes.csv"), os.path.join(tmp, "Patient_data.csv")
+            generate_visits(data_path, args.notes, notes_path, note_words=120)
+            bench_search(notes_path, data_path, args.repeat)
+
+    elif args.command == "suite":
+        run_suite(args)
+
+    elif args.command == "startup":
+        run_startup(args)
+
+
+if __name__ == "__main__":
+    main()
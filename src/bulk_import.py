@@ -0,0 +1,163 @@
+import argparse
+import csv
+import os
+import time
+from collections import Counter
+from itertools import islice
+from patients import Visit, Note
+from patient_repository import PATIENT_FIELDS, CHUNK_SIZE
+from visit_index import visit_ordinal
+
+REQUIRED_FIELDS = ["Patient_ID", "Visit_ID", "Visit_time", "Note_ID"]
+
+
+def validate_row(row):
+    """Return why an import row is unusable, or None if it can be imported."""
+    for field in PATIENT_FIELDS:
+        if row.get(field) is None:
+            return f"missing column {field}"
+    for field in REQUIRED_FIELDS:
+        if not row[field].strip():
+            return f"empty {field}"
+    if not visit_ordinal(row["Visit_time"]):
+        return "invalid Visit_time"
+    try:
+        age = int(row["Age"])
+    except ValueError:
+        return "invalid Age"
+    if not 0 <= age <= 130:
+        return "invalid Age"
+    return None
+
+
+def build_entry(row):
+    """Turn a validated row into the (patient_id, visit, note, note_text) tuple storage.add_visits takes."""
+    visit = Visit(row["Visit_ID"].strip(), row["Visit_time"].strip(), row["Visit_department"], row["Gender"],
+                  row["Race"], int(row["Age"]), row["Ethnicity"], row["Insurance"], row["Zip_code"],
+                  row["Chief_complaint"])
+    note = Note(row["Note_ID"].strip(), row["Note_type"])
+    visit.add_note(note)
+    return row["Patient_ID"].strip(), visit, note, row.get("Note_text") or ""
+
+
+class ImportReport:
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.rejected = Counter()  # reason -> rows
+        self.started = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return self.read / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        rejected = ", ".join(f"{reason}: {count}" for reason, count in self.rejected.most_common()) or "none"
+        return (f"Read {self.read:,} rows in {self.seconds:.1f} s ({self.rate:,.0f} rows/s): "
+                f"{self.imported:,} imported, {self.duplicates:,} duplicates skipped, "
+                f"{sum(self.rejected.values()):,} rejected ({rejected})")
+
+
+def bulk_import(storage, input_file, batch_size=CHUNK_SIZE, note_index=None, rejects_file=None, progress=None):
+    """Stream visits and notes from input_file into storage, one batch write per batch_size rows.
+
+    The input has the Patient_data.csv columns plus an optional Note_text
+    column. Rows that fail validation are counted (and copied to
+    rejects_file with a Reason column, if given). Rows whose Visit_ID or
+    Note_ID is already stored, or appeared earlier in the input, are skipped.
+    The storage's in-memory model, and note_index if given, are updated in
+    place, so nothing has to be reloaded afterwards.
+
+    progress, if given, is called with the ImportReport after each batch.
+    Raises FileNotFoundError if input_file is missing.
+    """
+    report = ImportReport()
+    seen_visits, seen_notes = set(), set()
+    rejects = None
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        try:
+            while True:
+                rows = list(islice(reader, batch_size))
+                if not rows:
+                    break
+                report.read += len(rows)
+
+                valid = []
+                for row in rows:
+                    reason = validate_row(row)
+                    if reason is None:
+                        valid.append(row)
+                        continue
+                    report.rejected[reason] += 1
+                    if rejects_file:
+                        if rejects is None:
+                            rejects_handle = open(rejects_file, mode='w', newline='', encoding='utf-8')
+                            rejects = csv.DictWriter(rejects_handle, fieldnames=list(reader.fieldnames) + ["Reason"],
+                                                     extrasaction='ignore')
+                            rejects.writeheader()
+                        rejects.writerow({**row, "Reason": reason})
+
+                stored_visits, stored_notes = storage.existing_ids({row["Visit_ID"].strip() for row in valid},
+                                                                   {row["Note_ID"].strip() for row in valid})
+                entries = []
+                for row in valid:
+                    visit_id, note_id = row["Visit_ID"].strip(), row["Note_ID"].strip()
+                    if (visit_id in stored_visits or visit_id in seen_visits
+                            or note_id in stored_notes or note_id in seen_notes):
+                        report.duplicates += 1
+                        continue
+                    seen_visits.add(visit_id)
+                    seen_notes.add(note_id)
+                    entries.append(build_entry(row))
+
+                if entries:
+                    storage.add_visits(entries)
+                    if note_index is not None:
+                        note_index.add_notes([(note.note_id, pid, visit.visit_time, text)
+                                              for pid, visit, note, text in entries],
+                                             appended=storage.notes_file is not None)
+                    report.imported += len(entries)
+                if progress is not None:
+                    progress(report)
+        finally:
+            if rejects is not None:
+                rejects_handle.close()
+    return report
+
+
+if __name__ == "__main__":
+    from storage import open_storage
+    from note_search import load_note_index, index_file
+
+    parser = argparse.ArgumentParser(description="Import a nightly extract of visits and notes.")
+    parser.add_argument("input_file", help="CSV with the Patient_data.csv columns plus Note_text")
+    parser.add_argument("--data-file", default="Patient_data.csv")
+    parser.add_argument("--notes-file", default="Notes.csv")
+    parser.add_argument("--batch-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--rejects", help="write rejected rows and their reasons to this CSV")
+    args = parser.parse_args()
+
+    storage = open_storage(args.data_file, args.notes_file)
+    try:
+        storage.load()
+    except FileNotFoundError:
+        pass  # the first import creates the data file
+    # Keep an existing search index current rather than leaving it to be rebuilt
+    note_index = load_note_index(args.notes_file, args.data_file) if os.path.exists(index_file(args.notes_file)) else None
+
+    try:
+        result = bulk_import(storage, args.input_file, args.batch_size, note_index, args.rejects,
+                             progress=lambda report: print(f"  {report.read:,} rows, {report.rate:,.0f} rows/s"))
+    except FileNotFoundError:
+        print(f"Input file {args.input_file} not found.")
+    else:
+        if note_index is not None:
+            note_index.save()
+        print(result)
+    storage.close()
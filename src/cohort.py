@@ -0,0 +1,373 @@
+import heapq
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+from visit_index import visit_ordinal
+from instrumentation import timed
+
+# Criterion name -> Patient_data.csv column, for the columns indexed by value
+CATEGORY_CRITERIA = {
+    "department": "Visit_department",
+    "race": "Race",
+    "gender": "Gender",
+    "ethnicity": "Ethnicity",
+    "insurance": "Insurance",
+    "complaint": "Chief_complaint",
+    "zip": "Zip_code",  # indexed by its first ZIP_PREFIX digits
+}
+# Every criterion with the prompt shown for it, in display order
+CRITERIA_LABELS = {
+    "department": "Department",
+    "gender": "Gender",
+    "race": "Race",
+    "ethnicity": "Ethnicity",
+    "insurance": "Insurance",
+    "complaint": "Chief complaint",
+    "zip": "Zip prefix (e.g. 534xx)",
+    "age": "Age (e.g. 51-65, 65+)",
+    "visit_date": "Visit dates (e.g. Q3 2016, 2016-07 to 2016-09)",
+}
+ZIP_PREFIX = 3
+# A value whose rows would take more room as a row list than as a bitmap over all
+# rows (4 bytes per row against 1 bit per visit) is kept as a bitmap
+DENSE_RATIO = 32
+NONZERO_BYTES = re.compile(rb"[^\x00]")
+
+
+# -------------------- Bitmaps --------------------
+#
+# A cohort is a Python int used as a bitset: bit i is set when visit row i
+# matches. AND, OR and popcount on ints run in C over machine words, so
+# combining criteria over a million visits costs microseconds.
+
+def bitmap_of(rows):
+    """Bitmap with the bits of the given row numbers set."""
+    if not rows:
+        return 0
+    low = min(rows) >> 3
+    buffer = bytearray((max(rows) >> 3) - low + 1)
+    for row in rows:
+        buffer[(row >> 3) - low] |= 1 << (row & 7)
+    return int.from_bytes(buffer, "little") << (low * 8)
+
+
+def bitmap_mask(bitmap, size):
+    """A numpy bool array of size entries, True where the bitmap's bit is set."""
+    import numpy as np  # only loaded once a cohort needs per-row arithmetic
+    data = np.frombuffer(bitmap.to_bytes((size + 7) // 8, "little"), dtype=np.uint8)
+    return np.unpackbits(data, bitorder="little", count=size).view(bool)
+
+
+def mask_bitmap(mask):
+    """Inverse of bitmap_mask()."""
+    import numpy as np
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+
+def rows_of(bitmap):
+    """Yield the row numbers set in a bitmap, in ascending order."""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for match in NONZERO_BYTES.finditer(data):
+        offset, byte = match.start() * 8, data[match.start()]
+        for bit in range(8):
+            if byte >> bit & 1:
+                yield offset + bit
+
+
+class Posting:
+    """The rows holding one value: a bitmap for common values, a row list for rare ones."""
+
+    __slots__ = ("bits", "rows")
+
+    def __init__(self):
+        self.bits = 0
+        self.rows = array("I")
+
+    def __len__(self):
+        return self.bits.bit_count() + len(self.rows)
+
+    def bitmap(self):
+        return self.bits | bitmap_of(self.rows) if self.rows else self.bits
+
+    def seal(self, size):
+        """Fold the row list into the bitmap once the value is common enough."""
+        if self.rows and len(self) * DENSE_RATIO >= size:
+            self.bits = self.bitmap()
+            self.rows = array("I")
+
+
+class SortedIndex:
+    """Postings for an ordered key (Age, visit date ordinal), with the keys kept sorted for range lookups."""
+
+    def __init__(self):
+        self.postings = {}
+        self._keys = None
+
+    def add(self, key, row):
+        posting = self.postings.get(key)
+        if posting is None:
+            posting = self.postings[key] = Posting()
+            self._keys = None
+        posting.rows.append(row)
+
+    def keys(self):
+        if self._keys is None:
+            self._keys = sorted(self.postings)
+        return self._keys
+
+    def between(self, low=None, high=None):
+        """Bitmap of the rows whose key is from low to high, both inclusive; None means unbounded."""
+        keys = self.keys()
+        start = 0 if low is None else bisect_left(keys, low)
+        end = len(keys) if high is None else bisect_right(keys, high)
+        bits, rows = 0, array("I")
+        for key in keys[start:end]:
+            posting = self.postings[key]
+            bits |= posting.bits
+            rows.extend(posting.rows)
+        return bits | bitmap_of(rows)
+
+
+# -------------------- Index --------------------
+
+class CohortIndex:
+    """Bitmap indexes over every visit row, for multi-criteria cohort counts and lookups.
+
+    Rows are numbered in the order they are consumed. Each value of the
+    categorical columns (and each 3-digit zip prefix) maps to the rows holding
+    it; Age and visit date are sorted indexes, so a range is one bisect and an
+    OR of the keys inside it. select() ANDs the criteria together without
+    visiting a single Patient or Visit object.
+
+    consume() makes the index a storage.load() sink, and can also be called
+    later with newly added rows. remove_patient() masks out a patient's rows.
+    Rows hold a patient number rather than the Patient_ID, so counting a
+    cohort's patients or finding a patient's rows is one vectorised pass.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.patients = array("I")  # patient number per row
+        self.patient_ids = []       # Patient_ID per patient number
+        self.visit_ids = []
+        self.ordinals = array("i")  # visit date ordinal per row, 0 if invalid
+        self.removed = 0
+        self.columns = {criterion: {} for criterion in CATEGORY_CRITERIA}
+        self.ages = SortedIndex()
+        self.dates = SortedIndex()
+        self._patient_numbers = {}  # Patient_ID -> patient number
+
+    def __len__(self):
+        return self.size - self.removed.bit_count()
+
+    @classmethod
+    @timed("cohort.build", rows=len)
+    def build(cls, chunks):
+        """Index every row of an iterable of row chunks, e.g. storage.iter_row_chunks()."""
+        index = cls()
+        for chunk in chunks:
+            index.consume(chunk)
+        index.seal()
+        return index
+
+    def consume(self, rows):
+        postings = [(criterion, column, self.columns[criterion]) for criterion, column in CATEGORY_CRITERIA.items()]
+        for row in rows:
+            number = self.size
+            self.size += 1
+            patient_id = row["Patient_ID"]
+            patient = self._patient_numbers.get(patient_id)
+            if patient is None:
+                patient = self._patient_numbers[patient_id] = len(self.patient_ids)
+                self.patient_ids.append(patient_id)
+            self.patients.append(patient)
+            self.visit_ids.append(row["Visit_ID"])
+            for criterion, column, values in postings:
+                value = row[column].strip()
+                if criterion == "zip":
+                    value = value[:ZIP_PREFIX]
+                posting = values.get(value)
+                if posting is None:
+                    posting = values[value] = Posting()
+                posting.rows.append(number)
+            try:
+                self.ages.add(int(row["Age"]), number)
+            except ValueError:
+                pass
+            ordinal = visit_ordinal(row["Visit_time"])
+            self.ordinals.append(ordinal)
+            if ordinal:
+                self.dates.add(ordinal, number)
+
+    def seal(self):
+        """Turn the row lists of common values into bitmaps; called once a build is complete."""
+        for values in self.columns.values():
+            for posting in values.values():
+                posting.seal(self.size)
+        for index in (self.ages, self.dates):
+            for posting in index.postings.values():
+                posting.seal(self.size)
+
+    def remove_patient(self, patient_id):
+        """Exclude every row of a patient from later queries; returns how many rows that was."""
+        patient = self._patient_numbers.get(patient_id)
+        if patient is None:
+            return 0
+        rows = self._patient_array() == patient
+        self.removed |= mask_bitmap(rows)
+        return int(rows.sum())
+
+    def _patient_array(self):
+        import numpy as np
+        return np.frombuffer(self.patients, dtype=np.uintc).copy()  # a copy, so consume() can still grow the array
+
+    # -------------------- Queries --------------------
+
+    def values(self, criterion):
+        """The distinct values of a categorical criterion still present, most common first."""
+        return [value for value, _ in self.breakdown(self.everyone(), criterion)]
+
+    def everyone(self):
+        return ((1 << self.size) - 1) & ~self.removed
+
+    def select(self, criteria):
+        """Bitmap of the live rows matching every criterion.
+
+        criteria maps a name from CATEGORY_CRITERIA to a value or a list of
+        values (any of which may match; compared case-insensitively), or
+        "age" / "visit_date" to a (low, high) pair of ints / dates, inclusive,
+        where either end may be None. Zip values are prefixes of up to
+        ZIP_PREFIX digits. Raises ValueError for an unknown criterion.
+        """
+        result = self.everyone()
+        for criterion, wanted in criteria.items():
+            if criterion in CATEGORY_CRITERIA:
+                result &= self._any_of(criterion, [wanted] if isinstance(wanted, str) else wanted)
+            elif criterion == "age":
+                result &= self.ages.between(*wanted)
+            elif criterion == "visit_date":
+                low, high = wanted
+                result &= self.dates.between(low.toordinal() if low else None, high.toordinal() if high else None)
+            else:
+                raise ValueError(f"Unknown cohort criterion: {criterion}")
+            if not result:
+                break
+        return result
+
+    def _any_of(self, criterion, wanted):
+        values = self.columns[criterion]
+        wanted = [value.strip().casefold() for value in wanted]
+        bits, rows = 0, array("I")
+        for value, posting in values.items():
+            value = value.casefold()
+            if criterion == "zip":
+                matched = any(value.startswith(prefix[:ZIP_PREFIX]) for prefix in wanted)
+            else:
+                matched = value in wanted
+            if matched:
+                bits |= posting.bits
+                rows.extend(posting.rows)
+        return bits | bitmap_of(rows)
+
+    def count(self, criteria):
+        return self.select(criteria).bit_count()
+
+    def breakdown(self, cohort, criterion):
+        """[(value, visits)] of a categorical criterion within a cohort bitmap, largest first."""
+        counts = []
+        for value, posting in self.columns[criterion].items():
+            visits = (cohort & posting.bitmap()).bit_count()
+            if visits:
+                counts.append((value, visits))
+        return sorted(counts, key=lambda item: (-item[1], item[0]))
+
+    def patient_count(self, cohort):
+        """How many distinct patients the visits of a cohort bitmap belong to."""
+        import numpy as np
+        patients = self._patient_array()[bitmap_mask(cohort, self.size)]
+        return int(np.count_nonzero(np.bincount(patients, minlength=len(self.patient_ids))))
+
+    def visits(self, cohort, limit=None):
+        """[(patient_id, visit_id, visit date or None)] in a cohort, most recent visit first."""
+        rows = rows_of(cohort)
+        if limit is not None:
+            rows = heapq.nlargest(limit, rows, key=self.ordinals.__getitem__)
+        else:
+            rows = sorted(rows, key=self.ordinals.__getitem__, reverse=True)
+        return [(self.patient_ids[self.patients[row]], self.visit_ids[row],
+                 date.fromordinal(self.ordinals[row]) if self.ordinals[row] else None) for row in rows]
+
+
+# -------------------- Parsing --------------------
+
+AGE_PATTERN = re.compile(r"(\d+)?\s*([-+])?\s*(\d+)?")
+RANGE_SEPARATOR = re.compile(r"\s+to\s+|\s*\.\.\s*")
+QUARTER_PATTERN = re.compile(r"^(?:q([1-4])\s*[-/ ]?\s*(\d{4})|(\d{4})\s*[-/ ]?\s*q([1-4]))$", re.IGNORECASE)
+
+
+def parse_period(text):
+    """(first day, last day) of a period: YYYY, YYYY-MM, YYYY-MM-DD or a quarter (Q3 2016, 2016-Q3).
+
+    Raises ValueError for anything else.
+    """
+    text = text.strip()
+    quarter = QUARTER_PATTERN.match(text)
+    if quarter:
+        number, year = (int(quarter.group(1)), int(quarter.group(2))) if quarter.group(1) else \
+            (int(quarter.group(4)), int(quarter.group(3)))
+        first = date(year, number * 3 - 2, 1)
+        last = date(year + 1, 1, 1) if number == 4 else date(year, number * 3 + 1, 1)
+        return first, date.fromordinal(last.toordinal() - 1)
+    for pattern in ("%Y-%m-%d", "%Y-%m", "%Y"):
+        try:
+            first = datetime.strptime(text, pattern).date()
+        except ValueError:
+            continue
+        if pattern == "%Y-%m-%d":
+            return first, first
+        if pattern == "%Y-%m":
+            following = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+        else:
+            following = date(first.year + 1, 1, 1)
+        return first, date.fromordinal(following.toordinal() - 1)
+    raise ValueError(f"Unrecognised period: {text}")
+
+
+def parse_criteria(fields):
+    """Turn {criterion: text} as typed by a user into select() criteria; blank fields are left out.
+
+    Categorical fields take comma-separated alternatives ("Medicare, Medicaid";
+    zip prefixes may be written 534xx). Age is "51-65", "65+" or "-18".
+    Visit dates are a period or "period to period" (see parse_period).
+    Raises ValueError with a message fit to show the user.
+    """
+    criteria = {}
+    for criterion, text in fields.items():
+        text = (text or "").strip()
+        if not text:
+            continue
+        if criterion in CATEGORY_CRITERIA:
+            values = [value.strip() for value in text.split(",") if value.strip()]
+            if criterion == "zip":
+                values = [value.rstrip("xX*") for value in values]
+                if any(not value.isdigit() or len(value) > ZIP_PREFIX for value in values):
+                    raise ValueError(f"Zip codes are matched on their first {ZIP_PREFIX} digits, e.g. 534xx")
+            criteria[criterion] = values
+        elif criterion == "age":
+            match = AGE_PATTERN.fullmatch(text)
+            low, separator, high = match.groups() if match else (None, None, None)
+            if (low is None and high is None) or (separator != "-" and high is not None) or \
+                    (separator == "+" and low is None):
+                raise ValueError("Age must be a number or a range such as 51-65, 65+ or -18")
+            low = int(low) if low is not None else None
+            high = int(high) if high is not None else None
+            criteria["age"] = (low, low) if separator is None else (low, high)
+        elif criterion == "visit_date":
+            parts = RANGE_SEPARATOR.split(text, maxsplit=1)
+            first, last = parts[0], parts[-1]
+            criteria["visit_date"] = (parse_period(first)[0] if first else None,
+                                      parse_period(last)[1] if last else None)
+        else:
+            raise ValueError(f"Unknown cohort criterion: {criterion}")
+    return criteria
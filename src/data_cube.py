@@ -0,0 +1,350 @@
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+from patient_repository import (CHUNK_SIZE, iter_removed_rows, iter_rows_with_offsets, load_tombstones,
+                                resume_offset, saved_source, tail_bytes)
+from instrumentation import timed
+from age_groups import AGE_BINS, AGE_LABELS
+
+# Dimension -> the Patient_data.csv column it is derived from, in axis order
+DIMENSIONS = {
+    "Department": "Visit_department",
+    "Gender": "Gender",
+    "Race": "Race",
+    "Ethnicity": "Ethnicity",
+    "Insurance": "Insurance",
+    "AgeGroup": "Age",
+    "Month": "Visit_time",
+}
+AXES = list(DIMENSIONS)
+SOURCE_COLUMNS = list(DIMENSIONS.values())
+MONTH_ROLLUPS = {"Quarter": 3, "Year": 12}  # coarser groupings of the Month axis, in months
+OTHER_AGES = "Other"  # AgeGroup entry for ages in no band, which the statistics report leaves out
+VISIT_DATE_FORMAT = "%m/%d/%Y"
+COUNT_DTYPE = np.int32
+CSV_CHUNK_ROWS = 1_000_000  # rows per read_csv chunk on a full build
+VERSION = 2
+
+
+def month_key(label):
+    """"YYYY-MM" -> year * 12 + month - 1."""
+    year, month = map(int, label.split("-"))
+    return year * 12 + month - 1
+
+
+def month_label(key):
+    return f"{key // 12}-{key % 12 + 1:02d}"
+
+
+def _month_keys(column):
+    # Parse each distinct Visit_time once; -1 where there is no valid date
+    column = column.astype("category")
+    dates = pd.to_datetime(column.cat.categories.astype(str).str.strip(), format=VISIT_DATE_FORMAT, errors="coerce")
+    keys = np.where(dates.isna(), -1, dates.year.to_numpy(dtype=float) * 12 + dates.month.to_numpy(dtype=float) - 1)
+    codes = column.cat.codes.to_numpy()
+    return np.where(codes >= 0, keys.astype(np.int64)[codes], -1)
+
+
+class _FileHead(io.RawIOBase):
+    """The first `limit` bytes of an open binary file, so a reader cannot see rows appended meanwhile."""
+
+    def __init__(self, binfile, limit):
+        self.binfile = binfile
+        self.remaining = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.binfile.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+class VisitCube:
+    """Visit counts for every department x gender x race x ethnicity x insurance x age group x month.
+
+    The cells are one dense numpy array with an axis per dimension, so a slice
+    is an index, a roll-up is a sum over axes and a cross-tab is both. None of
+    them read Patient_data.csv. Month is a contiguous range of months and
+    rolls up to Quarter and Year; the other axes list values in the order
+    they were first seen.
+
+    Like VisitRollups, the cube remembers how far into Patient_data.csv it
+    has read, so refresh() only counts rows appended since, and a removal
+    only uncounts the removed patient's rows. A compaction forces a rebuild.
+    """
+
+    def __init__(self):
+        self.labels = {dimension: [] for dimension in AXES if dimension != "Month"}
+        self.labels["AgeGroup"] = AGE_LABELS + [OTHER_AGES]
+        self.first_month = 0  # month key of the first entry on the Month axis
+        self.counts = np.zeros((0,) * len(AXES), dtype=COUNT_DTYPE)
+        self.undated = 0  # visits without a valid Visit_time, which no month can hold
+        self.source = None  # (inode, byte offset read up to, tombstone state)
+
+    def total(self):
+        return int(self.counts.sum(dtype=np.int64))
+
+    def axis_labels(self, dimension):
+        if dimension == "Month":
+            return [month_label(self.first_month + i) for i in range(self.counts.shape[-1])]
+        return self.labels[dimension]
+
+    # -------------------- Counting --------------------
+
+    def add_frame(self, frame, visits=1):
+        """Count the visits in a DataFrame holding the SOURCE_COLUMNS as raw strings, in one vectorised pass.
+
+        visits=-1 uncounts them instead.
+        """
+        months = _month_keys(frame["Visit_time"])
+        dated = months >= 0
+        self.undated += visits * int((~dated).sum())
+        if not dated.any():
+            return
+        frame, months = frame[dated], months[dated]
+
+        codes = []
+        for dimension in AXES[:-1]:
+            column = frame[DIMENSIONS[dimension]]
+            if dimension == "AgeGroup":
+                bands = pd.cut(pd.to_numeric(column, errors="coerce"), bins=AGE_BINS, labels=False)
+                codes.append(np.nan_to_num(bands.to_numpy(dtype=float), nan=len(AGE_LABELS)).astype(np.int64))
+                continue
+            values = column.fillna("").astype(str).str.strip().astype("category")
+            labels = self.labels[dimension]
+            positions = {label: i for i, label in enumerate(labels)}
+            for value in values.cat.categories:
+                if value not in positions:
+                    positions[value] = len(labels)
+                    labels.append(value)
+            lookup = np.array([positions[value] for value in values.cat.categories], dtype=np.int64)
+            codes.append(lookup[values.cat.codes.to_numpy()])
+
+        self._grow(int(months.min()), int(months.max()))
+        codes.append(months - self.first_month)
+        cells = np.ravel_multi_index(codes, self.counts.shape)
+        flat = self.counts.reshape(-1)
+        if len(cells) * 8 < flat.size:
+            np.add.at(flat, cells, visits)  # a few visits: don't allocate a whole cube of counts
+        else:
+            flat += visits * np.bincount(cells, minlength=flat.size).astype(COUNT_DTYPE)
+
+    def add_rows(self, rows, visits=1):
+        if rows:
+            self.add_frame(pd.DataFrame.from_records(rows, columns=SOURCE_COLUMNS), visits)
+
+    def _grow(self, first_month, last_month):
+        """Widen the axes to every known label and the months from first_month to last_month."""
+        old_shape = self.counts.shape
+        if old_shape[-1]:
+            first_month = min(first_month, self.first_month)
+            last_month = max(last_month, self.first_month + old_shape[-1] - 1)
+        shape = tuple(len(self.labels[dimension]) for dimension in AXES[:-1]) + (last_month - first_month + 1,)
+        if shape == old_shape:
+            return
+        counts = np.zeros(shape, dtype=COUNT_DTYPE)
+        if self.counts.size:
+            shift = self.first_month - first_month
+            counts[tuple(slice(0, n) for n in old_shape[:-1]) + (slice(shift, shift + old_shape[-1]),)] = self.counts
+        self.counts = counts
+        self.first_month = first_month
+
+    # -------------------- Keeping up with the data file --------------------
+
+    def refresh(self, data_file):
+        """Bring the cube up to date with data_file; returns True if anything changed."""
+        try:
+            inode = os.stat(data_file).st_ino
+        except FileNotFoundError:
+            return False
+        removed = load_tombstones(data_file)
+        tombstones = sorted(removed.items())
+        offset = resume_offset(data_file, self.source, inode, removed)
+        if offset is None:
+            self.__init__()
+            end = self._read_rows(data_file, 0, removed) if removed else self._read_csv(data_file)
+        else:
+            self.add_rows(list(iter_removed_rows(data_file, offset, dict(self.source[2]), removed)), -1)
+            end = self._read_rows(data_file, offset, removed)
+        changed = self.source != (inode, end, tombstones)
+        self.source = (inode, end, tombstones)
+        return changed
+
+    def _read_csv(self, data_file):
+        # Full build: pandas' C parser, stopping before a final row whose append may still be in progress
+        size = os.path.getsize(data_file)
+        tail = tail_bytes(data_file, size)
+        if b"\n" not in tail:
+            return self._read_rows(data_file, 0, {})
+        end = size - len(tail) + tail.rindex(b"\n") + 1
+        with open(data_file, 'rb') as binfile:
+            reader = pd.read_csv(io.BufferedReader(_FileHead(binfile, end)), usecols=SOURCE_COLUMNS, dtype=str,
+                                 chunksize=CSV_CHUNK_ROWS)
+            for chunk in reader:
+                self.add_frame(chunk)
+        return end
+
+    def _read_rows(self, data_file, offset, tombstones):
+        end = offset
+        rows = []
+        for start, end, row in iter_rows_with_offsets(data_file, offset):
+            if start < tombstones.get(row["Patient_ID"], -1):
+                continue
+            rows.append(row)
+            if len(rows) >= CHUNK_SIZE:
+                self.add_rows(rows)
+                rows = []
+        self.add_rows(rows)
+        return end
+
+    # -------------------- Queries --------------------
+
+    def _axis(self, dimension):
+        if dimension in MONTH_ROLLUPS:
+            return AXES.index("Month")
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"Unknown dimension: {dimension}")
+        return AXES.index(dimension)
+
+    def _slice(self, filters):
+        """(cells, labels per axis) for the cells matching filters; see query()."""
+        cells = self.counts
+        labels = [self.axis_labels(dimension) for dimension in AXES]
+        for dimension, wanted in filters.items():
+            axis = self._axis(dimension)
+            if dimension == "Month":
+                first, last = wanted
+                start = 0 if first is None else max(month_key(first) - self.first_month, 0)
+                stop = len(labels[axis]) if last is None else max(month_key(last) - self.first_month + 1, 0)
+                cells = cells[(slice(None),) * axis + (slice(start, stop),)]
+                labels[axis] = labels[axis][start:stop]
+                continue
+            if dimension in MONTH_ROLLUPS:
+                raise ValueError(f"Filter on Month rather than {dimension}")
+            wanted = {value.strip().casefold() for value in ([wanted] if isinstance(wanted, str) else wanted)}
+            positions = [i for i, label in enumerate(labels[axis]) if label.casefold() in wanted]
+            cells = np.take(cells, positions, axis=axis)
+            labels[axis] = [labels[axis][i] for i in positions]
+        return cells, labels
+
+    def query(self, group_by=(), filters=None):
+        """Visit counts for the cells matching filters, rolled up to the group_by dimensions.
+
+        filters maps a dimension to a value or list of values (compared
+        case-insensitively), or "Month" to a ("YYYY-MM", "YYYY-MM") range,
+        inclusive, where either end may be None. group_by names dimensions
+        from DIMENSIONS or MONTH_ROLLUPS. Returns the total as an int with no
+        group_by, otherwise a pandas Series indexed by every combination of
+        the grouped labels, zeros included. Raises ValueError for an unknown
+        dimension.
+        """
+        cells, labels = self._slice(filters or {})
+        axes = [self._axis(dimension) for dimension in group_by]
+        if len(set(axes)) != len(axes):
+            raise ValueError("Group by each dimension once (Month, Quarter and Year share an axis)")
+        if not axes:
+            return int(cells.sum(dtype=np.int64))
+
+        summed = cells.sum(axis=tuple(i for i in range(cells.ndim) if i not in axes), dtype=np.int64)
+        kept = sorted(axes)
+        summed = summed.transpose([kept.index(axis) for axis in axes])
+        index_labels = []
+        for position, (dimension, axis) in enumerate(zip(group_by, axes)):
+            if dimension in MONTH_ROLLUPS and len(labels[axis]):
+                size = MONTH_ROLLUPS[dimension]
+                groups = np.array([month_key(label) // size for label in labels[axis]])
+                starts = np.concatenate([[0], np.flatnonzero(np.diff(groups)) + 1])
+                summed = np.add.reduceat(summed, starts, axis=position)
+                index_labels.append([str(group // 4) + f"-Q{group % 4 + 1}" if size == 3 else str(group)
+                                     for group in groups[starts]])
+            else:
+                index_labels.append(labels[axis])
+
+        if len(group_by) == 1:
+            index = pd.Index(index_labels[0], name=group_by[0])
+        else:
+            index = pd.MultiIndex.from_product(index_labels, names=list(group_by))
+        return pd.Series(summed.reshape(-1), index=index, name="Visits")
+
+    def crosstab(self, rows, columns, filters=None):
+        """DataFrame of visit counts with one dimension down and another across, without all-zero rows/columns."""
+        table = self.query([rows, columns], filters).unstack(columns)
+        return table.loc[table.sum(axis=1) > 0, table.sum(axis=0) > 0]
+
+    # -------------------- Persistence --------------------
+
+    def save(self, path):
+        meta = {"version": VERSION, "axes": AXES, "labels": self.labels, "first_month": self.first_month,
+                "undated": self.undated, "source": self.source}
+        temp_path = path + ".tmp"
+        with open(temp_path, mode='wb') as f:
+            np.savez_compressed(f, counts=self.counts,
+                                meta=np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a saved cube, or return an empty one if it is missing, damaged or from another version."""
+        cube = cls()
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                meta = json.loads(saved["meta"].tobytes())
+                counts = saved["counts"]
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return cube
+        if meta.get("version") != VERSION or meta.get("axes") != AXES:
+            return cube
+        cube.labels = meta["labels"]
+        cube.first_month = meta["first_month"]
+        cube.undated = meta["undated"]
+        cube.counts = counts.astype(COUNT_DTYPE, copy=False)
+        if meta["source"] is not None:
+            cube.source = saved_source(meta["source"])
+        return cube
+
+
+def cube_file(data_file):
+    root, _ = os.path.splitext(data_file)
+    return f"{root}_cube.npz"
+
+
+@timed("load_cube", rows=lambda cube: cube.total())
+def load_cube(data_file, cube=None):
+    """Return the cube for data_file, counting only rows appended since it was last saved."""
+    path = cube_file(data_file)
+    if cube is None:
+        cube = VisitCube.load(path)
+    if cube.refresh(data_file):
+        cube.save(path)
+    return cube
+
+
+def parse_filters(fields):
+    """Turn {dimension: text} as typed by a user into query() filters; blank fields are left out.
+
+    Dimensions take comma-separated alternatives. Month takes a period or
+    "period to period" (see cohort.parse_period), e.g. Q3 2016 or 2016-07 to 2016-09.
+    Raises ValueError with a message fit to show the user.
+    """
+    from cohort import RANGE_SEPARATOR, parse_period
+
+    filters = {}
+    for dimension, text in fields.items():
+        text = (text or "").strip()
+        if not text:
+            continue
+        if dimension == "Month":
+            parts = RANGE_SEPARATOR.split(text, maxsplit=1)
+            first, last = parts[0], parts[-1]
+            filters["Month"] = (parse_period(first)[0].strftime("%Y-%m") if first else None,
+                                parse_period(last)[1].strftime("%Y-%m") if last else None)
+        elif dimension in DIMENSIONS:
+            filters[dimension] = [value.strip() for value in text.split(",") if value.strip()]
+        else:
+            raise ValueError(f"Unknown dimension: {dimension}")
+    return filters
@@ -0,0 +1,176 @@
+import argparse
+import csv
+import os
+import time
+import numpy as np
+import pandas as pd
+from patient_repository import PATIENT_FIELDS, NOTE_FIELDS
+from users import hash_password
+
+# Category values and their shares in the sample data/ files
+DEPARTMENTS = {"Pediatrics": 0.30, "Head and Neck": 0.11, "Obstetrics and gynaecology": 0.10, "Radiology": 0.10,
+               "Cardiology": 0.09, "Psychiatry": 0.09, "Emergency department": 0.08, "Neorology": 0.07,
+               "Surgery": 0.06}
+RACES = {"Pacific Islanders": 0.21, "Black": 0.18, "White": 0.17, "Native Americans": 0.16, "Asian": 0.14,
+         "Unknown": 0.14}
+GENDERS = {"Male": 0.36, "Female": 0.35, "Non-binary": 0.29}
+ETHNICITIES = {"Non-Hispanic": 0.29, "Hispanic": 0.27, "Other": 0.23, "Unknown": 0.21}
+INSURANCES = {"Medicare": 0.22, "Blueshield": 0.22, "Not Available": 0.21, "Unknown": 0.21, "Medicaid": 0.14}
+COMPLAINTS = {"chest pain": 0.17, "infection": 0.15, "Unknown": 0.14, "back pain": 0.14, "injury": 0.13,
+              "fatigue": 0.14, "bleeding": 0.13}
+NOTE_TYPES = {"social work note": 0.26, "discharge note": 0.22, "oncology note": 0.18, "progress note": 0.17,
+              "admission note": 0.17}
+ROLES = {"clinician": 0.27, "management": 0.25, "nurse": 0.24, "admin": 0.24}
+
+NOTE_WORDS = ("the patient was admitted with a history of and no fever pain csf leak in the after surgery "
+              "tumour resection drain infection meningitis antibiotics discharged stable follow up mri ct "
+              "scan showed normal lesion spinal fluid chest cough dyspnea treated day weeks later").split()
+VOCABULARY_SIZE = 20000
+
+FIRST_DAY = pd.Timestamp("2000-01-01").toordinal()
+LAST_DAY = pd.Timestamp("2024-12-31").toordinal()
+EPOCH = pd.Timestamp("1970-01-01").toordinal()
+VISITS_PER_PATIENT = 2.5  # mean; a few patients account for many visits
+ID_ALPHABET = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"))
+DATASET_FILES = {"data_file": "Patient_data.csv", "notes_file": "Notes.csv", "credentials_file": "Credentials.csv"}
+
+
+def _pick(rng_or_uniform, categories, n=None):
+    """Draw category values with the shares given in a {value: share} dict."""
+    values = np.array(list(categories))
+    weights = np.array(list(categories.values()), dtype=float)
+    cumulative = np.cumsum(weights / weights.sum())
+    uniform = rng_or_uniform.random(n) if n is not None else rng_or_uniform
+    return values[np.minimum(np.searchsorted(cumulative, uniform), len(values) - 1)]
+
+
+def _patient_uniform(patient_ids, salt):
+    # Deterministic per-patient uniform numbers, so a patient's demographics
+    # agree across visits without keeping a table of every patient
+    h = (patient_ids.astype(np.uint64) * np.uint64(2654435761) + np.uint64(salt * 40503)) % np.uint64(2 ** 32)
+    h = (h ^ (h >> np.uint64(13))) * np.uint64(1274126177) % np.uint64(2 ** 32)
+    return h.astype(np.float64) / 2 ** 32
+
+
+def _visit_days(rng, n):
+    """Visit dates weighted towards recent years, with fewer visits at weekends."""
+    days = FIRST_DAY + ((LAST_DAY - FIRST_DAY) * rng.random(n) ** 0.7).astype(np.int64)
+    weekend = ((days - 1) % 7 >= 5) & (rng.random(n) < 0.5)  # ordinal 1 (0001-01-01) was a Monday
+    # moved back to a weekday of the week before
+    days[weekend] -= (days[weekend] - 1) % 7 - 4 + rng.integers(0, 5, int(weekend.sum()))
+    return pd.to_datetime(days - EPOCH, unit='D')
+
+
+def _note_texts(rng, n, mean_words, vocabulary, weights):
+    # Note lengths vary like the sample notes (log-normal, a long tail of long notes)
+    lengths = np.maximum(rng.lognormal(np.log(mean_words) - 0.3, 0.75, n).astype(np.int64), 5)
+    words = rng.choice(vocabulary, int(lengths.sum()), p=weights)
+    return [" ".join(chunk) for chunk in np.split(words, np.cumsum(lengths)[:-1])]
+
+
+def generate_visits(data_path, visits, notes_path=None, seed=0, note_words=400, chunk_size=1_000_000):
+    """Write Patient_data.csv (and a matching Notes.csv, if notes_path is given) with `visits` rows."""
+    rng = np.random.default_rng(seed)
+    patients = max(int(visits / VISITS_PER_PATIENT), 1)
+    vocabulary = np.array([f"w{i}" for i in range(VOCABULARY_SIZE)], dtype=object)
+    for rank, word in enumerate(NOTE_WORDS):
+        vocabulary[rank * rank] = word  # clinical words spread across the frequency ranks
+    word_weights = 1 / np.arange(1, VOCABULARY_SIZE + 1)
+    word_weights /= word_weights.sum()
+
+    notes_file = open(notes_path, mode='w', newline='', encoding='utf-8') if notes_path else None
+    try:
+        with open(data_path, mode='w', newline='', encoding='utf-8') as csvfile:
+            csvfile.write(",".join(PATIENT_FIELDS) + "\r\n")
+            if notes_file:
+                csv.writer(notes_file).writerow(NOTE_FIELDS)
+            written = 0
+            while written < visits:
+                n = min(chunk_size, visits - written)
+                ids = np.arange(written, written + n) + 100000
+                patient_ids = 10000 + (patients * rng.random(n) ** 2).astype(np.int64)
+                days = _visit_days(rng, n)
+                birth_years = 1920 + (_patient_uniform(patient_ids, 7) * 100).astype(np.int64)
+                frame = pd.DataFrame({
+                    "Patient_ID": patient_ids,
+                    "Visit_ID": ids,
+                    "Visit_time": days.month.astype(str) + "/" + days.day.astype(str) + "/" + days.year.astype(str),
+                    "Visit_department": _pick(rng, DEPARTMENTS, n),
+                    "Race": _pick(_patient_uniform(patient_ids, 1), RACES),
+                    "Gender": _pick(_patient_uniform(patient_ids, 2), GENDERS),
+                    "Ethnicity": _pick(_patient_uniform(patient_ids, 3), ETHNICITIES),
+                    "Age": np.clip(days.year.to_numpy() - birth_years, 0, 112),
+                    "Zip_code": 53000 + (_patient_uniform(patient_ids, 4) * 1000).astype(np.int64),
+                    "Insurance": _pick(_patient_uniform(patient_ids, 5), INSURANCES),
+                    "Chief_complaint": _pick(rng, COMPLAINTS, n),
+                    "Note_ID": ids,
+                    "Note_type": _pick(rng, NOTE_TYPES, n),
+                })
+                frame.to_csv(csvfile, header=False, index=False, lineterminator="\r\n")
+                if notes_file:
+                    pd.DataFrame({
+                        "": np.arange(written, written + n), "Patient_ID": patient_ids, "Visit_ID": ids,
+                        "Note_ID": ids, "Note_text": _note_texts(rng, n, note_words, vocabulary, word_weights),
+                    }).to_csv(notes_file, header=False, index=False, lineterminator="\r\n")
+                written += n
+    finally:
+        if notes_file:
+            notes_file.close()
+    return data_path
+
+
+def _random_ids(rng, n, length=7):
+    return ["".join(chars) for chars in ID_ALPHABET[rng.integers(0, len(ID_ALPHABET), (n, length))]]
+
+
+def generate_credentials(path, users, seed=0, hash_iterations=None):
+    """Write Credentials.csv with `users` accounts; returns them as (username, password, role) tuples.
+
+    Passwords are plaintext unless hash_iterations is given, in which case
+    they are stored as hash_password() strings with that many iterations.
+    """
+    rng = np.random.default_rng(seed)
+    usernames = list(dict.fromkeys(_random_ids(rng, users * 2)))[:users]
+    passwords = _random_ids(rng, len(usernames))
+    roles = _pick(rng, ROLES, len(usernames))
+    accounts = list(zip(usernames, passwords, roles))
+    with open(path, mode='w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["", "username", "password", "role"])
+        for i, (username, password, role) in enumerate(accounts):
+            stored = hash_password(password, hash_iterations) if hash_iterations else password
+            writer.writerow([i, username, stored, role])
+    return accounts
+
+
+def dataset_paths(directory):
+    return {name: os.path.join(directory, file_name) for name, file_name in DATASET_FILES.items()}
+
+
+def generate_dataset(directory, visits, seed=0, users=2000, note_words=400, hash_iterations=None):
+    """Write Patient_data.csv, Notes.csv and Credentials.csv into directory.
+
+    Returns {"data_file", "notes_file", "credentials_file", "accounts"}.
+    The same arguments always produce the same files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = dataset_paths(directory)
+    generate_visits(paths["data_file"], visits, paths["notes_file"], seed, note_words)
+    paths["accounts"] = generate_credentials(paths["credentials_file"], users, seed, hash_iterations)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic hospital data files with the real schema.")
+    parser.add_argument("directory")
+    parser.add_argument("--visits", type=float, default=1e5, help="number of visits, e.g. 1e6")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--note-words", type=int, default=400, help="mean words per note")
+    parser.add_argument("--hash-iterations", type=int, help="store hashed passwords instead of plaintext")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate_dataset(args.directory, int(args.visits), args.seed, args.users, args.note_words, args.hash_iterations)
+    print(f"Generated {int(args.visits):,} visits and {args.users:,} users in {args.directory} "
+          f"in {time.perf_counter() - start:.1f} s")
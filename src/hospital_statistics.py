@@ -1,100 +1,292 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")  # charts are only ever saved to files, never shown
 import matplotlib.pyplot as plt
+from patient_repository import iter_row_chunks, load_tombstones
+from visit_trends import load_rollups, month_range
+from age_groups import AGE_BINS, AGE_LABELS
+from instrumentation import timed
 
-def load_patient_data(file_path):
-    """Load and clean the patient visit data."""
+STAT_COLUMNS = ['Visit_time', 'Gender', 'Race', 'Ethnicity', 'Age', 'Insurance']
+STAT_DTYPES = {
+    'Visit_time': 'category',  # parsed into dates per distinct value, see parse_visit_dates
+    'Gender': 'category',
+    'Race': 'category',
+    'Ethnicity': 'category',
+    'Age': 'float32',
+    'Insurance': 'category',
+}
+CATEGORY_COLUMNS = ['Gender', 'Race', 'Ethnicity', 'Insurance']
+VISIT_DATE_FORMAT = "%m/%d/%Y"
+REPORT_START = pd.Timestamp("2020-01-01")
+
+class StatisticsFrameBuilder:
+    """Collect the report columns from chunks of raw Patient_data.csv rows."""
+    def __init__(self):
+        self.frames = []
+
+    def consume(self, rows):
+        self.frames.append(pd.DataFrame.from_records(rows, columns=STAT_COLUMNS))
+
+    def frame(self):
+        if self.frames:
+            df = pd.concat(self.frames, ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=STAT_COLUMNS)
+        self.frames = []
+        return prepare_frame(df)
+
+def parse_visit_dates(column):
+    """Parse Visit_time strings, converting each distinct date only once."""
+    column = column.astype('category')
+    dates = pd.to_datetime(column.cat.categories, format=VISIT_DATE_FORMAT, errors='coerce')
+    return pd.Series(dates.take(column.cat.codes.to_numpy(), allow_fill=True, fill_value=pd.NaT),
+                     index=column.index)
+
+def prepare_frame(df):
+    """Convert raw string columns and keep visits from 2020 onwards."""
+    df['Age'] = pd.to_numeric(df['Age'], errors='coerce')
+    df['Visit_time'] = parse_visit_dates(df['Visit_time'])
+    df = df[df['Visit_time'] >= REPORT_START]
+
+    if df['Visit_time'].isnull().any():
+        print("⚠️ Warning: Some Visit_time values could not be parsed as dates.")
+    return df
+
+def default_csv_engine():
+    """Use the multithreaded pyarrow CSV parser when it is installed."""
     try:
-        df = pd.read_csv(file_path)
-        df['Visit_time'] = pd.to_datetime(df['Visit_time'], errors='coerce')
-        df = df[df['Visit_time'] >= pd.to_datetime("2020-01-01")]
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "c"
+    return "pyarrow"
+
+def read_statistics_csv(file_path, engine=None, chunksize=None):
+    """Read only the report columns of Patient_data.csv with explicit dtypes.
 
-        if df['Visit_time'].isnull().any():
-            print("⚠️ Warning: Some Visit_time values could not be parsed as dates.")
-        return df
+    With chunksize (C engine only) each chunk is date-filtered before it is
+    kept, which bounds peak memory on very large files.
+    """
+    engine = engine or default_csv_engine()
+    options = dict(usecols=STAT_COLUMNS, dtype=STAT_DTYPES, engine=engine)
+    if not chunksize or engine == "pyarrow":
+        return prepare_frame(pd.read_csv(file_path, **options))
+
+    frames = [prepare_frame(chunk) for chunk in pd.read_csv(file_path, chunksize=chunksize, **options)]
+    if not frames:
+        return prepare_frame(pd.DataFrame(columns=STAT_COLUMNS))
+    df = pd.concat(frames, ignore_index=True)
+    # Chunks can see different category sets, which concat widens to object
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    return df
+
+@timed("statistics.load_patient_data", rows=lambda df: 0 if df is None else len(df))
+def load_patient_data(file_path, chunks=None, engine=None, chunksize=None):
+    """Load and clean the patient visit data.
+
+    A plain CSV is read with pruned columns and fixed dtypes. chunks may
+    supply the rows from another storage backend instead; a CSV with pending
+    tombstones is also streamed row by row so removed patients stay hidden.
+    """
+    if chunks is None:
+        try:
+            if not load_tombstones(file_path):
+                return read_statistics_csv(file_path, engine, chunksize)
+        except FileNotFoundError:
+            print(f"File not found: {file_path}")
+            return None
+        chunks = iter_row_chunks(file_path)
+
+    builder = StatisticsFrameBuilder()
+    try:
+        for chunk in chunks:
+            builder.consume(chunk)
     except FileNotFoundError:
         print(f"File not found: {file_path}")
         return None
+    return builder.frame()
 
-def plot_gender_trends(df):
-    counts = df['Gender'].value_counts().sort_index()
-    plt.figure(figsize=(8, 6))
-    counts.plot(kind='bar', color='skyblue', edgecolor='black')
-    plt.title("Gender Trends", fontsize=14)
-    plt.xlabel("Gender", fontsize=12)
-    plt.ylabel("Number of Visits", fontsize=12)
-    plt.xticks(rotation=30, fontsize=10)
-    plt.yticks(fontsize=10)
-    plt.tight_layout()
-    plt.savefig("gender_trends.png", dpi=300)
-    plt.close()
-    print("✅ Saved: gender_trends.png")
+# -------------------- Aggregation --------------------
 
-def plot_race_trends(df):
-    counts = df['Race'].value_counts().sort_index()
-    plt.figure(figsize=(8, 6))
-    counts.plot(kind='bar', color='skyblue', edgecolor='black')
-    plt.title("Race Trends", fontsize=14)
-    plt.xlabel("Race", fontsize=12)
-    plt.ylabel("Number of Visits", fontsize=12)
-    plt.xticks(rotation=30, fontsize=10)
-    plt.yticks(fontsize=10)
-    plt.tight_layout()
-    plt.savefig("race_trends.png", dpi=300)
-    plt.close()
-    print("✅ Saved: race_trends.png")
+BREAKDOWNS = ['Gender', 'Race', 'Ethnicity', 'AgeGroup', 'Insurance']
 
-def plot_ethnicity_trends(df):
-    counts = df['Ethnicity'].value_counts().sort_index()
-    plt.figure(figsize=(8, 6))
-    counts.plot(kind='bar', color='skyblue', edgecolor='black')
-    plt.title("Ethnicity Trends", fontsize=14)
-    plt.xlabel("Ethnicity", fontsize=12)
-    plt.ylabel("Number of Visits", fontsize=12)
-    plt.xticks(rotation=30, fontsize=10)
-    plt.yticks(fontsize=10)
-    plt.tight_layout()
-    plt.savefig("ethnicity_trends.png", dpi=300)
-    plt.close()
-    print("✅ Saved: ethnicity_trends.png")
+class StatisticsResult:
+    """Visit counts for every demographic breakdown, ready to be rendered."""
+    def __init__(self, joint, breakdowns):
+        self.joint = joint            # visit counts per Gender x Race x Ethnicity x AgeGroup x Insurance
+        self.breakdowns = breakdowns  # breakdown name -> Series of visit counts
+        self.total = int(joint.sum())
+
+    def __getitem__(self, name):
+        return self.breakdowns[name]
+
+@timed("statistics.compute")
+def compute_statistics(df):
+    """Count visits for all breakdowns with a single groupby over categorical columns.
+
+    The raw frame is scanned once to build the joint counts; each breakdown is
+    then a roll-up of that (much smaller) table. df is not modified.
+    """
+    dims = pd.DataFrame({
+        'Gender': df['Gender'].astype('category'),
+        'Race': df['Race'].astype('category'),
+        'Ethnicity': df['Ethnicity'].astype('category'),
+        'AgeGroup': pd.cut(df['Age'], bins=AGE_BINS, labels=AGE_LABELS),
+        'Insurance': df['Insurance'].astype('category'),
+    })
+    joint = dims.groupby(BREAKDOWNS, observed=True, dropna=False).size()
+
+    breakdowns = {}
+    for name in BREAKDOWNS:
+        counts = joint.groupby(level=name, observed=True).sum().sort_index()
+        if name == 'AgeGroup':
+            counts = counts.reindex(AGE_LABELS, fill_value=0)
+        breakdowns[name] = counts
+    return StatisticsResult(joint, breakdowns)
+
+# -------------------- Rendering --------------------
 
-def plot_age_trends(df):
-    df['AgeGroup'] = pd.cut(df['Age'], bins=[0, 18, 35, 50, 65, 100],
-                            labels=["0-18", "19-35", "36-50", "51-65", "66+"])
-    counts = df['AgeGroup'].value_counts().sort_index()
+# (breakdown, chart title, x-axis label, output file)
+CHARTS = [
+    ('Gender', "Gender Trends", "Gender", "gender_trends.png"),
+    ('Race', "Race Trends", "Race", "race_trends.png"),
+    ('Ethnicity', "Ethnicity Trends", "Ethnicity", "ethnicity_trends.png"),
+    ('AgeGroup', "Age Trends", "Age Group", "age_trends.png"),
+    ('Insurance', "Insurance Trends", "Insurance", "insurance_trends.png"),
+]
+
+def plot_breakdown(counts, title, xlabel, filename):
     plt.figure(figsize=(8, 6))
     counts.plot(kind='bar', color='skyblue', edgecolor='black')
-    plt.title("Age Trends", fontsize=14)
-    plt.xlabel("Age Group", fontsize=12)
+    plt.title(title, fontsize=14)
+    plt.xlabel(xlabel, fontsize=12)
     plt.ylabel("Number of Visits", fontsize=12)
     plt.xticks(rotation=30, fontsize=10)
     plt.yticks(fontsize=10)
     plt.tight_layout()
-    plt.savefig("age_trends.png", dpi=300)
+    plt.savefig(filename, dpi=300)
     plt.close()
-    print("✅ Saved: age_trends.png")
+    print(f"✅ Saved: {filename}")
 
-def plot_insurance_trends(df):
-    counts = df['Insurance'].value_counts().sort_index()
-    plt.figure(figsize=(8, 6))
-    counts.plot(kind='bar', color='skyblue', edgecolor='black')
-    plt.title("Insurance Trends", fontsize=14)
-    plt.xlabel("Insurance", fontsize=12)
+MONTHLY_TRENDS_FILE = "monthly_visit_trends.png"
+
+def plot_monthly_trends(counts, filename=MONTHLY_TRENDS_FILE):
+    plt.figure(figsize=(10, 6))
+    counts.plot(kind='line', color='steelblue', marker='o', markersize=3)
+    plt.title("Monthly Visit Trends", fontsize=14)
+    plt.xlabel("Month", fontsize=12)
     plt.ylabel("Number of Visits", fontsize=12)
     plt.xticks(rotation=30, fontsize=10)
     plt.yticks(fontsize=10)
+    plt.grid(alpha=0.3)
     plt.tight_layout()
-    plt.savefig("insurance_trends.png", dpi=300)
+    plt.savefig(filename, dpi=300)
     plt.close()
-    print("✅ Saved: insurance_trends.png")
+    print(f"✅ Saved: {filename}")
+
+CHART_CACHE_FILE = "chart_cache.json"
+
+_render_pool = None
+_background = None
+
+def _render_chart_job(labels, values, title, xlabel, filename):
+    plot_breakdown(pd.Series(values, index=labels), title, xlabel, filename)
+    return filename
+
+def _render_trend_job(labels, values, filename):
+    plot_monthly_trends(pd.Series(values, index=labels), filename)
+    return filename
 
-def generate_statistics(file_path):
-    """Main function to generate all bar chart plots for management reports."""
-    df = load_patient_data(file_path)
+def _get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        # spawn, not fork: the GUI calls this from a worker thread of a Tk process
+        _render_pool = ProcessPoolExecutor(max_workers=min(len(CHARTS) + 1, os.cpu_count() or 1),
+                                           mp_context=multiprocessing.get_context("spawn"))
+    return _render_pool
+
+def _load_chart_cache(cache_file):
+    try:
+        with open(cache_file, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+@timed("statistics.render")
+def render_statistics(result, rollups=None, cache_file=CHART_CACHE_FILE):
+    """Save one bar chart per breakdown of a StatisticsResult, plus the monthly
+    trend line when visit rollups are given.
+
+    Charts are rendered in parallel worker processes. A chart whose counts
+    hash to the same key as last time, and whose file still exists, is not
+    rendered again.
+    """
+    charts = []
+    for name, title, xlabel, filename in CHARTS:
+        counts = result[name]
+        labels = [str(label) for label in counts.index]
+        values = [int(value) for value in counts.values]
+        charts.append((filename, _render_chart_job, (labels, values, title, xlabel, filename)))
+    if rollups is not None:
+        monthly = dict(rollups.series("month"))
+        if monthly:
+            labels = month_range(min(monthly), max(monthly))
+            values = [monthly.get(label, 0) for label in labels]
+            charts.append((MONTHLY_TRENDS_FILE, _render_trend_job, (labels, values, MONTHLY_TRENDS_FILE)))
+
+    cache = _load_chart_cache(cache_file)
+    jobs = []
+    for filename, job, args in charts:
+        key = hashlib.sha256(json.dumps([job.__name__, args]).encode('utf-8')).hexdigest()
+        if cache.get(filename) == key and os.path.exists(filename):
+            print(f"✅ Up to date: {filename}")
+            continue
+        jobs.append((key, job, args))
+
+    if not jobs:
+        return
+    pool = _get_render_pool()
+    futures = [(key, pool.submit(job, *args)) for key, job, args in jobs]
+    for key, future in futures:
+        cache[future.result()] = key
+
+    with open(cache_file, mode='w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=2)
+
+@timed("generate_statistics")
+def generate_statistics(file_path, df=None, chunks=None, rollups=None):
+    """Main function to generate all plots for management reports.
+
+    The monthly trend comes from the incrementally maintained visit rollups;
+    without a rollups argument they are refreshed from file_path.
+    """
+    if df is None:
+        df = load_patient_data(file_path, chunks)
     if df is None:
         return
+    if rollups is None and chunks is None:
+        rollups = load_rollups(file_path)
+
+    render_statistics(compute_statistics(df), rollups)
+
+def generate_statistics_async(file_path, df=None, chunks=None, rollups=None):
+    """Run generate_statistics off the calling thread and return its Future.
+
+    rollups may also be a function returning them, so refreshing them
+    (which can mean rereading the whole data file) happens off the caller's
+    thread too.
+    """
+    global _background
+    if _background is None:
+        _background = ThreadPoolExecutor(max_workers=1)
+
+    def run():
+        return generate_statistics(file_path, df, chunks, rollups() if callable(rollups) else rollups)
 
-    plot_gender_trends(df)
-    plot_race_trends(df)
-    plot_ethnicity_trends(df)
-    plot_age_trends(df)
-    plot_insurance_trends(df)
+    return _background.submit(run)
@@ -0,0 +1,263 @@
+import atexit
+import bisect
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+METRICS_ENV = "HOSPITAL_METRICS"          # metrics file to append to, or "1" for METRICS_FILE; unset disables
+PROFILE_ENV = "HOSPITAL_PROFILE"          # operations to profile, comma separated ("*" for all)
+PROFILE_MODE_ENV = "HOSPITAL_PROFILE_MODE"  # cprofile (default), tracemalloc or both
+METRICS_FILE = "metrics.jsonl"
+PROFILE_DIR = "profiles"
+# Upper bounds of the latency histogram buckets, in milliseconds; the last bucket is open-ended
+BUCKET_BOUNDS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+TRACEMALLOC_TOP = 25  # allocation sites written per tracemalloc capture
+
+
+class OperationStats:
+    """Latency histogram and row count for one named operation."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+
+    def add(self, seconds, rows=0, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.rows += rows
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound (in seconds) of the bucket holding the given fraction of calls."""
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS_MS, self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(bound / 1000, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count, "errors": self.errors, "total_s": self.total, "max_s": self.max,
+            "p50_s": self.percentile(0.5), "p95_s": self.percentile(0.95), "rows": self.rows,
+            "buckets_ms": dict(zip([str(bound) for bound in BUCKET_BOUNDS_MS] + ["inf"], self.buckets)),
+        }
+
+
+class Metrics:
+    """Per-operation timings for this process, appended to a JSON-lines file on close.
+
+    record() is thread-safe, so loader threads and the Tk thread can share
+    one instance. close() (also run at interpreter exit) writes one line
+    holding every operation recorded since the process started.
+    """
+
+    def __init__(self, path=METRICS_FILE, profile=(), profile_mode="cprofile"):
+        self.path = path
+        self.profile = set(profile)
+        self.profile_mode = profile_mode
+        self.operations = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._profiling = False
+        self._closed = False
+        atexit.register(self.close)
+
+    def record(self, name, seconds, rows=0, error=False):
+        with self._lock:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = OperationStats()
+            stats.add(seconds, rows, error)
+
+    def snapshot(self):
+        """{operation: stats dict}, safe to read while other threads record."""
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in sorted(self.operations.items())}
+
+    def report(self):
+        lines = [f"{'operation':<32} {'calls':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'rows':>11}"]
+        for name, stats in self.snapshot().items():
+            lines.append(f"{name:<32} {stats['count']:>7,} {stats['p50_s'] * 1000:>9.1f} "
+                         f"{stats['p95_s'] * 1000:>9.1f} {stats['max_s'] * 1000:>9.1f} {stats['rows']:>11,}")
+        return "\n".join(lines)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        operations = self.snapshot()
+        if not operations:
+            return
+        entry = {"pid": os.getpid(), "started": self.started, "ended": time.time(), "operations": operations}
+        try:
+            with open(self.path, mode='a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"Could not write metrics: {e}")
+
+    # -------------------- Profiling --------------------
+
+    def should_profile(self, name):
+        return ("*" in self.profile or name in self.profile) and not self._profiling
+
+    def profiled(self, name, func, *args, **kwargs):
+        """Run func under cProfile and/or tracemalloc, writing the capture to PROFILE_DIR."""
+        import cProfile
+        import tracemalloc
+
+        self._profiling = True  # one capture at a time; nested operations are only timed
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+        use_cprofile = self.profile_mode in ("cprofile", "both")
+        use_tracemalloc = self.profile_mode in ("tracemalloc", "both") and not tracemalloc.is_tracing()
+        profiler = cProfile.Profile() if use_cprofile else None
+        try:
+            if use_tracemalloc:
+                tracemalloc.start()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    profiler.dump_stats(base + ".prof")
+                if use_tracemalloc:
+                    snapshot = tracemalloc.take_snapshot().filter_traces([
+                        tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, cProfile.__file__),
+                        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+                    current, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    with open(base + ".tracemalloc.txt", mode='w', encoding='utf-8') as f:
+                        f.write(f"peak {peak / 1024:,.0f} KiB, still allocated {current / 1024:,.0f} KiB\n")
+                        for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                            f.write(f"{stat}\n")
+        finally:
+            self._profiling = False
+
+
+def _from_environment():
+    path = os.environ.get(METRICS_ENV, "").strip()
+    if not path or path == "0":
+        return None
+    profile = [name.strip() for name in os.environ.get(PROFILE_ENV, "").split(",") if name.strip()]
+    mode = os.environ.get(PROFILE_MODE_ENV, "cprofile").strip().lower()
+    return Metrics(METRICS_FILE if path == "1" else path, profile, mode)
+
+
+# Read once at import: instrumentation is fixed for the life of the process
+metrics = _from_environment()
+
+
+def enabled():
+    return metrics is not None
+
+
+class _Measurement:
+    __slots__ = ("name", "rows", "started")
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        metrics.record(self.name, time.perf_counter() - self.started, self.rows, exc_type is not None)
+        return False
+
+
+class _NullMeasurement:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass  # `m.rows = n` is a no-op when metrics are off
+
+
+_NULL_MEASUREMENT = _NullMeasurement()
+
+
+def measure(name):
+    """Context manager timing a block; set .rows on it to record rows processed.
+
+    With metrics off this returns a shared do-nothing object.
+    """
+    if metrics is None:
+        return _NULL_MEASUREMENT
+    return _Measurement(name)
+
+
+def timed(name, rows=None):
+    """Decorator recording each call's latency under name.
+
+    rows, if given, is called with the return value and gives the number of
+    rows to record. With metrics off the function is returned unwrapped, so
+    it costs nothing. Operations listed in HOSPITAL_PROFILE are also
+    captured with cProfile/tracemalloc.
+    """
+    def decorate(func):
+        if metrics is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = True
+            try:
+                if metrics.should_profile(name):
+                    result = metrics.profiled(name, func, *args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                count = 0
+                if not error and rows is not None:
+                    count = rows(result)
+                metrics.record(name, time.perf_counter() - started, count, error)
+        return wrapper
+    return decorate
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarise the metrics file written with HOSPITAL_METRICS set.")
+    parser.add_argument("metrics_file", nargs="?", default=METRICS_FILE)
+    parser.add_argument("--last", type=int, help="only the most recent N sessions")
+    args = parser.parse_args()
+
+    totals = Metrics(path=os.devnull)
+    with open(args.metrics_file, encoding='utf-8') as f:
+        sessions = [json.loads(line) for line in f if line.strip()]
+    for session in sessions[-args.last:] if args.last else sessions:
+        for name, stats in session["operations"].items():
+            merged = totals.operations.setdefault(name, OperationStats())
+            merged.count += stats["count"]
+            merged.errors += stats["errors"]
+            merged.total += stats["total_s"]
+            merged.max = max(merged.max, stats["max_s"])
+            merged.rows += stats["rows"]
+            for i, count in enumerate(stats["buckets_ms"].values()):
+                merged.buckets[i] += count
+    print(f"{len(sessions)} sessions in {args.metrics_file}")
+    print(totals.report())
@@ -1,95 +1,83 @@
 import argparse
 from users import authenticate_user
-from patients import Patient, Visit, Note
-from notes import load_notes, get_notes_by_date
-from hospital_statistics import generate_statistics
-import csv
+from patients import Visit, Note
+from notes import get_notes_by_date
+from storage import open_storage
+from cohort import CohortIndex, CATEGORY_CRITERIA, CRITERIA_LABELS, parse_criteria
+from note_search import load_note_index, journal_note, journal_removal
+from usage_log import get_usage_logger
 from datetime import datetime
 import uuid
 
 # -------------------- Data Handling --------------------
 
-def load_patient_data(data_file, notes_dict):
-    patients = {}
+def load_patient_data(storage):
     try:
-        with open(data_file, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                pid = row["Patient_ID"]
-                if pid not in patients:
-                    patients[pid] = Patient(pid)
-
-                visit = Visit(
-                    visit_id=row["Visit_ID"],
-                    visit_time=row["Visit_time"],
-                    department=row["Visit_department"],
-                    gender=row["Gender"],
-                    race=row["Race"],
-                    age=int(row["Age"]),
-                    ethnicity=row["Ethnicity"],
-                    insurance=row["Insurance"],
-                    zip_code=row["Zip_code"],
-                    chief_complaint=row["Chief_complaint"]
-                )
-
-                note_id = row["Note_ID"]
-                note_type = row["Note_type"]
-                note_text = notes_dict[note_id].note_text if note_id in notes_dict else ""
-                note = Note(note_id, note_type, note_text)
-                visit.add_note(note)
-
-                patients[pid].add_visit(visit)
+        storage.load()
     except FileNotFoundError:
-        print(f"Data file {data_file} not found.")
-    return patients
-
-
-def save_visit(data_file, patient_id, visit, note):
-    with open(data_file, mode='a', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            patient_id,
-            visit.visit_id,
-            visit.visit_time,
-            visit.department,
-            visit.gender,
-            visit.race,
-            visit.age,
-            visit.ethnicity,
-            visit.insurance,
-            visit.zip_code,
-            visit.chief_complaint,
-            note.note_id,
-            note.note_type
-        ])
-
-
-def write_all_patients(data_file, patients):
-    with open(data_file, mode='w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            "Patient_ID", "Visit_ID", "Visit_time", "Visit_department",
-            "Gender", "Race", "Age", "Ethnicity", "Insurance",
-            "Zip_code", "Chief_complaint", "Note_ID", "Note_type"
-        ])
-        for patient in patients.values():
-            for visit in patient.visits:
-                for note in visit.notes:
-                    writer.writerow([
-                        patient.patient_id,
-                        visit.visit_id,
-                        visit.visit_time,
-                        visit.department,
-                        visit.gender,
-                        visit.race,
-                        visit.age,
-                        visit.ethnicity,
-                        visit.insurance,
-                        visit.zip_code,
-                        visit.chief_complaint,
-                        note.note_id,
-                        note.note_type
-                    ])
+        print(f"Data file {storage.data_file} not found.")
+
+# -------------------- Cohort Queries --------------------
+
+def run_cohort_queries(storage, show_visits, log_usage):
+    """Index the visits once, then answer cohort queries until the user stops."""
+    print("Indexing visits...")
+    cohort_index = CohortIndex.build(storage.iter_row_chunks())
+    while True:
+        print("\nSeparate alternatives with commas; leave a field blank to match anything.")
+        fields = {criterion: input(f"{label}: ") for criterion, label in CRITERIA_LABELS.items()}
+        try:
+            criteria = parse_criteria(fields)
+        except ValueError as e:
+            print(e)
+            continue
+        breakdown = input(f"Break down by ({', '.join(CATEGORY_CRITERIA)}; blank for department): ").strip()
+        if breakdown not in CATEGORY_CRITERIA:
+            breakdown = "department"
+
+        cohort = cohort_index.select(criteria)
+        visits = cohort.bit_count()
+        print(f"{visits:,} visits by {cohort_index.patient_count(cohort):,} patients")
+        for value, count in cohort_index.breakdown(cohort, breakdown):
+            print(f"  {value or '(blank)':<32} {count:>10,} {count / visits:>7.1%}")
+        if show_visits and visits:
+            for patient_id, visit_id, visit_date in cohort_index.visits(cohort, limit=20):
+                print(f"{visit_date or 'unknown date'}  Patient {patient_id}  Visit {visit_id}")
+            if visits > 20:
+                print("(20 most recent shown)")
+        description = ", ".join(f"{criterion}={text.strip()}" for criterion, text in fields.items() if text.strip())
+        log_usage(f"cohort_query: {description or 'all'}")
+
+        if input("Run another cohort query? (y/n): ").strip().lower() != "y":
+            return
+
+# -------------------- Visit Cube --------------------
+
+def explore_visits(storage, log_usage):
+    """Answer slice, roll-up and cross-tab questions from the visit cube until the user stops."""
+    from data_cube import AXES, MONTH_ROLLUPS, parse_filters  # numpy/pandas are only needed here
+
+    cube = storage.visit_cube()
+    groupings = AXES + list(MONTH_ROLLUPS)
+    print(f"{cube.total():,} visits in the cube. Dimensions: {', '.join(groupings)}")
+    while True:
+        rows = input("Rows (dimension): ").strip()
+        columns = input("Columns (dimension, blank for none): ").strip()
+        print("Separate alternatives with commas; leave a filter blank to include everything.")
+        fields = {dimension: input(f"{'Months (e.g. Q3 2016, 2016-07 to 2016-09)' if dimension == 'Month' else dimension}: ")
+                  for dimension in AXES}
+        try:
+            filters = parse_filters(fields)
+            table = cube.crosstab(rows, columns, filters) if columns else cube.query([rows], filters)
+        except ValueError as e:
+            print(e)
+            continue
+        print(table.to_string())
+        description = ", ".join(f"{dimension}={text.strip()}" for dimension, text in fields.items() if text.strip())
+        log_usage(f"explore_visits: {rows} x {columns or '(none)'}" + (f" where {description}" if description else ""))
+
+        if input("Run another query? (y/n): ").strip().lower() != "y":
+            return
 
 # -------------------- Command-Line Logic --------------------
 
@@ -97,52 +85,68 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-username", required=True)
     parser.add_argument("-password", required=True)
+    parser.add_argument("-cohort", action="store_true", help="run cohort queries instead of generating statistics")
+    parser.add_argument("-explore", action="store_true",
+                        help="slice and cross-tabulate visit counts instead of generating statistics")
     args = parser.parse_args()
 
     credential_file = "Credentials.csv"
     data_file = "Patient_data.csv"
     notes_file = "Notes.csv"
+    logger = get_usage_logger("usage_log.csv")
 
     user = authenticate_user(credential_file, args.username, args.password)
     if not user:
+        logger.log(args.username, "unknown", "LOGIN_FAILED")
         return
+    logger.log(user.username, user.role, "LOGIN_SUCCESS")
 
-    notes_dict = load_notes(notes_file)
-    patients = load_patient_data(data_file, notes_dict)
+    def log_usage(action):
+        logger.log(user.username, user.role, action)
+
+    storage = open_storage(data_file, notes_file)
+
+    if args.cohort and user.can_query_cohorts():
+        run_cohort_queries(storage, show_visits=user.can_access_phi(), log_usage=log_usage)
+        return
+
+    if args.explore and user.can_generate_stats():
+        explore_visits(storage, log_usage)
+        return
 
     if user.can_generate_stats():
-        generate_statistics(data_file)
+        from hospital_statistics import generate_statistics  # pandas/matplotlib are only needed here
+        generate_statistics(data_file, chunks=storage.statistics_chunks(), rollups=storage.visit_rollups())
+        log_usage("generate_statistics")
         return
 
-    elif user.role == "admin":
+    if not user.needs_visit_rows():
         while True:
             date_input = input("Enter date to count visits (YYYY-MM-DD): ")
             try:
                 target_date = datetime.strptime(date_input, "%Y-%m-%d").date()
-                target_str = target_date.strftime("%m/%d/%Y")
                 break
             except ValueError:
                 print("Invalid format. Please enter date as YYYY-MM-DD (e.g., 2019-04-05)")
 
-        count = 0
-        for p in patients.values():
-            for v in p.visits:
-                if v.visit_time.strip() == target_str:
-                    count += 1
-
+        count = storage.visit_rollups().count_on(target_date)
         print(f"Total visits on {target_date.isoformat()}: {count}")
+        log_usage(f"count_visits: {target_date}")
         return
 
+    load_patient_data(storage)
+    note_index = None  # loaded on the first search_notes
+
     while True:
-        action = input("\nEnter action (add_patient, remove_patient, retrieve_patient, count_visits, view_note, Stop): ")
+        load_patient_data(storage)  # picks up only what other sessions appended meanwhile
+        if note_index is not None:
+            note_index.replay_journal()
+        action = input("\nEnter action (add_patient, remove_patient, retrieve_patient, count_visits, view_note, search_notes, cohort, Stop): ")
         if action == "Stop":
             break
 
         if action == "add_patient" and user.can_add_remove():
             pid = input("Enter Patient ID: ")
-            if pid not in patients:
-                patients[pid] = Patient(pid)
-
             visit_id = str(uuid.uuid4().hex[:8])
             visit_input = input("Enter visit date (YYYY-MM-DD): ")
             visit_time = datetime.strptime(visit_input, "%Y-%m-%d").strftime("%m/%d/%Y")
@@ -161,40 +165,45 @@ def main():
             visit = Visit(visit_id, visit_time, dept, gender, race, age, ethnicity, insurance, zip_code, complaint)
             note = Note(note_id, note_type, note_text)
             visit.add_note(note)
-            patients[pid].add_visit(visit)
-            save_visit(data_file, pid, visit, note)
+            storage.add_visit(pid, visit, note)
+            if note_index is not None:
+                note_index.add_note(note_id, pid, visit_time, note_text)
+            else:
+                journal_note(notes_file, note_id, pid, visit_time, note_text)
             print("Visit added.")
+            log_usage(f"add_patient: {pid}")
 
         elif action == "remove_patient" and user.can_add_remove():
             pid = input("Enter Patient ID to remove: ")
-            if pid in patients:
-                del patients[pid]
-                write_all_patients(data_file, patients)
+            if storage.remove_patient(pid):
+                if note_index is not None:
+                    note_index.remove_patient(pid)
+                else:
+                    journal_removal(notes_file, pid)
+                storage.compact()
                 print("Patient removed.")
+                log_usage(f"remove_patient: {pid}")
             else:
                 print("Patient not found.")
+                log_usage(f"remove_patient: {pid} NOT_FOUND")
 
         elif action == "retrieve_patient" and user.can_access_phi():
             pid = input("Enter Patient ID to retrieve: ")
-            if pid in patients:
-                print(patients[pid].get_all_info())
+            patient = storage.get_patient(pid)
+            if patient is not None:
+                print(patient.get_all_info())
+                log_usage(f"retrieve_patient: {pid}")
             else:
                 print("Patient not found.")
+                log_usage(f"retrieve_patient: {pid} NOT_FOUND")
 
         elif action == "count_visits" and user.can_count_visits():
             date = input("Enter date to count visits (YYYY-MM-DD): ")
             try:
                 target_date = datetime.strptime(date, "%Y-%m-%d").date()
-                count = 0
-                for p in patients.values():
-                    for v in p.visits:
-                        try:
-                            visit_date = datetime.strptime(v.visit_time.strip(), "%m/%d/%Y").date()
-                            if visit_date == target_date:
-                                count += 1
-                        except ValueError:
-                            continue 
+                count = storage.count_visits(target_date)
                 print(f"Total visits on {date}: {count}")
+                log_usage(f"count_visits: {target_date}")
             except ValueError:
                 print("Invalid date format.")
 
@@ -203,17 +212,43 @@ def main():
             date = input("Enter date (YYYY-MM-DD): ")
             try:
                 target_str = datetime.strptime(date, "%Y-%m-%d").strftime("%m/%d/%Y")
-                if pid in patients:
-                    notes = get_notes_by_date(patients[pid], target_str)
+                patient = storage.get_patient(pid)
+                if patient is not None:
+                    notes = get_notes_by_date(patient, target_str)
                     if notes:
                         for note in notes:
                             print(note)
                     else:
                         print("No notes found on that date.")
+                    log_usage(f"view_note: {pid}")
                 else:
                     print("Patient not found.")
+                    log_usage(f"view_note: {pid} NOT_FOUND")
+            except ValueError:
+                print("Invalid date format.")
+
+        elif action == "search_notes" and user.can_view_notes():
+            query = input("Enter search terms (words, \"phrase\", OR, -exclude): ")
+            pid = input("Enter Patient ID (blank for all): ").strip() or None
+            try:
+                start_input = input("From date (YYYY-MM-DD, blank for any): ").strip()
+                end_input = input("To date (YYYY-MM-DD, blank for any): ").strip()
+                start = datetime.strptime(start_input, "%Y-%m-%d").date() if start_input else None
+                end = datetime.strptime(end_input, "%Y-%m-%d").date() if end_input else None
             except ValueError:
                 print("Invalid date format.")
+                continue
+            if note_index is None:
+                note_index = load_note_index(notes_file, data_file)
+            matches = [m for m in note_index.search(query, patient_id=pid, start=start, end=end)
+                       if storage.has_patient(m[1])]
+            for note_id, patient_id, visit_date in matches[:20]:
+                print(f"{visit_date or 'unknown date'}  Patient {patient_id}  Note {note_id}")
+            print(f"{len(matches)} matching notes" + (" (20 most recent shown)" if len(matches) > 20 else ""))
+            log_usage(f"search_notes: {query}")
+
+        elif action == "cohort" and user.can_query_cohorts():
+            run_cohort_queries(storage, show_visits=user.can_access_phi(), log_usage=log_usage)
 
         else:
             print("Invalid action or insufficient permission.")
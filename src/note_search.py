@@ -0,0 +1,486 @@
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import date
+from itertools import accumulate
+from patient_repository import file_position, iter_rows_with_offsets, iter_visit_rows, unchanged_until
+from visit_index import visit_ordinal
+from instrumentation import timed
+
+# On-disk layout: MAGIC, version and header length (struct HEADER), a JSON
+# header with the note metadata and term dictionary, then the postings blob,
+# which is memory-mapped and decoded one term at a time. Each term's postings
+# are three arrays back to back: delta-encoded document numbers, positions
+# per document, and the token positions. Each array is stored with the
+# narrowest of uint8/uint16/uint32 that holds its largest value, named by
+# the term's typecodes in the header (e.g. "BBH").
+MAGIC = b"NIDX"
+VERSION = 2
+HEADER = struct.Struct("<4sIQ")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+QUERY_PATTERN = re.compile(r'(-?)"([^"]*)"|(\S+)')
+MERGE_THRESHOLD = 1000  # journal entries replayed on load before the index file is rewritten
+
+
+def tokenize(text):
+    """Lower-case alphanumeric tokens, e.g. "CSF-leak at D10" -> ["csf", "leak", "at", "d10"]."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def index_file(notes_file):
+    root, _ = os.path.splitext(notes_file)
+    return f"{root}_index.bin"
+
+
+def journal_file(notes_file):
+    root, _ = os.path.splitext(notes_file)
+    return f"{root}_index_journal.jsonl"
+
+
+def _append_journal(notes_file, entry):
+    with open(journal_file(notes_file), mode='a', encoding='utf-8') as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def _file_position(path, offset):
+    """file_position() in a JSON-friendly form."""
+    inode, offset, tail = file_position(path, offset)
+    return [inode, offset, tail.hex()]
+
+
+def _unchanged_until(path, source):
+    return source is not None and unchanged_until(path, (source[0], source[1], bytes.fromhex(source[2])))
+
+
+def _visit_dates(data_file, note_ids=None):
+    """{Note_ID: Visit_time} from Patient_data.csv, for all notes or just note_ids."""
+    if data_file is None:
+        return {}
+    dates = {}
+    try:
+        for row in iter_visit_rows(data_file):
+            if note_ids is None or row["Note_ID"] in note_ids:
+                dates[row["Note_ID"]] = row["Visit_time"]
+    except FileNotFoundError:
+        pass
+    return dates
+
+
+def _pack(values):
+    """(typecode, bytes) of values in the narrowest unsigned array type that holds them."""
+    top = max(values, default=0)
+    typecode = "B" if top < 1 << 8 else "H" if top < 1 << 16 else "I"
+    packed = values if typecode == "I" and isinstance(values, array) else array(typecode, values)
+    return typecode, packed.tobytes()
+
+
+def _unpack(blob, offset, count, typecode):
+    """Decode count values stored at offset as a uint32 array; returns (array, offset past them)."""
+    values = array(typecode)
+    end = offset + count * values.itemsize
+    values.frombytes(blob[offset:end])
+    return (values if typecode == "I" else array("I", values)), end
+
+
+def _packed_size(doc_count, position_count, typecodes):
+    widths = [array(typecode).itemsize for typecode in typecodes]
+    return doc_count * (widths[0] + widths[1]) + position_count * widths[2]
+
+
+def journal_note(notes_file, note_id, patient_id, visit_time, text):
+    """Record a note added after Notes.csv was indexed; replayed whenever the index is loaded."""
+    _append_journal(notes_file, {"add": [note_id, patient_id, visit_time, text]})
+
+
+def journal_removal(notes_file, patient_id):
+    """Record that a patient's notes must no longer be returned by searches."""
+    _append_journal(notes_file, {"remove": patient_id})
+
+
+def parse_query(query):
+    """Split a query into OR groups of (negated, tokens) clauses.
+
+    Words are ANDed together, "quoted words" form a phrase, a leading - or
+    NOT excludes a word or phrase, and OR separates alternatives:
+    'csf leak OR "spinal fluid" -infection'.
+    """
+    groups = [[]]
+    negate = False
+    for match in QUERY_PATTERN.finditer(query):
+        phrase_negated, phrase, word = match.groups()
+        if word == "OR":
+            groups.append([])
+            continue
+        if word == "AND":
+            continue
+        if word == "NOT":
+            negate = True
+            continue
+        if phrase is not None:
+            clause_negated, tokens = bool(phrase_negated), tokenize(phrase)
+        elif word.startswith("-") and len(word) > 1:
+            clause_negated, tokens = True, tokenize(word[1:])
+        else:
+            clause_negated, tokens = False, tokenize(word)
+        if tokens:
+            groups[-1].append((clause_negated or negate, tokens))
+        negate = False
+    return [group for group in groups if group]
+
+
+class _Postings:
+    __slots__ = ("docs", "counts", "positions", "starts")
+
+    def __init__(self, docs=None, counts=None, positions=None):
+        self.docs = docs if docs is not None else array("I")        # sorted document numbers
+        self.counts = counts if counts is not None else array("I")  # positions per document
+        self.positions = positions if positions is not None else array("I")
+        self.starts = None  # lazily computed offsets of each document's positions
+
+    def positions_of(self, doc):
+        i = bisect_left(self.docs, doc)
+        if i == len(self.docs) or self.docs[i] != doc:
+            return ()
+        if self.starts is None:
+            self.starts = list(accumulate(self.counts, initial=0))
+        return self.positions[self.starts[i]:self.starts[i + 1]]
+
+    def to_bytes(self):
+        """(typecodes, bytes) of the delta-encoded documents, the counts and the positions."""
+        deltas = array("I", [self.docs[0]] if self.docs else [])
+        deltas.extend(b - a for a, b in zip(self.docs, self.docs[1:]))
+        packed = [_pack(deltas), _pack(self.counts), _pack(self.positions)]
+        return "".join(typecode for typecode, _ in packed), b"".join(data for _, data in packed)
+
+    @classmethod
+    def from_bytes(cls, blob, offset, doc_count, position_count, typecodes):
+        deltas, offset = _unpack(blob, offset, doc_count, typecodes[0])
+        counts, offset = _unpack(blob, offset, doc_count, typecodes[1])
+        positions, _ = _unpack(blob, offset, position_count, typecodes[2])
+        return cls(array("I", accumulate(deltas)), counts, positions)
+
+
+class NoteSearchIndex:
+    """Inverted index from note tokens to the notes (and positions) containing them.
+
+    Postings are packed into narrow integer arrays in the index file, which
+    is mapped rather than read, and a term's are only decoded when a query
+    first touches it. Notes appended to Notes.csv since the file was written
+    are indexed on load, and notes added or patients removed through the
+    index are kept in a journal next to it and replayed.
+    """
+
+    def __init__(self, notes_file, data_file=None):
+        self.notes_file = notes_file
+        self.data_file = data_file  # where appended notes are dated
+        self.note_ids = []
+        self.patients = []
+        self.dates = array("i")  # visit date ordinal per document, 0 if unknown
+        self.deleted = set()
+        self.postings = {}
+        self.source = None  # [inode, offset, tail] of Notes.csv, indexed up to offset
+        self.journal_offset = 0
+        self._stored = {}  # term -> (offset, docs, positions, typecodes) in _blob, not yet decoded
+        self._blob = b""
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.note_ids) - len(self.deleted)
+
+    # -------------------- Building --------------------
+
+    def _add_documents(self, documents):
+        """Index (note_id, patient_id, visit_time, text) notes.
+
+        Each token occurrence is appended straight onto its term's arrays, so
+        indexing creates no per-note containers for the garbage collector.
+        """
+        for note_id, patient_id, visit_time, text in documents:
+            doc = len(self.note_ids)
+            self.note_ids.append(note_id)
+            self.patients.append(patient_id)
+            self.dates.append(visit_ordinal(visit_time))
+            for position, token in enumerate(tokenize(text)):
+                postings = self.postings.get(token)
+                if postings is None:
+                    postings = self._term(token)
+                    if postings is None:
+                        postings = self.postings[token] = _Postings()
+                docs = postings.docs
+                if docs and docs[-1] == doc:
+                    postings.counts[-1] += 1
+                else:
+                    docs.append(doc)
+                    postings.counts.append(1)
+                    postings.starts = None
+                postings.positions.append(position)
+
+    def _remove_patient(self, patient_id):
+        self.deleted.update(doc for doc, pid in enumerate(self.patients) if pid == patient_id)
+
+    @classmethod
+    def build(cls, notes_file, data_file):
+        """Index every note in Notes.csv, dating each by its visit in Patient_data.csv."""
+        index = cls(notes_file, data_file)
+        visit_dates = _visit_dates(data_file)
+        end = 0
+
+        def documents():
+            nonlocal end
+            for _, end, row in iter_rows_with_offsets(notes_file):
+                yield row["Note_ID"], row["Patient_ID"], visit_dates.get(row["Note_ID"], ""), row["Note_text"]
+
+        try:
+            index._add_documents(documents())
+            index.source = _file_position(notes_file, end)
+        except FileNotFoundError:
+            print(f" Note file {notes_file} not found.")
+        return index
+
+    def _read_appended(self, visit_dates=None):
+        """Index the notes appended to Notes.csv since it was last read; returns how many.
+
+        Does nothing if the file was rewritten or replaced; only a rebuild
+        can catch up then. visit_dates ({Note_ID: Visit_time}) saves looking
+        up notes whose visits are already known in Patient_data.csv.
+        """
+        if not _unchanged_until(self.notes_file, self.source):
+            return 0
+        rows, end = [], self.source[1]
+        for _, end, row in iter_rows_with_offsets(self.notes_file, end):
+            rows.append((row["Note_ID"], row["Patient_ID"], row["Note_text"]))
+        if not rows:
+            return 0
+        visit_dates = dict(visit_dates or {})
+        missing = {note_id for note_id, _, _ in rows if note_id not in visit_dates}
+        if missing:
+            visit_dates.update(_visit_dates(self.data_file, missing))
+        self._add_documents((note_id, patient_id, visit_dates.get(note_id, ""), text)
+                            for note_id, patient_id, text in rows)
+        self.source = _file_position(self.notes_file, end)
+        return len(rows)
+
+    # -------------------- Incremental updates --------------------
+
+    def _journal(self, entries):
+        """Append entries to the journal, first catching up on other sessions' entries.
+
+        The offset then moves past our own, so replay_journal never applies them twice.
+        """
+        self._replay()
+        with open(journal_file(self.notes_file), mode='ab') as f:
+            f.writelines((json.dumps(entry) + "\n").encode("utf-8") for entry in entries)
+            self.journal_offset = f.tell()
+
+    def add_note(self, note_id, patient_id, visit_time, text):
+        """Index a newly written note and journal it so the next load sees it too."""
+        with self._lock:
+            self._journal([{"add": [note_id, patient_id, visit_time, text]}])
+            self._add_documents([(note_id, patient_id, visit_time, text)])
+
+    def add_notes(self, notes, appended=False):
+        """Index a batch of (note_id, patient_id, visit_time, text) notes.
+
+        appended=True means the notes were written to Notes.csv itself: they
+        are not journaled but read back from the file, along with anything
+        else appended to it since it was last read.
+        """
+        with self._lock:
+            if appended:
+                self._read_appended({note_id: visit_time for note_id, _, visit_time, _ in notes})
+            else:
+                self._journal([{"add": list(note)} for note in notes])
+                self._add_documents(notes)
+
+    def remove_patient(self, patient_id):
+        with self._lock:
+            self._journal([{"remove": patient_id}])
+            self._remove_patient(patient_id)
+
+    def replay_journal(self):
+        """Index notes appended to Notes.csv and apply journal entries written since they were last read.
+
+        Returns how many notes and entries were applied. Sessions sharing the
+        notes file see each other's additions and removals this way.
+        """
+        with self._lock:
+            return self._read_appended() + self._replay()
+
+    def _replay(self):
+        replayed = 0
+        added = []  # consecutive additions, indexed together before the next removal
+        try:
+            with open(journal_file(self.notes_file), mode='rb') as f:
+                f.seek(self.journal_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # torn write
+                    self.journal_offset += len(line)
+                    entry = json.loads(line)
+                    if "add" in entry:
+                        added.append(entry["add"])
+                    else:
+                        self._add_documents(added)
+                        added = []
+                        self._remove_patient(entry["remove"])
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        self._add_documents(added)
+        return replayed
+
+    # -------------------- Queries --------------------
+
+    def _term(self, token):
+        postings = self.postings.get(token)
+        if postings is None and token in self._stored:
+            postings = self.postings[token] = _Postings.from_bytes(self._blob, *self._stored.pop(token))
+            if not self._stored:
+                self._blob = b""  # every term is decoded; let go of the mapping
+        return postings
+
+    def _clause_docs(self, tokens):
+        postings = [self._term(token) for token in tokens]
+        if any(p is None for p in postings):
+            return set()
+        docs = set(min(postings, key=lambda p: len(p.docs)).docs)
+        for p in postings:
+            docs.intersection_update(p.docs)
+        if len(tokens) == 1:
+            return docs
+        # Phrase: every later token must follow the first at the matching offset
+        matches = set()
+        for doc in docs:
+            starts = set(postings[0].positions_of(doc))
+            for offset, p in enumerate(postings[1:], 1):
+                starts.intersection_update(position - offset for position in p.positions_of(doc))
+                if not starts:
+                    break
+            if starts:
+                matches.add(doc)
+        return matches
+
+    @timed("note_search.search", rows=len)
+    def search(self, query, patient_id=None, start=None, end=None, limit=None):
+        """Return [(Note_ID, Patient_ID, visit date or None)] matching query, newest first.
+
+        patient_id restricts the results to one patient and start/end (dates,
+        inclusive) to visits in that range.
+        """
+        with self._lock:
+            matches = set()
+            for group in parse_query(query):
+                included = [tokens for negated, tokens in group if not negated]
+                if not included:
+                    continue  # a group of exclusions alone would match everything
+                docs = self._clause_docs(included[0])
+                for tokens in included[1:]:
+                    if not docs:
+                        break
+                    docs &= self._clause_docs(tokens)
+                for negated, tokens in group:
+                    if negated and docs:
+                        docs -= self._clause_docs(tokens)
+                matches |= docs
+            matches -= self.deleted
+
+            if patient_id is not None:
+                matches = [doc for doc in matches if self.patients[doc] == patient_id]
+            if start or end:
+                first = start.toordinal() if start else 1
+                last = end.toordinal() if end else date.max.toordinal()
+                matches = [doc for doc in matches if first <= self.dates[doc] <= last]
+            # Newest visit first, ties broken by the most recently indexed note
+            results = sorted(matches, reverse=True)
+            results.sort(key=self.dates.__getitem__, reverse=True)
+            if limit is not None:
+                results = results[:limit]
+            return [(self.note_ids[doc], self.patients[doc], self._date(doc)) for doc in results]
+
+    def _date(self, doc):
+        return date.fromordinal(self.dates[doc]) if self.dates[doc] else None
+
+    # -------------------- Persistence --------------------
+
+    def save(self, path=None):
+        """Write the index atomically; the journal is kept but marked as merged."""
+        path = path or index_file(self.notes_file)
+        with self._lock:
+            terms, chunks, offset = {}, [], 0
+            for token, postings in self.postings.items():
+                typecodes, data = postings.to_bytes()
+                terms[token] = [offset, len(postings.docs), len(postings.positions), typecodes]
+                chunks.append(data)
+                offset += len(data)
+            for token, (stored_offset, doc_count, position_count, typecodes) in self._stored.items():
+                size = _packed_size(doc_count, position_count, typecodes)
+                terms[token] = [offset, doc_count, position_count, typecodes]
+                chunks.append(self._blob[stored_offset:stored_offset + size])
+                offset += size
+            header = json.dumps({
+                "source": self.source, "journal_offset": self.journal_offset,
+                "note_ids": self.note_ids, "patients": self.patients, "dates": self.dates.tolist(),
+                "deleted": sorted(self.deleted), "terms": terms,
+            }).encode("utf-8")
+
+            temp_path = path + ".tmp"
+            try:
+                with open(temp_path, mode='wb') as f:
+                    f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+                    f.write(header)
+                    for chunk in chunks:
+                        f.write(chunk)
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f"Could not write note index {path}: {e}")  # e.g. still mapped by another process on Windows
+
+    @classmethod
+    def load(cls, notes_file, path=None, data_file=None):
+        """Map a saved index, or return None if it is missing, damaged or from another version."""
+        path = path or index_file(notes_file)
+        try:
+            with open(path, mode='rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError, OSError):
+            return None  # ValueError: empty file
+        try:
+            magic, version, header_size = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or version != VERSION:
+                return None
+            header = json.loads(mm[HEADER.size:HEADER.size + header_size])
+        except (struct.error, ValueError):
+            return None
+
+        index = cls(notes_file, data_file)
+        index.source = header["source"]
+        index.journal_offset = header["journal_offset"]
+        index.note_ids = header["note_ids"]
+        index.patients = header["patients"]
+        index.dates = array("i", header["dates"])
+        index.deleted = set(header["deleted"])
+        index._stored = {token: tuple(entry) for token, entry in header["terms"].items()}
+        index._blob = memoryview(mm)[HEADER.size + header_size:]
+        return index
+
+
+@timed("load_note_index", rows=len)
+def load_note_index(notes_file, data_file):
+    """Return the search index for notes_file.
+
+    Notes appended to Notes.csv since the index was saved are indexed on
+    top of it; it is only rebuilt if the file was rewritten or replaced.
+    """
+    index = NoteSearchIndex.load(notes_file, data_file=data_file)
+    journal_size = os.path.getsize(journal_file(notes_file)) if os.path.exists(journal_file(notes_file)) else 0
+    if index is None or not _unchanged_until(notes_file, index.source) or journal_size < index.journal_offset:
+        index = NoteSearchIndex.build(notes_file, data_file)
+        index.replay_journal()
+        index.save()
+    elif index.replay_journal() >= MERGE_THRESHOLD:
+        index.save()
+    return index
@@ -1,21 +1,163 @@
 import csv
+import io
+import mmap
+import os
+import threading
 from patients import Note
+from instrumentation import measure
+from snapshot import REFRESH_ROWS, load_note_offsets, save_note_offsets
+
+
+class NoteStore:
+    """Read-only view of Notes.csv backed by a memory-mapped file.
+
+    Only an index from Note_ID to the byte range of its CSV record is kept in
+    memory; note text is decoded from the mapping each time it is requested.
+    The index itself is built on first use, so sessions that never read a
+    note never scan the file. It is saved as a snapshot (see snapshot.py),
+    so later sessions only scan records appended since.
+    """
+
+    def __init__(self, note_file_path):
+        self.path = note_file_path
+        self.offsets = None
+        self._mmap = None
+        self._file = None
+        self._text_column = None
+        self._id_column = None
+        self._indexed_end = 0  # byte offset up to which complete records are indexed
+        self._lock = threading.Lock()
+
+    def build_index(self):
+        """Build the index now, e.g. from a background thread, instead of on first use."""
+        self._ensure_index()
+
+    def _ensure_index(self):
+        if self.offsets is not None:
+            return
+        with self._lock:
+            if self.offsets is None:
+                self._build_index()
+
+    def _build_index(self):
+        offsets = {}
+        try:
+            self._file = open(self.path, 'rb')
+        except FileNotFoundError:
+            print(f" Note file {self.path} not found.")
+            self.offsets = offsets
+            return
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self.offsets = offsets
+            return
+
+        mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = next(csv.reader([mm.readline().decode('utf-8-sig')]))
+        self._id_column = header.index("Note_ID")
+        self._text_column = header.index("Note_text")
+        start = mm.tell()
+        restored = load_note_offsets(self.path)
+        if restored is not None:
+            offsets, start = restored
+        with measure("load_notes") as m:
+            before = len(offsets)
+            self._scan(mm, start, offsets)
+            m.rows = scanned = len(offsets) - before
+        if restored is None or scanned >= REFRESH_ROWS:
+            save_note_offsets(self.path, offsets, self._indexed_end)
+        self._mmap = mm
+        self.offsets = offsets
+
+    def _scan(self, mm, start, offsets):
+        # A record ends at the first line break outside quotes, i.e. once the
+        # running count of quote characters is even.
+        mm.seek(start)
+        quotes = 0
+        while True:
+            line = mm.readline()
+            if not line:
+                break
+            quotes += line.count(b'"')
+            if quotes % 2:
+                continue
+            end = mm.tell()
+            note_id = self._record_note_id(mm[start:end], self._id_column)
+            if note_id:
+                offsets[note_id] = (start, end)
+            start = end
+            quotes = 0
+        self._indexed_end = start
+
+    def refresh(self):
+        """Index records appended to the file since the index was built."""
+        with self._lock:
+            if self.offsets is None:
+                return  # not built yet; the first lookup will see the whole file
+            if self._mmap is None:
+                # The file was missing or empty; index it afresh on next use
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self.offsets = None
+                return
+            if os.fstat(self._file.fileno()).st_size <= self._indexed_end:
+                return
+            # Readers may still hold the old mapping; it closes once they drop it
+            mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmap = mm
+            with measure("notes.refresh") as m:
+                before = len(self.offsets)
+                self._scan(mm, self._indexed_end, self.offsets)
+                m.rows = len(self.offsets) - before
+
+    @staticmethod
+    def _record_note_id(record, id_column):
+        prefix = record.split(b',', id_column + 1)
+        if len(prefix) > id_column and b'"' not in b','.join(prefix[:id_column + 1]):
+            return prefix[id_column].strip().decode('utf-8')
+        row = next(csv.reader(io.StringIO(record.decode('utf-8'))), [])
+        return row[id_column] if len(row) > id_column else None
+
+    def get_text(self, note_id):
+        """Return the text of a note, or "" if the note is unknown."""
+        self._ensure_index()
+        span = self.offsets.get(note_id)
+        if span is None:
+            return ""
+        start, end = span
+        row = next(csv.reader(io.StringIO(self._mmap[start:end].decode('utf-8'))))
+        return row[self._text_column]
+
+    def __contains__(self, note_id):
+        self._ensure_index()
+        return note_id in self.offsets
+
+    def __getitem__(self, note_id):
+        if note_id not in self:
+            raise KeyError(note_id)
+        return Note(note_id, "Unknown", store=self)  # Note_type is missing from Notes.csv
+
+    def __len__(self):
+        self._ensure_index()
+        return len(self.offsets)
+
+    def __iter__(self):
+        self._ensure_index()
+        return iter(self.offsets)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.offsets = None
 
 
 def load_notes(note_file_path):
-    """Load clinical notes into a dictionary keyed by Note_ID."""
-    notes = {}
-    try:
-        with open(note_file_path, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                note_id = row["Note_ID"]
-                note_text = row["Note_text"]
-                note_type = "Unknown"  # fallback since Note_type is missing
-                notes[note_id] = Note(note_id, note_type, note_text)
-    except FileNotFoundError:
-        print(f" Note file {note_file_path} not found.")
-    return notes
+    """Open the clinical notes as a lazily indexed store keyed by Note_ID."""
+    return NoteStore(note_file_path)
 
 
 from datetime import datetime
@@ -25,13 +167,8 @@ def get_notes_by_date(patient, date_str):
     matching_notes = []
     target_date = datetime.strptime(date_str, "%m/%d/%Y").date()
 
-    for visit in patient.visits:
-        try:
-            visit_date = datetime.strptime(visit.visit_time.strip(), "%m/%d/%Y").date()
-            if visit_date == target_date:
-                matching_notes.extend(visit.notes)
-        except ValueError:
-            continue  # skip invalid dates silently
+    for visit in patient.visits_on(target_date):
+        matching_notes.extend(visit.notes)
 
     return matching_notes
 
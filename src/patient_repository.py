@@ -0,0 +1,412 @@
+import csv
+import io
+import os
+import tempfile
+import threading
+from itertools import islice
+from patients import Patient, Visit, Note
+from instrumentation import timed
+
+PATIENT_FIELDS = [
+    "Patient_ID", "Visit_ID", "Visit_time", "Visit_department",
+    "Race", "Gender", "Ethnicity", "Age", "Zip_code",
+    "Insurance", "Chief_complaint", "Note_ID", "Note_type"
+]
+
+NOTE_FIELDS = ["", "Patient_ID", "Visit_ID", "Note_ID", "Note_text"]  # Notes.csv, with its unnamed index column
+
+CHUNK_SIZE = 50000
+TAIL_CHECK_BYTES = 4096  # bytes before a read position compared to tell an append from a rewrite
+
+
+# -------------------- Reading --------------------
+
+def iter_visit_rows(data_file):
+    """Yield live Patient_data.csv rows one at a time as dictionaries.
+
+    Rows hidden by a tombstone (see remove_patient) and a torn final row left
+    by an interrupted append are skipped: like iter_rows_with_offsets, a
+    final line without a line break is never read.
+    """
+    tombstones = load_tombstones(data_file)
+    if not tombstones:
+        with open(data_file, newline='', encoding='utf-8') as csvfile:
+            reader = csv.DictReader(_complete_lines(csvfile))
+            for row in reader:
+                if row.get(reader.fieldnames[-1]) is not None:
+                    yield row
+        return
+
+    for start, end, row in iter_rows_with_offsets(data_file):
+        if start < tombstones.get(row["Patient_ID"], -1):
+            continue
+        yield row
+
+
+def _complete_lines(textfile):
+    """The lines of a file up to, not including, a final one without a line break."""
+    for line in textfile:
+        if not line.endswith('\n'):
+            return
+        yield line
+
+
+def iter_rows_with_offsets(data_file, offset=0):
+    """Yield (start, end, row) for each complete row, with byte offsets into the file.
+
+    Reading begins at offset, which must be a row boundary previously returned
+    as an end (0 reads the whole file). A final row without a line break is
+    not yielded, since its append may still be in progress. This is slower
+    than a plain DictReader and only used when offsets are needed.
+    """
+    with open(data_file, 'rb') as binfile:
+        header = binfile.readline()
+        if not header:
+            return
+        fieldnames = next(csv.reader([header.decode('utf-8-sig')]))
+        position = max(offset, len(header))
+        binfile.seek(position)
+
+        def lines():
+            nonlocal position
+            for line in binfile:
+                if not line.endswith(b'\n'):
+                    return
+                position += len(line)
+                yield line.decode('utf-8')
+
+        reader = csv.DictReader(lines(), fieldnames=fieldnames)
+        while True:
+            start = position
+            row = next(reader, None)
+            if row is None:
+                return
+            if row.get(fieldnames[-1]) is not None:
+                yield start, position, row
+
+
+def iter_patient_rows(data_file, patient_ids, end):
+    """Yield (start, row) for the rows of the given patients that start before byte offset end.
+
+    Lines are matched on their leading Patient_ID before any CSV parsing,
+    so only the matching rows are parsed. This relies on rows being one
+    line each, as the app writes them.
+    """
+    prefixes = tuple(f"{patient_id},".encode('utf-8') for patient_id in patient_ids)
+    if not prefixes:
+        return
+    with open(data_file, 'rb') as binfile:
+        header = binfile.readline()
+        fieldnames = next(csv.reader([header.decode('utf-8-sig')]), [])
+        position = len(header)
+        for line in binfile:
+            if position >= end:
+                return
+            start, position = position, position + len(line)
+            if line.startswith(prefixes) and line.endswith(b'\n'):
+                row = dict(zip(fieldnames, next(csv.reader([line.decode('utf-8')]))))
+                if row.get("Patient_ID") in patient_ids:
+                    yield start, row
+
+
+def iter_row_chunks(data_file, chunk_size=CHUNK_SIZE):
+    """Yield lists of at most chunk_size rows so callers never hold the whole file."""
+    rows = iter_visit_rows(data_file)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def file_signature(data_file):
+    """Return the size and mtime of a data file and its tombstones, or None if it does not exist."""
+    try:
+        stat = os.stat(data_file)
+    except FileNotFoundError:
+        return None
+    try:
+        tomb_stat = os.stat(tombstone_file(data_file))
+        tombs = (tomb_stat.st_size, tomb_stat.st_mtime_ns)
+    except FileNotFoundError:
+        tombs = None
+    return stat.st_size, stat.st_mtime_ns, tombs
+
+
+def build_visit(row, note_store):
+    """Build the Visit (with its Note attached) described by one CSV row."""
+    visit = Visit(
+        visit_id=row["Visit_ID"],
+        visit_time=row["Visit_time"],
+        department=row["Visit_department"],
+        gender=row["Gender"],
+        race=row["Race"],
+        age=int(row["Age"]),
+        ethnicity=row["Ethnicity"],
+        insurance=row["Insurance"],
+        zip_code=row["Zip_code"],
+        chief_complaint=row["Chief_complaint"]
+    )
+
+    # The text stays in the note store until something reads note.note_text
+    visit.add_note(Note(row["Note_ID"], row["Note_type"], store=note_store))
+    return visit
+
+
+@timed("load_patient_data", rows=lambda patients: sum(len(patient.visits) for patient in patients.values()))
+def load_patient_data(data_file, note_store, date_index=None, sinks=(), progress=None):
+    """Build the Patient/Visit/Note graph in a single streaming pass.
+
+    Every chunk of raw rows is also handed to each sink's consume() method,
+    so other consumers (e.g. the statistics frame) are fed from the same pass.
+    progress, if given, is called with the number of rows read after each chunk.
+    Raises FileNotFoundError if the data file is missing.
+    """
+    patients = {}
+    rows_read = 0
+    for chunk in iter_row_chunks(data_file):
+        for row in chunk:
+            pid = row["Patient_ID"]
+            if pid not in patients:
+                patients[pid] = Patient(pid)
+
+            visit = build_visit(row, note_store)
+            patients[pid].add_visit(visit)
+            if date_index is not None:
+                date_index.add(visit.visit_time)
+
+        for sink in sinks:
+            sink.consume(chunk)
+        rows_read += len(chunk)
+        if progress is not None:
+            progress(rows_read)
+    return patients
+
+
+# -------------------- Following Appends --------------------
+
+def tail_bytes(path, offset, length=TAIL_CHECK_BYTES):
+    """The (up to) length bytes of a file just before offset."""
+    with open(path, 'rb') as binfile:
+        binfile.seek(max(offset - length, 0))
+        return binfile.read(min(offset, length))
+
+
+def file_position(data_file, offset):
+    """(inode, offset, bytes before offset): enough to tell later whether data_file was only appended to."""
+    return os.stat(data_file).st_ino, offset, tail_bytes(data_file, offset)
+
+
+def unchanged_until(data_file, position):
+    """True if data_file still has the same identity and bytes up to position's offset; it may have grown."""
+    inode, offset, tail = position
+    try:
+        stat = os.stat(data_file)
+    except FileNotFoundError:
+        return False
+    return stat.st_ino == inode and stat.st_size >= offset and tail_bytes(data_file, offset) == tail
+
+
+def add_appended_rows(data_file, offset, patients, note_store, date_index, tombstones, skip_visits=()):
+    """Add the rows after byte offset to patients and date_index.
+
+    Rows hidden by tombstones ({Patient_ID: offset}) are left out, as are
+    rows whose Visit_ID is in skip_visits (which are removed from it as they
+    are seen). Returns (rows added, offset just past the last complete row).
+    """
+    added = 0
+    for start, offset, row in iter_rows_with_offsets(data_file, offset):
+        patient_id = row["Patient_ID"]
+        if start < tombstones.get(patient_id, -1):
+            continue
+        if row["Visit_ID"] in skip_visits:
+            skip_visits.discard(row["Visit_ID"])
+            continue
+        visit = build_visit(row, note_store)
+        patient = patients.get(patient_id)
+        if patient is None:
+            patient = patients[patient_id] = Patient(patient_id)
+        patient.add_visit(visit)
+        date_index.add(visit.visit_time)
+        added += 1
+    return added, offset
+
+
+# -------------------- Writing --------------------
+
+def visit_row(patient_id, visit, note):
+    """Return a CSV row for one visit/note pair in PATIENT_FIELDS order."""
+    return [
+        patient_id,
+        visit.visit_id,
+        visit.visit_time,
+        visit.department,
+        visit.race,
+        visit.gender,
+        visit.ethnicity,
+        visit.age,
+        visit.zip_code,
+        visit.insurance,
+        visit.chief_complaint,
+        note.note_id,
+        note.note_type
+    ]
+
+
+def _append_rows(path, rows, header=None):
+    """Append CSV rows and fsync them, starting on a fresh line if a previous write was torn.
+
+    header is written first if the file is new or empty.
+    """
+    with open(path, mode='a+b') as binfile:
+        if binfile.tell() > 0:
+            binfile.seek(-1, os.SEEK_END)
+            if binfile.read(1) != b'\n':
+                binfile.write(b'\r\n')
+        elif header is not None:
+            rows = [header] + list(rows)
+        text = io.StringIO(newline='')
+        csv.writer(text).writerows(rows)
+        binfile.write(text.getvalue().encode('utf-8'))
+        binfile.flush()
+        os.fsync(binfile.fileno())
+
+
+def save_visit(data_file, patient_id, visit, note):
+    with _write_lock:
+        _append_rows(data_file, [visit_row(patient_id, visit, note)])
+
+
+def save_visits(data_file, entries):
+    """Append many (patient_id, visit, note) visits with a single write and fsync."""
+    with _write_lock:
+        _append_rows(data_file, [visit_row(patient_id, visit, note) for patient_id, visit, note in entries],
+                     header=PATIENT_FIELDS)
+
+
+def save_notes(notes_file, notes):
+    """Append (patient_id, visit_id, note_id, text) records to Notes.csv with a single write and fsync."""
+    with _write_lock:
+        _append_rows(notes_file, [["", patient_id, visit_id, note_id, text]
+                                  for patient_id, visit_id, note_id, text in notes], header=NOTE_FIELDS)
+
+
+# -------------------- Tombstones and Compaction --------------------
+#
+# Removing a patient appends one tombstone row (Patient_ID, byte offset,
+# inode) to a side file instead of rewriting Patient_data.csv. Rows of that
+# patient that start before the offset are treated as deleted, so visits
+# added after the removal survive. Once enough tombstones accumulate
+# (compaction_due) the data file can be compacted into a temporary file and
+# swapped in with os.replace; that is a pass over the whole file, so callers
+# run it in the background. The new file has a different inode, which
+# retires the old tombstones even if the process dies before the side file
+# is removed.
+
+COMPACT_THRESHOLD = 100
+
+_write_lock = threading.RLock()
+
+
+def tombstone_file(data_file):
+    root, ext = os.path.splitext(data_file)
+    return f"{root}_tombstones{ext or '.csv'}"
+
+
+def load_tombstones(data_file):
+    """Return {Patient_ID: offset} for the tombstones that apply to the current data file."""
+    try:
+        inode = os.stat(data_file).st_ino
+    except FileNotFoundError:
+        return {}
+
+    tombstones = {}
+    try:
+        with open(tombstone_file(data_file), newline='', encoding='utf-8') as csvfile:
+            for row in csv.reader(csvfile):
+                if len(row) != 3:
+                    continue  # torn write
+                try:
+                    offset, row_inode = int(row[1]), int(row[2])
+                except ValueError:
+                    continue
+                if row_inode == inode:
+                    tombstones[row[0]] = max(offset, tombstones.get(row[0], 0))
+    except FileNotFoundError:
+        pass
+    return tombstones
+
+
+def resume_offset(data_file, source, inode, tombstones):
+    """Where a reader of data_file can resume from source ((inode, offset, tombstones)), or None to start over.
+
+    Tombstones only ever move forward while the inode stays the same, so
+    anything else means the file was replaced or rewritten.
+    """
+    if source is None:
+        return None
+    old_inode, old_offset, old_tombstones = source
+    if old_inode != inode or os.path.getsize(data_file) < old_offset:
+        return None
+    if any(tombstones.get(patient_id, -1) < tombstone for patient_id, tombstone in old_tombstones):
+        return None
+    return old_offset
+
+
+def saved_source(source):
+    """A source as read back from JSON, which turns the tombstone tuples into lists.
+
+    SqliteStorage's sources end in a removal counter rather than tombstones
+    and come back unchanged.
+    """
+    inode, offset, tombstones = source
+    return inode, offset, [tuple(t) for t in tombstones] if isinstance(tombstones, list) else tombstones
+
+
+def iter_removed_rows(data_file, offset, old_tombstones, tombstones):
+    """Yield the rows among the first offset bytes that tombstones hide but old_tombstones did not."""
+    hidden_before = {patient_id: old_tombstones.get(patient_id, -1) for patient_id, tombstone in tombstones.items()
+                     if tombstone > old_tombstones.get(patient_id, -1)}
+    for start, row in iter_patient_rows(data_file, hidden_before, offset):
+        patient_id = row["Patient_ID"]
+        if hidden_before[patient_id] <= start < tombstones[patient_id]:
+            yield row
+
+
+def remove_patient(data_file, patient_id):
+    """Delete every stored visit of a patient with a single O(1) append; returns the tombstone's offset."""
+    with _write_lock:
+        stat = os.stat(data_file)
+        tomb_path = tombstone_file(data_file)
+        _append_rows(tomb_path, [[patient_id, stat.st_size, stat.st_ino]])
+        return stat.st_size
+
+
+def compaction_due(data_file):
+    return len(load_tombstones(data_file)) >= COMPACT_THRESHOLD
+
+
+def compact(data_file):
+    """Rewrite the data file without tombstoned rows and atomically swap it in."""
+    with _write_lock:
+        tombstones = load_tombstones(data_file)
+        if tombstones:
+            directory = os.path.dirname(os.path.abspath(data_file))
+            fd, temp_path = tempfile.mkstemp(prefix=".compact-", suffix=".csv", dir=directory)
+            try:
+                with os.fdopen(fd, mode='w', newline='', encoding='utf-8') as outfile:
+                    writer = csv.writer(outfile)
+                    writer.writerow(PATIENT_FIELDS)
+                    for row in iter_visit_rows(data_file):
+                        writer.writerow([row[field] for field in PATIENT_FIELDS])
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+                os.replace(temp_path, data_file)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        try:
+            os.remove(tombstone_file(data_file))
+        except FileNotFoundError:
+            pass
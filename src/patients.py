@@ -1,27 +1,55 @@
+import sys
 import uuid
+from bisect import bisect_left, bisect_right
+from visit_index import visit_ordinal
+
+
+def _intern(value):
+    # Category columns repeat a handful of values across millions of visits,
+    # so every visit shares one string object per distinct value.
+    return sys.intern(value) if isinstance(value, str) else value
+
 
 class Note:
-    def __init__(self, note_id, note_type, note_text=""):
+    __slots__ = ("note_id", "note_type", "_note_text", "store")
+
+    def __init__(self, note_id, note_type, note_text="", store=None):
         self.note_id = note_id
-        self.note_type = note_type
-        self.note_text = note_text
+        self.note_type = _intern(note_type)
+        self._note_text = note_text
+        self.store = store  # NoteStore to read the text from on demand
+
+    @property
+    def note_text(self):
+        if self.store is not None:
+            return self.store.get_text(self.note_id)
+        return self._note_text
+
+    @note_text.setter
+    def note_text(self, value):
+        self._note_text = value
+        self.store = None
 
     def __str__(self):
         return f"Note ID: {self.note_id}, Type: {self.note_type}\n{self.note_text}"
 
 
 class Visit:
+    __slots__ = ("visit_id", "visit_time", "date_ordinal", "department", "gender", "race", "age",
+                 "ethnicity", "insurance", "zip_code", "chief_complaint", "notes")
+
     def __init__(self, visit_id, visit_time, department, gender, race, age, ethnicity, insurance, zip_code, chief_complaint):
         self.visit_id = visit_id
-        self.visit_time = visit_time
-        self.department = department
-        self.gender = gender
-        self.race = race
+        self.visit_time = _intern(visit_time)
+        self.date_ordinal = visit_ordinal(self.visit_time)  # parsed once; 0 if the date is invalid
+        self.department = _intern(department)
+        self.gender = _intern(gender)
+        self.race = _intern(race)
         self.age = age
-        self.ethnicity = ethnicity
-        self.insurance = insurance
-        self.zip_code = zip_code
-        self.chief_complaint = chief_complaint
+        self.ethnicity = _intern(ethnicity)
+        self.insurance = _intern(insurance)
+        self.zip_code = _intern(zip_code)
+        self.chief_complaint = _intern(chief_complaint)
         self.notes = []
 
     def add_note(self, note):
@@ -35,15 +63,41 @@ class Visit:
 
 
 class Patient:
+    """A patient and their visits, kept in visit date order.
+
+    _dates holds each visit's date ordinal in the same order, so the latest
+    visit is the last one and the visits on a given day are found by bisection.
+    """
+
+    __slots__ = ("patient_id", "visits", "_dates")
+
     def __init__(self, patient_id):
         self.patient_id = patient_id
         self.visits = []
+        self._dates = []
 
     def add_visit(self, visit):
-        self.visits.append(visit)
+        ordinal = visit.date_ordinal
+        if not self._dates or ordinal >= self._dates[-1]:
+            self.visits.append(visit)  # the usual case: visits arrive in date order
+            self._dates.append(ordinal)
+            return
+        i = bisect_right(self._dates, ordinal)
+        self.visits.insert(i, visit)
+        self._dates.insert(i, ordinal)
 
     def remove_all_visits(self):
         self.visits = []
+        self._dates = []
+
+    def latest_visit(self):
+        """The visit with the most recent date, or None if there are no visits."""
+        return self.visits[-1] if self.visits else None
+
+    def visits_on(self, day):
+        """All visits on a date, in the order they were added."""
+        ordinal = day.toordinal()
+        return self.visits[bisect_left(self._dates, ordinal):bisect_right(self._dates, ordinal)]
 
     def get_all_info(self):
         info = f"Patient ID: {self.patient_id}\n"
@@ -0,0 +1,437 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from patients import Patient, Visit, Note
+from patient_repository import add_appended_rows, file_signature, load_tombstones, tail_bytes
+from visit_index import VisitDateIndex
+from instrumentation import timed
+
+# Binary snapshots of parsed CSV files, so a restart maps the previous parse
+# instead of repeating it. Layout: HEADER, a JSON header describing the
+# source file and the sections, then the sections as packed arrays, each
+# starting on an ALIGNMENT boundary. Sections are read through memoryviews
+# of the mapped file; nothing is copied or decoded until it is used.
+
+MAGIC = b"HSNP"
+VERSION = 1
+HEADER = struct.Struct("<4sIQ")  # magic, version, JSON header size
+ALIGNMENT = 8
+REFRESH_ROWS = 100000    # rows appended since the snapshot after which it is rewritten
+HASH_BLOCK = 1 << 20
+
+# Visit columns stored as codes into a table of distinct values
+CATEGORY_FIELDS = ["visit_time", "department", "gender", "race", "ethnicity", "insurance", "zip_code",
+                   "chief_complaint", "note_type"]
+
+
+def snapshot_file(source_file):
+    """Patient_data.csv -> Patient_data.snapshot"""
+    return os.path.splitext(source_file)[0] + ".snapshot"
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def content_hash(path, size):
+    """Hex digest of the first size bytes of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        remaining = size
+        while remaining > 0:
+            block = f.read(min(HASH_BLOCK, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+def source_state(path):
+    """What a snapshot records about its source file, or None if the file does not end on a complete line."""
+    stat = os.stat(path)
+    tail = tail_bytes(path, stat.st_size)
+    if tail and not tail.endswith(b"\n"):
+        return None  # an append is in progress; the row boundary is unknown
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino, "tail": tail.hex(),
+            "hash": content_hash(path, stat.st_size)}
+
+
+def resume_offset(path, source):
+    """Byte offset in path up to which the snapshot's source is unchanged, or None if it is stale.
+
+    The file may have grown by appends since the snapshot was written, in
+    which case the rows after the returned offset still need reading. An
+    append is recognised by the bytes just before the old end being
+    unchanged; a file of the same size with a new mtime is compared by
+    content hash.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    size = source["size"]
+    if stat.st_ino != source["inode"] or stat.st_size < size:
+        return None
+    if stat.st_size == size and stat.st_mtime_ns == source["mtime_ns"]:
+        return size
+    if tail_bytes(path, size).hex() != source["tail"]:
+        return None
+    if stat.st_size == size and content_hash(path, size) != source["hash"]:
+        return None
+    return size
+
+
+def write_snapshot(path, meta, sections):
+    """Write sections ({name: (typecode, array or buffer)}) and meta atomically to path.
+
+    Returns False if the file could not be replaced, e.g. because another
+    process on Windows still has the old snapshot mapped.
+    """
+    layout, offset = {}, 0
+    for name, (typecode, data) in sections.items():
+        size = memoryview(data).nbytes
+        layout[name] = [typecode, offset, size]
+        offset = _align(offset + size)
+    header = json.dumps({"meta": meta, "sections": layout}).encode("utf-8")
+
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, mode='wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+            f.write(header)
+            f.write(b"\0" * (_align(HEADER.size + len(header)) - HEADER.size - len(header)))
+            for name, (typecode, data) in sections.items():
+                f.write(data)
+                f.write(b"\0" * (_align(layout[name][2]) - layout[name][2]))
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Could not write snapshot {path}: {e}")
+        return False
+    return True
+
+
+def read_snapshot(path):
+    """Map a snapshot and return (meta, {name: memoryview}), or None if it is missing, damaged or from another version."""
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError, OSError):
+        return None  # ValueError: empty file
+    try:
+        magic, version, header_size = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            return None
+        header = json.loads(mm[HEADER.size:HEADER.size + header_size])
+        base = _align(HEADER.size + header_size)
+        view = memoryview(mm)
+        sections = {}
+        for name, (typecode, offset, size) in header["sections"].items():
+            if base + offset + size > len(mm):
+                return None
+            sections[name] = view[base + offset:base + offset + size].cast(typecode)
+        return header["meta"], sections
+    except (struct.error, ValueError, KeyError, TypeError):
+        return None
+
+
+def open_snapshot(source_file):
+    """Return (meta, sections, offset) for source_file's snapshot if it is still valid, else None.
+
+    offset is where rows appended since the snapshot begin. A snapshot whose
+    source was only touched is rewritten with the new mtime, so the content
+    hash is not recomputed on every load.
+    """
+    path = snapshot_file(source_file)
+    snapshot = read_snapshot(path)
+    if snapshot is None:
+        return None
+    meta, sections = snapshot
+    source = meta["source"]
+    offset = resume_offset(source_file, source)
+    if offset is None:
+        return None
+    mtime = os.stat(source_file).st_mtime_ns
+    if offset == os.path.getsize(source_file) and mtime != source["mtime_ns"]:
+        meta = dict(meta, source=dict(source, mtime_ns=mtime))
+        write_snapshot(path, meta, {name: (view.format, view) for name, view in sections.items()})
+    return meta, sections, offset
+
+
+def _pack_strings(values):
+    """Concatenate strings into (offsets, blob); string i is blob[offsets[i]:offsets[i + 1]]."""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = array("Q", [0])
+    total = 0
+    for data in encoded:
+        total += len(data)
+        offsets.append(total)
+    return offsets, b"".join(encoded)
+
+
+class PackedStrings:
+    """Read-only sequence over strings packed by _pack_strings; sorted ones can be bisected."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def find(self, value):
+        """Position of value if the strings are sorted and contain it, else -1."""
+        i = bisect_left(self, value)
+        return i if i < len(self) and self[i] == value else -1
+
+
+# -------------------- Patient snapshots --------------------
+
+class SnapshotPatients:
+    """Dictionary of Patient_ID -> Patient backed by a mapped snapshot.
+
+    A Patient (with its visits and notes) is built the first time it is
+    looked up and kept from then on, so changes to it are not lost. Patients
+    added or popped later are tracked on top of the snapshot. Iterating the
+    whole mapping builds every patient.
+    """
+
+    def __init__(self, meta, sections, note_store):
+        self._ids = PackedStrings(sections["patient_id_offsets"], sections["patient_ids"])
+        self._starts = sections["patient_starts"]
+        self._visit_ids = PackedStrings(sections["visit_id_offsets"], sections["visit_ids"])
+        self._note_ids = PackedStrings(sections["note_id_offsets"], sections["note_ids"])
+        self._ages = sections["ages"]
+        self._codes = [sections[field] for field in CATEGORY_FIELDS]
+        self._values = [meta["categories"][field] for field in CATEGORY_FIELDS]
+        self._note_store = note_store
+        self._loaded = {}
+        self._removed = set()
+
+    def _build(self, i):
+        patient = Patient(self._ids[i])
+        codes, values = self._codes, self._values
+        for row in range(self._starts[i], self._starts[i + 1]):
+            visit_time, department, gender, race, ethnicity, insurance, zip_code, complaint, note_type = (
+                values[field][codes[field][row]] for field in range(len(CATEGORY_FIELDS)))
+            visit = Visit(self._visit_ids[row], visit_time, department, gender, race, self._ages[row], ethnicity,
+                          insurance, zip_code, complaint)
+            note_id = self._note_ids[row]
+            if note_id:
+                visit.add_note(Note(note_id, note_type, store=self._note_store))
+            patient.add_visit(visit)
+        return patient
+
+    def get(self, patient_id, default=None):
+        patient = self._loaded.get(patient_id)
+        if patient is not None:
+            return patient
+        if patient_id in self._removed:
+            return default
+        i = self._ids.find(patient_id)
+        if i < 0:
+            return default
+        patient = self._loaded[patient_id] = self._build(i)
+        return patient
+
+    def __getitem__(self, patient_id):
+        patient = self.get(patient_id)
+        if patient is None:
+            raise KeyError(patient_id)
+        return patient
+
+    def __contains__(self, patient_id):
+        if patient_id in self._loaded:
+            return True
+        return patient_id not in self._removed and self._ids.find(patient_id) >= 0
+
+    def __setitem__(self, patient_id, patient):
+        self._loaded[patient_id] = patient
+        self._removed.discard(patient_id)
+
+    def pop(self, patient_id, default=None):
+        patient = self.get(patient_id)
+        if patient is None:
+            return default
+        del self._loaded[patient_id]
+        if self._ids.find(patient_id) >= 0:
+            self._removed.add(patient_id)
+        return patient
+
+    def __iter__(self):
+        for i in range(len(self._ids)):
+            patient_id = self._ids[i]
+            if patient_id not in self._removed and patient_id not in self._loaded:
+                yield patient_id
+        yield from list(self._loaded)
+
+    def __len__(self):
+        # Patients popped are in _removed; patients built from the snapshot are also in _loaded
+        return len(self._ids) - len(self._removed) + sum(1 for patient_id in self._loaded
+                                                         if self._ids.find(patient_id) < 0)
+
+    def values(self):
+        for patient_id in list(self):
+            yield self[patient_id]
+
+    def items(self):
+        for patient_id in list(self):
+            yield patient_id, self[patient_id]
+
+
+def save_patients(data_file, patients, date_index, signature):
+    """Snapshot a loaded patient graph; skipped if data_file no longer matches signature.
+
+    signature is file_signature(data_file) taken before the graph was read,
+    so a file that changed while loading is not recorded as its source.
+    """
+    source = source_state(data_file)
+    if source is None or file_signature(data_file) != signature:
+        return False
+
+    patient_ids = sorted(patients)
+    starts = array("Q", [0])
+    ages = array("i")
+    visit_ids, note_ids = [], []
+    categories = {field: {} for field in CATEGORY_FIELDS}
+    codes = {field: array("I") for field in CATEGORY_FIELDS}
+    for patient_id in patient_ids:
+        for visit in patients[patient_id].visits:
+            for note in visit.notes or [None]:
+                visit_ids.append(visit.visit_id)
+                note_ids.append(note.note_id if note else "")
+                ages.append(visit.age)
+                values = (visit.visit_time, visit.department, visit.gender, visit.race, visit.ethnicity,
+                          visit.insurance, visit.zip_code, visit.chief_complaint, note.note_type if note else "")
+                for field, value in zip(CATEGORY_FIELDS, values):
+                    table = categories[field]
+                    code = table.get(value)
+                    if code is None:
+                        code = table[value] = len(table)
+                    codes[field].append(code)
+        starts.append(len(visit_ids))
+
+    sections = {}
+    for name, values in (("patient_id", patient_ids), ("visit_id", visit_ids), ("note_id", note_ids)):
+        offsets, blob = _pack_strings(values)
+        sections[name + "_offsets"] = ("Q", offsets)
+        sections[name + "s"] = ("B", blob)
+    sections["patient_starts"] = ("Q", starts)
+    sections["ages"] = ("i", ages)
+    for field in CATEGORY_FIELDS:
+        sections[field] = ("I", codes[field])
+    days = sorted(date_index.counts)
+    sections["days"] = ("i", array("i", days))
+    sections["day_counts"] = ("Q", array("Q", [date_index.counts[day] for day in days]))
+    meta = {"source": source, "categories": {field: list(table) for field, table in categories.items()}}
+    return write_snapshot(snapshot_file(data_file), meta, sections)
+
+
+@timed("snapshot.load_patients", rows=lambda restored: 0 if restored is None else restored[1].total())
+def load_patients(data_file, note_store):
+    """Return (patients, date_index, tombstones, offset) from data_file's snapshot, or None if there is no usable one.
+
+    Rows appended to data_file since the snapshot was written are read and
+    added, and tombstones written since then are applied; offset is where
+    the rows read end. If many rows had to be added the snapshot is rewritten.
+    """
+    signature = file_signature(data_file)
+    snapshot = open_snapshot(data_file)
+    if snapshot is None:
+        return None
+    meta, sections, offset = snapshot
+
+    patients = SnapshotPatients(meta, sections, note_store)
+    date_index = VisitDateIndex()
+    date_index.counts.update(dict(zip(sections["days"], sections["day_counts"])))
+
+    # A tombstone at or past the snapshot's end hides all the patient's snapshot rows
+    tombstones = load_tombstones(data_file)
+    for patient_id, tombstone in tombstones.items():
+        if tombstone >= offset:
+            patient = patients.pop(patient_id)
+            if patient is not None:
+                date_index.remove_patient(patient)
+
+    appended, end = add_appended_rows(data_file, offset, patients, note_store, date_index, tombstones)
+    if appended >= REFRESH_ROWS:
+        save_patients(data_file, patients, date_index, signature)
+    return patients, date_index, tombstones, end
+
+
+# -------------------- Note offset snapshots --------------------
+
+class SnapshotOffsets:
+    """Note_ID -> (start, end) byte range, from a snapshot plus records indexed since."""
+
+    def __init__(self, sections):
+        self._ids = PackedStrings(sections["note_id_offsets"], sections["note_ids"])
+        self._starts = sections["starts"]
+        self._ends = sections["ends"]
+        self._added = {}
+        self._added_new = 0  # entries of _added whose Note_ID is not in the snapshot
+
+    def get(self, note_id, default=None):
+        span = self._added.get(note_id)
+        if span is not None:
+            return span
+        i = self._ids.find(note_id)
+        return (self._starts[i], self._ends[i]) if i >= 0 else default
+
+    def __contains__(self, note_id):
+        return note_id in self._added or self._ids.find(note_id) >= 0
+
+    def __setitem__(self, note_id, span):
+        if note_id not in self._added and self._ids.find(note_id) < 0:
+            self._added_new += 1
+        self._added[note_id] = span
+
+    def __len__(self):
+        return len(self._ids) + self._added_new
+
+    def __iter__(self):
+        for i in range(len(self._ids)):
+            yield self._ids[i]
+        for note_id in list(self._added):
+            if self._ids.find(note_id) < 0:
+                yield note_id
+
+    def items(self):
+        for note_id in self:
+            yield note_id, self.get(note_id)
+
+
+def save_note_offsets(notes_file, offsets, indexed_end):
+    """Snapshot a NoteStore's offsets, valid for the first indexed_end bytes of notes_file."""
+    source = source_state(notes_file)
+    if source is None or source["size"] != indexed_end:
+        return False
+    note_ids = sorted(offsets)
+    id_offsets, blob = _pack_strings(note_ids)
+    starts, ends = array("Q"), array("Q")
+    for note_id in note_ids:
+        start, end = offsets.get(note_id)
+        starts.append(start)
+        ends.append(end)
+    sections = {"note_id_offsets": ("Q", id_offsets), "note_ids": ("B", blob), "starts": ("Q", starts),
+                "ends": ("Q", ends)}
+    return write_snapshot(snapshot_file(notes_file), {"source": source}, sections)
+
+
+def load_note_offsets(notes_file):
+    """Return (offsets, indexed_end) from notes_file's snapshot, or None if there is no usable one.
+
+    Records appended after indexed_end still have to be scanned.
+    """
+    snapshot = open_snapshot(notes_file)
+    if snapshot is None:
+        return None
+    meta, sections, offset = snapshot
+    return SnapshotOffsets(sections), offset
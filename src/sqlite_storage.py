@@ -0,0 +1,315 @@
+import argparse
+import csv
+import sqlite3
+import threading
+from itertools import islice
+from patients import Patient, Visit, Note
+from patient_repository import PATIENT_FIELDS, CHUNK_SIZE, iter_row_chunks
+from visit_index import parse_visit_date
+from visit_trends import VisitRollups, rollup_file
+from instrumentation import timed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS visits (
+    Patient_ID TEXT NOT NULL,
+    Visit_ID TEXT NOT NULL,
+    Visit_time TEXT NOT NULL,
+    Visit_date INTEGER,
+    Visit_department TEXT,
+    Race TEXT,
+    Gender TEXT,
+    Ethnicity TEXT,
+    Age INTEGER,
+    Zip_code TEXT,
+    Insurance TEXT,
+    Chief_complaint TEXT,
+    Note_ID TEXT,
+    Note_type TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_visits_patient ON visits (Patient_ID);
+CREATE INDEX IF NOT EXISTS idx_visits_date ON visits (Visit_date);
+CREATE INDEX IF NOT EXISTS idx_visits_note ON visits (Note_ID);
+CREATE INDEX IF NOT EXISTS idx_visits_visit ON visits (Visit_ID);
+
+CREATE TABLE IF NOT EXISTS notes (
+    Note_ID TEXT PRIMARY KEY,
+    Patient_ID TEXT,
+    Visit_ID TEXT,
+    Note_text TEXT
+);
+
+-- What the saved rollups and cube need to uncount a deleted visit; no identifiers
+CREATE TABLE IF NOT EXISTS removed_visits (
+    seq INTEGER PRIMARY KEY,
+    Visit_rowid INTEGER NOT NULL,
+    Visit_time TEXT,
+    Visit_department TEXT,
+    Chief_complaint TEXT,
+    Gender TEXT,
+    Race TEXT,
+    Ethnicity TEXT,
+    Insurance TEXT,
+    Age INTEGER
+);
+CREATE TRIGGER IF NOT EXISTS log_visit_removal AFTER DELETE ON visits BEGIN
+    INSERT INTO removed_visits (Visit_rowid, Visit_time, Visit_department, Chief_complaint, Gender, Race,
+                                Ethnicity, Insurance, Age)
+    VALUES (old.rowid, old.Visit_time, old.Visit_department, old.Chief_complaint, old.Gender, old.Race,
+            old.Ethnicity, old.Insurance, old.Age);
+END;
+"""
+
+VISIT_COLUMNS = PATIENT_FIELDS[:3] + ["Visit_date"] + PATIENT_FIELDS[3:]
+INSERT_VISIT = f"INSERT INTO visits ({', '.join(VISIT_COLUMNS)}) VALUES ({', '.join('?' * len(VISIT_COLUMNS))})"
+SQL_PARAMETER_LIMIT = 900  # stays under SQLite's default limit of 999 bound parameters
+INSERT_NOTE = "INSERT OR REPLACE INTO notes (Note_ID, Patient_ID, Visit_ID, Note_text) VALUES (?, ?, ?, ?)"
+SUMMARY_FIELDS = ["Visit_time", "Visit_department", "Chief_complaint", "Gender", "Race", "Ethnicity", "Insurance", "Age"]
+SOURCE_TAG = "sqlite"  # first entry of a saved rollups/cube source, where the CSV backend keeps an inode
+
+
+def _visit_values(row):
+    """Turn a Patient_data.csv row dictionary into an INSERT_VISIT parameter tuple."""
+    visit_date = parse_visit_date(row["Visit_time"])
+    values = [row[field] for field in PATIENT_FIELDS]
+    values.insert(3, visit_date.toordinal() if visit_date else None)
+    return values
+
+
+class SqliteStorage:
+    """Patient data in an SQLite database, queried through indexes instead of held in memory.
+
+    Offers the same methods as storage.CsvStorage. It also serves as the note
+    store (note_store) for the Note objects it returns, so note text is read
+    on demand.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.notes_file = None  # note text lives in the notes table
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.note_store = self
+        self.rollups = None
+        self.cube = None
+
+    def is_empty(self):
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM visits LIMIT 1").fetchone() is None
+
+    # -------------------- Import --------------------
+
+    def import_csv(self, data_file, notes_file, batch_size=CHUNK_SIZE):
+        """One-shot import of Patient_data.csv and Notes.csv, one transaction per batch."""
+        visits = 0
+        try:
+            for chunk in iter_row_chunks(data_file, batch_size):
+                with self._lock, self.conn:
+                    self.conn.executemany(INSERT_VISIT, [_visit_values(row) for row in chunk])
+                visits += len(chunk)
+        except FileNotFoundError:
+            print(f"Data file {data_file} not found.")
+
+        notes = 0
+        try:
+            with open(notes_file, newline='', encoding='utf-8') as csvfile:
+                rows = ((r["Note_ID"], r["Patient_ID"], r["Visit_ID"], r["Note_text"]) for r in csv.DictReader(csvfile))
+                while True:
+                    batch = list(islice(rows, batch_size))
+                    if not batch:
+                        break
+                    with self._lock, self.conn:
+                        self.conn.executemany(INSERT_NOTE, batch)
+                    notes += len(batch)
+        except FileNotFoundError:
+            print(f" Note file {notes_file} not found.")
+        return visits, notes
+
+    # -------------------- Storage interface --------------------
+
+    @timed("sqlite.load")
+    def load(self, sinks=(), progress=None):
+        """Nothing to build in memory; only feed the sinks from the database."""
+        if sinks:
+            for chunk in self.iter_row_chunks():
+                for sink in sinks:
+                    sink.consume(chunk)
+
+    def refresh(self):
+        """Queries already see rows other sessions commit; there is nothing to catch up on."""
+        return 0
+
+    def load_notes(self):
+        """Notes are looked up by primary key; there is no index to build."""
+
+    def iter_row_chunks(self, chunk_size=CHUNK_SIZE):
+        with self._lock:
+            cursor = self.conn.execute(f"SELECT {', '.join(PATIENT_FIELDS)} FROM visits")
+            rows = cursor.fetchmany(chunk_size)
+        while rows:
+            yield [dict(zip(PATIENT_FIELDS, row)) for row in rows]
+            with self._lock:
+                rows = cursor.fetchmany(chunk_size)
+
+    def has_patient(self, patient_id):
+        with self._lock:
+            query = "SELECT 1 FROM visits WHERE Patient_ID = ? LIMIT 1"
+            return self.conn.execute(query, (patient_id,)).fetchone() is not None
+
+    def get_patient(self, patient_id):
+        with self._lock:
+            query = f"SELECT {', '.join(PATIENT_FIELDS)} FROM visits WHERE Patient_ID = ? ORDER BY rowid"
+            rows = self.conn.execute(query, (patient_id,)).fetchall()
+        if not rows:
+            return None
+
+        patient = Patient(patient_id)
+        for row in rows:
+            row = dict(zip(PATIENT_FIELDS, row))
+            visit = Visit(row["Visit_ID"], row["Visit_time"], row["Visit_department"], row["Gender"],
+                          row["Race"], int(row["Age"]), row["Ethnicity"], row["Insurance"],
+                          row["Zip_code"], row["Chief_complaint"])
+            visit.add_note(Note(row["Note_ID"], row["Note_type"], store=self))
+            patient.add_visit(visit)
+        return patient
+
+    def get_text(self, note_id):
+        with self._lock:
+            row = self.conn.execute("SELECT Note_text FROM notes WHERE Note_ID = ?", (note_id,)).fetchone()
+        return row[0] if row else ""
+
+    def add_visit(self, patient_id, visit, note):
+        row = dict(zip(PATIENT_FIELDS, [
+            patient_id, visit.visit_id, visit.visit_time, visit.department, visit.race, visit.gender,
+            visit.ethnicity, visit.age, visit.zip_code, visit.insurance, visit.chief_complaint,
+            note.note_id, note.note_type
+        ]))
+        with self._lock, self.conn:
+            self.conn.execute(INSERT_VISIT, _visit_values(row))
+            self.conn.execute(INSERT_NOTE, (note.note_id, patient_id, visit.visit_id, note.note_text))
+
+    def add_visits(self, entries):
+        """Add many (patient_id, visit, note, note_text) visits in a single transaction."""
+        visits, notes = [], []
+        for patient_id, visit, note, text in entries:
+            visits.append(_visit_values(dict(zip(PATIENT_FIELDS, [
+                patient_id, visit.visit_id, visit.visit_time, visit.department, visit.race, visit.gender,
+                visit.ethnicity, visit.age, visit.zip_code, visit.insurance, visit.chief_complaint,
+                note.note_id, note.note_type
+            ]))))
+            notes.append((note.note_id, patient_id, visit.visit_id, text))
+            note.store = self
+        with self._lock, self.conn:
+            self.conn.executemany(INSERT_VISIT, visits)
+            self.conn.executemany(INSERT_NOTE, notes)
+
+    def existing_ids(self, visit_ids, note_ids):
+        """Return which of the given Visit_IDs and Note_IDs are already stored."""
+        found = (set(), set())
+        for ids, query, result in ((list(visit_ids), "SELECT Visit_ID FROM visits WHERE Visit_ID IN ({})", found[0]),
+                                   (list(note_ids), "SELECT Note_ID FROM notes WHERE Note_ID IN ({})", found[1])):
+            for i in range(0, len(ids), SQL_PARAMETER_LIMIT):
+                batch = ids[i:i + SQL_PARAMETER_LIMIT]
+                with self._lock:
+                    rows = self.conn.execute(query.format(", ".join("?" * len(batch))), batch).fetchall()
+                result.update(row[0] for row in rows)
+        return found
+
+    def remove_patient(self, patient_id):
+        with self._lock, self.conn:
+            removed = self.conn.execute("DELETE FROM visits WHERE Patient_ID = ?", (patient_id,)).rowcount
+            self.conn.execute("DELETE FROM notes WHERE Patient_ID = ?", (patient_id,))
+        return removed > 0
+
+    def compact(self):
+        """Nothing to do: SQLite deletes rows in place."""
+        return False
+
+    def count_visits(self, day):
+        with self._lock:
+            query = "SELECT COUNT(*) FROM visits WHERE Visit_date = ?"
+            return self.conn.execute(query, (day.toordinal(),)).fetchone()[0]
+
+    def count_visits_between(self, start, end):
+        with self._lock:
+            query = "SELECT COUNT(*) FROM visits WHERE Visit_date BETWEEN ? AND ?"
+            return self.conn.execute(query, (start.toordinal(), end.toordinal())).fetchone()[0]
+
+    def statistics_chunks(self):
+        """Row chunks for the statistics loader, which cannot read the database itself."""
+        return self.iter_row_chunks()
+
+    def visit_rollups(self):
+        """Visit trend rollups, saved next to the database and caught up on visits changed since."""
+        path = rollup_file(self.db_file)
+        self.rollups = self._catch_up(self.rollups or VisitRollups.load(path), path)
+        return self.rollups
+
+    def visit_cube(self):
+        """The visit data cube, saved next to the database and caught up on visits changed since."""
+        from data_cube import VisitCube, cube_file  # numpy/pandas load only when the cube is used
+        path = cube_file(self.db_file)
+        self.cube = self._catch_up(self.cube or VisitCube.load(path), path)
+        return self.cube
+
+    def _catch_up(self, summary, path):
+        """Bring saved VisitRollups or a VisitCube up to date with the visits table, saving it if it changed.
+
+        Its source is (SOURCE_TAG, highest rowid counted, last removed_visits
+        seq uncounted), so only visits inserted or deleted since are read. If
+        the highest counted visit was deleted, SQLite may have given its
+        rowid to a newer visit, so the summary is rebuilt instead.
+        """
+        reader = sqlite3.connect(self.db_file)  # its own snapshot, so no change is counted twice or missed
+        try:
+            reader.execute("BEGIN")
+            last_rowid, last_removal = reader.execute(
+                "SELECT (SELECT IFNULL(MAX(rowid), 0) FROM visits), (SELECT IFNULL(MAX(seq), 0) FROM removed_visits)"
+            ).fetchone()
+            source = summary.source
+            if source is not None and source[0] == SOURCE_TAG:
+                _, counted, uncounted = source
+                top_removed = "SELECT 1 FROM removed_visits WHERE seq > ? AND Visit_rowid = ?"
+                if reader.execute(top_removed, (uncounted, counted)).fetchone():
+                    source = None
+            if source is None or source[0] != SOURCE_TAG:
+                summary, counted = type(summary)(), 0
+            else:
+                removed = reader.execute(f"SELECT {', '.join(SUMMARY_FIELDS)} FROM removed_visits "
+                                         "WHERE seq > ? AND Visit_rowid <= ?", (uncounted, counted))
+                summary.add_rows([dict(zip(SUMMARY_FIELDS, row)) for row in removed], -1)
+
+            cursor = reader.execute(f"SELECT {', '.join(SUMMARY_FIELDS)} FROM visits WHERE rowid > ?", (counted,))
+            rows = cursor.fetchmany(CHUNK_SIZE)
+            while rows:
+                summary.add_rows([dict(zip(SUMMARY_FIELDS, row)) for row in rows])
+                rows = cursor.fetchmany(CHUNK_SIZE)
+            reader.rollback()
+        finally:
+            reader.close()
+
+        if summary.source != (SOURCE_TAG, last_rowid, last_removal):
+            summary.source = (SOURCE_TAG, last_rowid, last_removal)
+            summary.save(path)
+        return summary
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import the CSV data files into an SQLite database.")
+    parser.add_argument("data_file", nargs="?", default="Patient_data.csv")
+    parser.add_argument("notes_file", nargs="?", default="Notes.csv")
+    parser.add_argument("db_file", nargs="?", default="hospital.db")
+    args = parser.parse_args()
+
+    storage = SqliteStorage(args.db_file)
+    if not storage.is_empty():
+        print(f"{args.db_file} already contains data; nothing imported.")
+    else:
+        visit_count, note_count = storage.import_csv(args.data_file, args.notes_file)
+        print(f"Imported {visit_count} visits and {note_count} notes into {args.db_file}")
+    storage.close()
@@ -0,0 +1,257 @@
+import os
+import threading
+import patient_repository
+import snapshot
+from patients import Patient
+from notes import load_notes
+from visit_index import VisitDateIndex
+from visit_trends import load_rollups
+
+STORAGE_ENV = "HOSPITAL_STORAGE"
+DB_FILE_ENV = "HOSPITAL_DB"
+DEFAULT_DB_FILE = "hospital.db"
+
+
+class CsvStorage:
+    """Patient data held in memory and persisted to Patient_data.csv.
+
+    This is the default backend. SqliteStorage in sqlite_storage.py provides
+    the same methods on top of an indexed database.
+    """
+
+    def __init__(self, data_file, notes_file):
+        self.data_file = data_file
+        self.notes_file = notes_file  # where add_visits appends note text
+        self.note_store = load_notes(notes_file)
+        self.patients = {}
+        self.date_index = VisitDateIndex()
+        self.loaded_signature = None
+        self.rollups = None
+        self.cube = None
+        self.known_ids = None  # (Visit_IDs, Note_IDs), built on first existing_ids()
+        # Where the rows in memory end, as a file_position(), so refresh() can read on from there
+        self.position = None
+        self.tombstones = {}         # {Patient_ID: offset} already applied to the model
+        self.written_visits = set()  # Visit_IDs this session appended beyond position
+        self._lock = threading.RLock()
+
+    def load(self, sinks=(), progress=None):
+        """Build the in-memory model, or bring an already loaded one up to date.
+
+        A loaded model only reads the rows appended since (see refresh).
+        Otherwise a valid snapshot of the file (see snapshot.py) is mapped
+        instead of parsing the CSV, and a full parse writes a new snapshot.
+        progress(rows_read) is called as the rebuild goes. Safe to run in a
+        worker thread: a rebuilt model replaces the old one only once complete.
+        Raises FileNotFoundError if the data file is missing.
+        """
+        signature = patient_repository.file_signature(self.data_file)
+        if signature is None or signature != self.loaded_signature:
+            if self.refresh() is None:
+                self._load_all(signature, sinks, progress)
+                return
+        # Nothing (more) to parse, but new sinks still need to see the rows
+        if sinks:
+            for chunk in self.iter_row_chunks():
+                for sink in sinks:
+                    sink.consume(chunk)
+
+    def _load_all(self, signature, sinks, progress):
+        restored = snapshot.load_patients(self.data_file, self.note_store) if signature is not None else None
+        if restored is not None:
+            patients, date_index, tombstones, end = restored
+            if progress is not None:
+                progress(date_index.total())
+            if sinks:
+                for chunk in self.iter_row_chunks():
+                    for sink in sinks:
+                        sink.consume(chunk)
+        else:
+            tombstones = patient_repository.load_tombstones(self.data_file)
+            date_index = VisitDateIndex()
+            patients = patient_repository.load_patient_data(self.data_file, self.note_store, date_index, sinks,
+                                                            progress)
+            snapshot.save_patients(self.data_file, patients, date_index, signature)
+            end = signature[0]
+            if patient_repository.file_signature(self.data_file) != signature or \
+                    not patient_repository.tail_bytes(self.data_file, end).endswith(b"\n"):
+                end = None  # changed while loading: the next refresh has to start over
+        with self._lock:
+            self.patients = patients
+            self.date_index = date_index
+            self.tombstones = tombstones
+            self.position = patient_repository.file_position(self.data_file, end) if end is not None else None
+            self.written_visits = set()
+            self.loaded_signature = signature
+            self.known_ids = None
+
+    def refresh(self):
+        """Add the rows other sessions appended since the model was loaded; returns how many.
+
+        Tombstones written since are applied too, and the note store picks up
+        appended notes. The cost is proportional to the new data. Returns
+        None, changing nothing, when only a full load() can catch up: the model
+        was never loaded, or the file was truncated, rewritten or replaced
+        (e.g. by compaction).
+        """
+        with self._lock:
+            if self.position is None or not patient_repository.unchanged_until(self.data_file, self.position):
+                return None
+            signature = patient_repository.file_signature(self.data_file)
+            offset = self.position[1]
+            tombstones = patient_repository.load_tombstones(self.data_file)
+            removed = []
+            for patient_id, tombstone in tombstones.items():
+                if tombstone <= self.tombstones.get(patient_id, -1):
+                    continue
+                if tombstone < offset:
+                    return None  # it hides some rows already read but not others; only a full load can tell
+                removed.append(patient_id)
+            for patient_id in removed:
+                patient = self.patients.pop(patient_id, None)
+                if patient is not None:
+                    self.date_index.remove_patient(patient)
+                    self.known_ids = None
+            self.tombstones = tombstones
+
+            added, end = patient_repository.add_appended_rows(self.data_file, offset, self.patients, self.note_store,
+                                                             self.date_index, tombstones, self.written_visits)
+            if added:
+                self.known_ids = None
+            self.position = patient_repository.file_position(self.data_file, end)
+            self.loaded_signature = signature
+        self.note_store.refresh()
+        return added
+
+    def load_notes(self):
+        """Index Notes.csv now rather than on the first note lookup."""
+        self.note_store.build_index()
+
+    def iter_row_chunks(self):
+        return patient_repository.iter_row_chunks(self.data_file)
+
+    def has_patient(self, patient_id):
+        return patient_id in self.patients
+
+    def get_patient(self, patient_id):
+        return self.patients.get(patient_id)
+
+    def add_visit(self, patient_id, visit, note):
+        with self._lock:
+            if patient_id not in self.patients:
+                self.patients[patient_id] = Patient(patient_id)
+            self.patients[patient_id].add_visit(visit)
+            self.date_index.add(visit.visit_time)
+            self._remember_ids(visit, note)
+            patient_repository.save_visit(self.data_file, patient_id, visit, note)
+            self.written_visits.add(visit.visit_id)  # already in memory; refresh() skips its row
+
+    def add_visits(self, entries):
+        """Add many (patient_id, visit, note, note_text) visits with one append to each file.
+
+        The note text goes to Notes.csv and the notes then read it from the
+        note store, so imported text is not held in memory.
+        """
+        with self._lock:
+            patient_repository.save_visits(self.data_file, [(pid, visit, note) for pid, visit, note, _ in entries])
+            patient_repository.save_notes(self.notes_file, [(pid, visit.visit_id, note.note_id, text)
+                                                            for pid, visit, note, text in entries])
+            self.note_store.refresh()
+            for patient_id, visit, note, _ in entries:
+                note.store = self.note_store
+                if patient_id not in self.patients:
+                    self.patients[patient_id] = Patient(patient_id)
+                self.patients[patient_id].add_visit(visit)
+                self.date_index.add(visit.visit_time)
+                self._remember_ids(visit, note)
+                self.written_visits.add(visit.visit_id)
+
+    def existing_ids(self, visit_ids, note_ids):
+        """Return which of the given Visit_IDs and Note_IDs are already stored."""
+        if self.known_ids is None:
+            known_visits, known_notes = set(), set()
+            for patient in self.patients.values():
+                for visit in patient.visits:
+                    known_visits.add(visit.visit_id)
+                    known_notes.update(note.note_id for note in visit.notes)
+            self.known_ids = (known_visits, known_notes)
+        known_visits, known_notes = self.known_ids
+        return ({visit_id for visit_id in visit_ids if visit_id in known_visits},
+                {note_id for note_id in note_ids if note_id in known_notes or note_id in self.note_store})
+
+    def _remember_ids(self, visit, note):
+        if self.known_ids is not None:
+            self.known_ids[0].add(visit.visit_id)
+            self.known_ids[1].add(note.note_id)
+
+    def remove_patient(self, patient_id):
+        """Remove a patient and all their visits; returns False if they don't exist."""
+        with self._lock:
+            self.refresh()  # catch up first, so the tombstone's offset leaves nothing unread
+            patient = self.patients.pop(patient_id, None)
+            if patient is None:
+                return False
+            self.date_index.remove_patient(patient)
+            self.known_ids = None
+            self.tombstones[patient_id] = patient_repository.remove_patient(self.data_file, patient_id)
+            return True
+
+    def compact(self):
+        """Rewrite the data file without removed rows once enough have built up; returns True if it did.
+
+        This reads and writes the whole file, so run it off the UI thread.
+        """
+        with self._lock:
+            if not patient_repository.compaction_due(self.data_file):
+                return False
+            self.refresh()  # catch up first, so the compacted file holds nothing unread
+            patient_repository.compact(self.data_file)
+            if self.position is not None:
+                # The new file holds exactly the rows in memory
+                self.position = patient_repository.file_position(self.data_file,
+                                                                 os.path.getsize(self.data_file))
+                self.tombstones = {}
+                self.written_visits = set()
+                self.loaded_signature = patient_repository.file_signature(self.data_file)
+            return True
+
+    def count_visits(self, day):
+        return self.date_index.count_on(day)
+
+    def count_visits_between(self, start, end):
+        return self.date_index.count_between(start, end)
+
+    def statistics_chunks(self):
+        """None: the statistics loader reads Patient_data.csv directly with its faster typed reader."""
+        return None
+
+    def visit_rollups(self):
+        """Visit trend rollups, catching up on rows appended since they were last read."""
+        self.rollups = load_rollups(self.data_file, self.rollups)
+        return self.rollups
+
+    def visit_cube(self):
+        """The visit data cube (see data_cube.py), catching up on rows appended since it was last saved."""
+        from data_cube import load_cube  # numpy/pandas load only when the cube is used
+        self.cube = load_cube(self.data_file, self.cube)
+        return self.cube
+
+    def close(self):
+        self.note_store.close()
+
+
+def open_storage(data_file, notes_file, db_file=None):
+    """Open the backend named by $HOSPITAL_STORAGE ("csv" by default, or "sqlite").
+
+    The SQLite database is imported from the CSV files the first time it is opened.
+    """
+    backend = os.environ.get(STORAGE_ENV, "csv").strip().lower()
+    if backend == "sqlite":
+        from sqlite_storage import SqliteStorage
+        storage = SqliteStorage(db_file or os.environ.get(DB_FILE_ENV, DEFAULT_DB_FILE))
+        if storage.is_empty():
+            storage.import_csv(data_file, notes_file)
+        return storage
+    if backend != "csv":
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return CsvStorage(data_file, notes_file)
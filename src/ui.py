@@ -1,11 +1,16 @@
 import tkinter as tk
 from tkinter import messagebox
 from users import authenticate_user
-from patients import Patient, Visit, Note
-from notes import load_notes
-from hospital_statistics import generate_statistics
+from patients import Visit, Note
+from storage import open_storage
+from patient_repository import PATIENT_FIELDS, visit_row
+from cohort import CohortIndex, CATEGORY_CRITERIA, CRITERIA_LABELS, parse_criteria
+from note_search import load_note_index, journal_note, journal_removal
+from usage_log import get_usage_logger
+import instrumentation
+from instrumentation import measure, timed
 from datetime import datetime
-import csv
+from concurrent.futures import ThreadPoolExecutor
 import tkinter.ttk as ttk
 from theme import UITheme
 
@@ -15,6 +20,12 @@ DATA_FILE = "Patient_data.csv"
 NOTES_FILE = "Notes.csv"
 CREDENTIALS_FILE = "Credentials.csv"
 LOG_FILE = "usage_log.csv"
+POLL_MS = 100
+REFRESH_MS = 5000  # how often rows other sessions append to the data file are picked up
+NOTE_PAGE_SIZE = 50  # visit/note rows per page in the patient viewer
+SEARCH_LIMIT = 500   # most recent matches shown by Search Notes
+COHORT_VISIT_LIMIT = 500  # most recent visits of a cohort shown by Show Visits
+
 
 class App:
     def __init__(self, root):
@@ -22,9 +33,25 @@ class App:
         UITheme.apply_theme(self.root)
         self.root.title("Hospital Clinical System")
         self.user = None
-        self.notes_dict = load_notes(NOTES_FILE)
-        self.patients = {}  # Will be populated after login
-        self.build_login()
+        self.storage = open_storage(DATA_FILE, NOTES_FILE)
+        self.stats_frame = None
+        self.statistics_job = None
+        self.usage_logger = get_usage_logger(LOG_FILE)
+        # Data loads in a worker thread; menu actions unlock as the stages they need become ready
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="data-loader")
+        self.load_jobs = []  # [(stage, future)] in submission order
+        self.ready = set()   # "visits", "notes", "search"
+        self.note_index = None
+        self.cohort_index = None  # built on the first cohort query
+        self.cohort_job = None
+        self.cohort_generation = 0  # bumped whenever the cohort index is dropped
+        self.rows_loaded = 0
+        self.action_buttons = []
+        self.status_label = None
+        self.root.protocol("WM_DELETE_WINDOW", self.exit_app)
+        self.build_login()  # no patient data is read until someone has logged in
+        self.refresh_job = None
+        self.root.after(REFRESH_MS, self.watch_data_file)
 
     def build_login(self):
         self.clear_root()
@@ -58,36 +85,158 @@ class App:
             self.show_menu()
 
     def load_patient_data(self):
-        self.patients = {}
-        try:
-            with open(DATA_FILE, newline='', encoding='utf-8') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    pid = row["Patient_ID"]
-                    if pid not in self.patients:
-                        self.patients[pid] = Patient(pid)
-
-                    visit = Visit(
-                        visit_id=row["Visit_ID"],
-                        visit_time=row["Visit_time"],
-                        department=row["Visit_department"],
-                        gender=row["Gender"],
-                        race=row["Race"],
-                        age=int(row["Age"]),
-                        ethnicity=row["Ethnicity"],
-                        insurance=row["Insurance"],
-                        zip_code=row["Zip_code"],
-                        chief_complaint=row["Chief_complaint"]
-                    )
-
-                    note_id = row["Note_ID"]
-                    note_type = row["Note_type"]
-                    note_text = self.notes_dict[note_id].note_text if note_id in self.notes_dict else ""
-                    note = Note(note_id, note_type, note_text)
-                    visit.add_note(note)
-                    self.patients[pid].add_visit(visit)
-        except FileNotFoundError:
-            messagebox.showerror("Error", f"{DATA_FILE} not found.")
+        # Re-logins reuse the data already loaded unless the file has changed on disk
+        self.stats_frame = None
+        self.drop_cohort_index()
+        self.ready.discard("visits")
+        if not self.load_jobs:
+            self.root.after(POLL_MS, self.poll_loading)
+        if not self.user.needs_visit_rows():
+            self.load_jobs.append(("visits", self.loader.submit(self.storage.visit_rollups)))
+            return
+        wants_stats = self.user.can_generate_stats()
+
+        def load_visits():
+            stats_builder = None
+            if wants_stats:
+                # pandas/matplotlib load here, on the loader thread, and only for users who can run statistics
+                from hospital_statistics import StatisticsFrameBuilder
+                stats_builder = StatisticsFrameBuilder()
+            self.storage.load([stats_builder] if stats_builder else [], self.report_progress)
+            return stats_builder.frame() if stats_builder else None
+
+        self.load_jobs.append(("visits", self.loader.submit(load_visits)))
+        if not self.user.can_view_notes():
+            return  # the notes corpus is only read for roles that can see it
+        if "notes" not in self.ready and all(stage != "notes" for stage, _ in self.load_jobs):
+            self.load_jobs.append(("notes", self.loader.submit(self.storage.load_notes)))
+        if "search" not in self.ready and all(stage != "search" for stage, _ in self.load_jobs):
+            self.load_jobs.append(("search", self.loader.submit(self.load_search_index)))
+
+    def load_search_index(self):
+        self.note_index = load_note_index(NOTES_FILE, DATA_FILE)
+
+    def index_note(self, pid, visit, note):
+        # Runs on the loader thread, so it always follows the job that loads the index
+        if self.note_index is not None:
+            self.note_index.add_note(note.note_id, pid, visit.visit_time, note.note_text)
+        else:
+            journal_note(NOTES_FILE, note.note_id, pid, visit.visit_time, note.note_text)
+
+    def unindex_patient(self, pid):
+        if self.note_index is not None:
+            self.note_index.remove_patient(pid)
+        else:
+            journal_removal(NOTES_FILE, pid)
+
+    def watch_data_file(self):
+        """Every REFRESH_MS, read in what other sessions appended since the last look."""
+        if self.refresh_job is not None and self.refresh_job.done():
+            try:
+                if self.refresh_job.result():
+                    self.stats_frame = None  # rebuilt from the current rows when next needed
+                    self.drop_cohort_index()
+            except Exception as e:
+                print(f"Could not refresh {DATA_FILE}: {e}")
+            self.refresh_job = None
+        if self.refresh_job is None and "visits" in self.ready and not self.load_jobs:
+            self.refresh_job = self.loader.submit(self.refresh_data)
+        self.root.after(REFRESH_MS, self.watch_data_file)
+
+    def refresh_data(self):
+        # Runs on the loader thread; returns True if the rows in memory changed
+        with measure("refresh_data"):
+            if not self.user.needs_visit_rows():
+                self.storage.visit_rollups()  # keeps the saved counts current without loading any rows
+                return False
+            if self.note_index is not None:
+                self.note_index.replay_journal()
+            changed = self.storage.refresh()
+            if changed is None:  # truncated or rewritten, e.g. compacted by another session
+                self.storage.load()
+                return True
+            return changed > 0
+
+    def build_cohort_index(self, then):
+        """Index every visit on the loader thread, then call then() on the Tk thread."""
+        if self.cohort_job is not None:
+            return
+        generation = self.cohort_generation
+        self.cohort_job = self.loader.submit(lambda: CohortIndex.build(self.storage.iter_row_chunks()))
+
+        def poll():
+            if not self.cohort_job.done():
+                self.root.after(POLL_MS, poll)
+                return
+            job, self.cohort_job = self.cohort_job, None
+            try:
+                index = job.result()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to index visits: {e}")
+                return
+            if generation != self.cohort_generation:
+                self.build_cohort_index(then)  # the data changed while indexing
+                return
+            self.cohort_index = index
+            then()
+
+        self.root.after(POLL_MS, poll)
+
+    def update_cohort_index(self, change):
+        """Apply one of this session's own writes to the cohort index, on the loader thread.
+
+        An index still being built may or may not see the write, so it is
+        discarded instead and rebuilt on the next query.
+        """
+        if self.cohort_index is not None:
+            self.loader.submit(change, self.cohort_index)
+        else:
+            self.drop_cohort_index()
+
+    def drop_cohort_index(self):
+        self.cohort_index = None
+        self.cohort_generation += 1
+
+    def report_progress(self, rows):
+        # Called from the loader thread; poll_loading picks the value up on the Tk thread
+        self.rows_loaded = rows
+
+    def poll_loading(self):
+        while self.load_jobs and self.load_jobs[0][1].done():
+            stage, job = self.load_jobs.pop(0)
+            try:
+                result = job.result()
+            except FileNotFoundError:
+                messagebox.showerror("Error", f"{DATA_FILE} not found.")
+                result = None
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load {stage}: {e}")
+                result = None
+            if stage == "visits" and self.user.can_generate_stats() and result is not None:
+                self.stats_frame = result
+            if all(pending != stage for pending, _ in self.load_jobs):
+                self.ready.add(stage)
+        self.update_actions()
+        if self.load_jobs:
+            self.root.after(POLL_MS, self.poll_loading)
+
+    def update_actions(self):
+        for button, needs in self.action_buttons:
+            if button.winfo_exists():
+                button.state(["!disabled"] if needs <= self.ready else ["disabled"])
+        if self.status_label is not None and self.status_label.winfo_exists():
+            pending = {stage for stage, _ in self.load_jobs}
+            if "visits" not in self.ready and not self.user.needs_visit_rows():
+                status = "Loading visit counts..."
+            elif "visits" not in self.ready:
+                status = f"Loading patient data... {self.rows_loaded:,} visits read"
+            elif "notes" in pending:
+                status = "Loading notes..."
+            elif "search" in pending:
+                status = "Loading note search index..."
+            else:
+                status = ""
+            self.status_label.config(text=status)
 
     def show_menu(self):
         self.clear_root()
@@ -102,31 +251,44 @@ class App:
             bg=UITheme.BG_COLOR
         ).pack(pady=15)
 
+        self.status_label = tk.Label(self.root, text="", font=UITheme.FONT, bg=UITheme.BG_COLOR)
+        self.status_label.pack()
+
         button_frame = tk.Frame(self.root, bg=UITheme.BG_COLOR)
         button_frame.pack()
+        self.action_buttons = []
 
-        def styled_button(label, cmd):
-            ttk.Button(
+        def styled_button(label, cmd, needs=()):
+            button = ttk.Button(
                 button_frame,
                 text=label,
                 command=cmd,
                 style=UITheme.BUTTON_STYLE
-            ).pack(pady=6, ipadx=10, ipady=5)
+            )
+            button.pack(pady=6, ipadx=10, ipady=5)
+            self.action_buttons.append((button, set(needs)))
 
         if self.user.role == "admin":
-            styled_button("Count Visits", self.count_visits)
+            styled_button("Count Visits", self.count_visits, needs=["visits"])
 
         elif self.user.role == "management":
-            styled_button("Generate Statistics", self.run_statistics)
+            styled_button("Generate Statistics", self.run_statistics, needs=["visits"])
+            styled_button("Explore Visits", self.explore_visits, needs=["visits"])
+            styled_button("Cohort Query", self.cohort_query, needs=["visits"])
 
         else:  # clinician or nurse
-            styled_button("Retrieve Patient", self.retrieve_patient)
-            styled_button("Add Patient", self.add_patient)
-            styled_button("Remove Patient", self.remove_patient)
-            styled_button("Count Visits", self.count_visits)
-            styled_button("View Note", self.view_note)
-
-        styled_button("Exit", self.root.destroy)
+            styled_button("Retrieve Patient", self.retrieve_patient, needs=["visits", "notes"])
+            styled_button("Add Patient", self.add_patient, needs=["visits"])
+            styled_button("Remove Patient", self.remove_patient, needs=["visits"])
+            styled_button("Count Visits", self.count_visits, needs=["visits"])
+            styled_button("View Note", self.view_note, needs=["visits", "notes"])
+            styled_button("Search Notes", self.search_notes, needs=["visits", "search"])
+            styled_button("Cohort Query", self.cohort_query, needs=["visits"])
+
+        if instrumentation.enabled():
+            styled_button("Diagnostics", self.show_diagnostics)
+        styled_button("Exit", self.exit_app)
+        self.update_actions()
         
     def count_visits(self):
         self.clear_root()
@@ -137,15 +299,11 @@ class App:
         def run_count():
             try:
                 target_date = datetime.strptime(date_entry.get(), "%Y-%m-%d").date()
-                count = 0
-                for p in self.patients.values():
-                    for v in p.visits:
-                        try:
-                            visit_date = datetime.strptime(v.visit_time.strip(), "%m/%d/%Y").date()
-                            if visit_date == target_date:
-                                count += 1
-                        except ValueError:
-                            continue
+                with measure("ui.count_visits"):
+                    if self.user.needs_visit_rows():
+                        count = self.storage.count_visits(target_date)
+                    else:
+                        count = self.storage.visit_rollups().count_on(target_date)
                 messagebox.showinfo("Result", f"Total visits on {target_date}: {count}")
                 self.log_usage(self.user.username, self.user.role, f"count_visits: {target_date}")
                 self.show_menu()
@@ -155,7 +313,30 @@ class App:
         tk.Button(self.root, text="Submit", command=run_count).pack()
 
     def run_statistics(self):
-        generate_statistics(DATA_FILE)
+        if self.statistics_job is not None:
+            messagebox.showinfo("Info", "Statistics are already being generated.")
+            return
+        from hospital_statistics import generate_statistics_async  # already imported by the visits load
+
+        # Rendering and the rollup refresh run in the background; poll for completion instead of blocking Tk
+        self.statistics_job = generate_statistics_async(DATA_FILE, self.stats_frame,
+                                                       chunks=self.storage.statistics_chunks(),
+                                                       rollups=self.storage.visit_rollups)
+        self.root.after(100, self.poll_statistics)
+
+    def poll_statistics(self):
+        if not self.statistics_job.done():
+            self.root.after(100, self.poll_statistics)
+            return
+        job, self.statistics_job = self.statistics_job, None
+        self.on_statistics_done(job)
+
+    def on_statistics_done(self, job):
+        try:
+            job.result()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to generate statistics: {e}")
+            return
         messagebox.showinfo("Done", "Statistics generated and saved as image files.")
         self.log_usage(self.user.username, self.user.role, "generate_statistics")
 
@@ -167,9 +348,45 @@ class App:
             widget.destroy()
 
     def log_usage(self, username, role, action):
-        with open(LOG_FILE, mode='a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([username, role, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), action])
+        self.usage_logger.log(username, role, action)
+
+    def show_diagnostics(self):
+        """Per-operation latency and row counts recorded so far in this session."""
+        self.clear_root()
+        self.root.geometry("900x500")
+        self.root.configure(bg=UITheme.BG_COLOR)
+        tk.Label(self.root, text="Diagnostics", font=UITheme.TITLE_FONT, bg=UITheme.BG_COLOR).pack(pady=10)
+
+        columns = ("operation", "calls", "errors", "p50", "p95", "max", "rows")
+        headings = ("Operation", "Calls", "Errors", "p50 (ms)", "p95 (ms)", "Max (ms)", "Rows")
+        tree = ttk.Treeview(self.root, columns=columns, show="headings", height=15)
+        for column, heading in zip(columns, headings):
+            tree.heading(column, text=heading)
+            tree.column(column, width=240 if column == "operation" else 90)
+        tree.pack(fill="both", expand=True, padx=10)
+
+        def refresh():
+            tree.delete(*tree.get_children())
+            for name, stats in instrumentation.metrics.snapshot().items():
+                tree.insert("", "end", values=(
+                    name, stats["count"], stats["errors"], f"{stats['p50_s'] * 1000:.1f}",
+                    f"{stats['p95_s'] * 1000:.1f}", f"{stats['max_s'] * 1000:.1f}", f"{stats['rows']:,}"
+                ))
+
+        buttons = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        buttons.pack(pady=10)
+        ttk.Button(buttons, text="Refresh", style=UITheme.BUTTON_STYLE, command=refresh).pack(side="left", padx=5)
+        ttk.Button(buttons, text="Back", style=UITheme.BUTTON_STYLE, command=self.show_menu).pack(side="left", padx=5)
+        tk.Label(self.root, text=f"Written to {instrumentation.metrics.path} on exit", font=UITheme.FONT,
+                 bg=UITheme.BG_COLOR).pack()
+        refresh()
+
+    def exit_app(self):
+        self.usage_logger.close()  # flush pending log rows before the window goes away
+        if instrumentation.enabled():
+            instrumentation.metrics.close()
+        self.loader.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
 
     def add_patient(self):
         self.clear_root()
@@ -208,15 +425,12 @@ class App:
                 note = Note(note_id, note_type, note_text)
                 visit.add_note(note)
 
-                if pid not in self.patients:
-                    self.patients[pid] = Patient(pid)
-                self.patients[pid].add_visit(visit)
-
-                with open(DATA_FILE, mode='a', newline='', encoding='utf-8') as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerow([
-                        pid, visit_id, visit_time, dept, race, gender, ethnicity, age, zip_code, insurance, complaint, note_id, note_type
-                    ])
+                with measure("ui.add_patient"):
+                    self.storage.add_visit(pid, visit, note)
+                    self.loader.submit(self.index_note, pid, visit, note)
+                    row = dict(zip(PATIENT_FIELDS, visit_row(pid, visit, note)))
+                    self.update_cohort_index(lambda index: index.consume([row]))
+                self.stats_frame = None
 
                 self.log_usage(self.user.username, self.user.role, f"add_patient: {pid}")
                 messagebox.showinfo("Success", "Patient added successfully.")
@@ -245,33 +459,22 @@ class App:
 
         def submit():
             pid = pid_entry.get().strip()
-            if pid not in self.patients:
+            with measure("ui.retrieve_patient"):
+                patient = self.storage.get_patient(pid)
+            if patient is None:
                 messagebox.showerror("Not Found", f"Patient {pid} does not exist.")
                 self.log_usage(self.user.username, self.user.role, f"retrieve_patient: {pid} NOT_FOUND")
                 self.show_menu()
                 return
 
-            patient = self.patients[pid]
             if not patient.visits:
                 messagebox.showinfo("No Visits", f"Patient {pid} has no visits.")
                 return
 
-            recent_visit = max(patient.visits, key=lambda v: datetime.strptime(v.visit_time.strip(), "%m/%d/%Y"))
+            recent_visit = patient.latest_visit()
 
-            info = f"Patient ID: {pid}\nVisit Date: {recent_visit.visit_time}\nDept: {recent_visit.department}\n"
-            info += f"Gender: {recent_visit.gender}, Race: {recent_visit.race}, Age: {recent_visit.age}\n"
-            info += f"Ethnicity: {recent_visit.ethnicity}, Insurance: {recent_visit.insurance}, Zip: {recent_visit.zip_code}\n"
-            info += f"Chief Complaint: {recent_visit.chief_complaint}\n\nNotes:\n"
-
-            if recent_visit.notes:
-                for note in recent_visit.notes:
-                    info += f"- [{note.note_type}] {note.note_text}\n"
-            else:
-                info += "No notes available."
-
-            messagebox.showinfo("Patient Info", info)
             self.log_usage(self.user.username, self.user.role, f"retrieve_patient: {pid}")
-            self.show_menu()
+            self.show_visits(f"Patient {pid}: most recent visit", [recent_visit])
 
         ttk.Button(
             self.root,
@@ -290,31 +493,348 @@ class App:
 
         def submit():
             pid = pid_entry.get().strip()
+            with measure("ui.view_note"):
+                patient = self.storage.get_patient(pid)
 
-            if pid not in self.patients:
+            if patient is None:
                 messagebox.showerror("Not Found", f"Patient {pid} not found.")
                 self.log_usage(self.user.username, self.user.role, f"view_note: {pid} NOT_FOUND")
                 self.show_menu()
                 return
 
-            patient = self.patients[pid]
-            notes = []
-
-            for visit in patient.visits:
-                for note in visit.notes:
-                    notes.append(f"[{note.note_type}] {note.note_text} (Date: {visit.visit_time})")
-
-            if not notes:
+            if not any(visit.notes for visit in patient.visits):
                 messagebox.showinfo("Notes", f"No notes available for Patient {pid}.")
-            else:
-                note_text = f"All Notes for {pid}:\n\n" + "\n".join(notes)
-                messagebox.showinfo("Notes", note_text)
+                self.log_usage(self.user.username, self.user.role, f"view_note: {pid}")
+                self.show_menu()
+                return
 
             self.log_usage(self.user.username, self.user.role, f"view_note: {pid}")
-            self.show_menu()
+            self.show_visits(f"All notes for patient {pid}", patient.visits)
 
         ttk.Button(self.root, text="Submit", command=submit, style=UITheme.BUTTON_STYLE).pack(pady=10)
 
+    @timed("ui.show_visits")
+    def show_visits(self, title, visits):
+        """Page through visits and their notes in a table.
+
+        Only the current page is inserted into the Treeview, and a note's text
+        is read from the note store when its row is selected, so large
+        histories cost no more to show than small ones.
+        """
+        self.clear_root()
+        self.root.geometry("900x600")
+        self.root.configure(bg=UITheme.BG_COLOR)
+        tk.Label(self.root, text=title, font=UITheme.TITLE_FONT, bg=UITheme.BG_COLOR).pack(pady=10)
+
+        # References only; nothing is formatted until its page is shown
+        rows = [(visit, note) for visit in visits for note in (visit.notes or [None])]
+        page_count = max((len(rows) + NOTE_PAGE_SIZE - 1) // NOTE_PAGE_SIZE, 1)
+        page = 0
+
+        columns = ("date", "department", "complaint", "note_type", "note_id")
+        headings = ("Visit Date", "Department", "Chief Complaint", "Note Type", "Note ID")
+        table_frame = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        table_frame.pack(fill="x", padx=10)
+        tree = ttk.Treeview(table_frame, columns=columns, show="headings", height=12, selectmode="browse")
+        for column, heading in zip(columns, headings):
+            tree.heading(column, text=heading)
+            tree.column(column, width=160)
+        scrollbar = ttk.Scrollbar(table_frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side="left", fill="x", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+        nav_frame = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        nav_frame.pack(pady=5)
+        page_label = tk.Label(nav_frame, font=UITheme.FONT, bg=UITheme.BG_COLOR)
+
+        details = tk.Label(self.root, font=UITheme.FONT, bg=UITheme.BG_COLOR, justify="left", anchor="w")
+        details.pack(fill="x", padx=10)
+        text_frame = tk.Frame(self.root)
+        text_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        note_body = tk.Text(text_frame, wrap="word", font=UITheme.FONT, height=10, state="disabled")
+        text_scrollbar = ttk.Scrollbar(text_frame, orient="vertical", command=note_body.yview)
+        note_body.configure(yscrollcommand=text_scrollbar.set)
+        note_body.pack(side="left", fill="both", expand=True)
+        text_scrollbar.pack(side="right", fill="y")
+
+        @timed("ui.show_visits.page")
+        def show_page(new_page):
+            nonlocal page
+            page = min(max(new_page, 0), page_count - 1)
+            tree.delete(*tree.get_children())
+            start = page * NOTE_PAGE_SIZE
+            for index, (visit, note) in enumerate(rows[start:start + NOTE_PAGE_SIZE], start):
+                tree.insert("", "end", iid=str(index), values=(
+                    visit.visit_time, visit.department, visit.chief_complaint,
+                    note.note_type if note else "", note.note_id if note else ""
+                ))
+            page_label.config(text=f"Page {page + 1} of {page_count}")
+            children = tree.get_children()
+            if children:
+                tree.selection_set(children[0])
+
+        def show_selected(event=None):
+            selection = tree.selection()
+            if not selection:
+                return
+            visit, note = rows[int(selection[0])]
+            with measure("ui.show_visits.note"):
+                text = note.note_text if note else "No notes available."
+            details.config(text=(
+                f"Visit {visit.visit_id} on {visit.visit_time} in {visit.department}\n"
+                f"Gender: {visit.gender}, Race: {visit.race}, Age: {visit.age}, Ethnicity: {visit.ethnicity}\n"
+                f"Insurance: {visit.insurance}, Zip: {visit.zip_code}, Chief Complaint: {visit.chief_complaint}"
+            ))
+            note_body.config(state="normal")
+            note_body.delete("1.0", "end")
+            note_body.insert("1.0", text)
+            note_body.config(state="disabled")
+
+        tree.bind("<<TreeviewSelect>>", show_selected)
+        ttk.Button(nav_frame, text="< Previous", style=UITheme.BUTTON_STYLE,
+                   command=lambda: show_page(page - 1)).pack(side="left", padx=5)
+        page_label.pack(side="left", padx=10)
+        ttk.Button(nav_frame, text="Next >", style=UITheme.BUTTON_STYLE,
+                   command=lambda: show_page(page + 1)).pack(side="left", padx=5)
+        ttk.Button(self.root, text="Back", style=UITheme.BUTTON_STYLE, command=self.show_menu).pack(pady=10)
+        show_page(0)
+
+    def search_notes(self):
+        self.clear_root()
+        self.root.geometry("900x650")
+        self.root.configure(bg=UITheme.BG_COLOR)
+
+        form = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        form.pack(pady=10)
+        labels = ["Search (words, \"phrase\", OR, -exclude)", "Patient ID (optional)",
+                  "From (YYYY-MM-DD, optional)", "To (YYYY-MM-DD, optional)"]
+        entries = []
+        for idx, label in enumerate(labels):
+            tk.Label(form, text=label, font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(row=idx, column=0, sticky="e", pady=4, padx=6)
+            entry = tk.Entry(form, font=UITheme.FONT, width=40)
+            entry.grid(row=idx, column=1, pady=4, padx=6)
+            entries.append(entry)
+        query_entry, pid_entry, start_entry, end_entry = entries
+
+        columns = ("date", "patient", "note_id")
+        tree = ttk.Treeview(self.root, columns=columns, show="headings", height=10, selectmode="browse")
+        for column, heading in zip(columns, ("Visit Date", "Patient ID", "Note ID")):
+            tree.heading(column, text=heading)
+            tree.column(column, width=200)
+        summary = tk.Label(self.root, font=UITheme.FONT, bg=UITheme.BG_COLOR)
+        note_body = tk.Text(self.root, wrap="word", font=UITheme.FONT, height=10, state="disabled")
+        results = []
+
+        def parse_date(entry):
+            value = entry.get().strip()
+            return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+        def run_search():
+            query = query_entry.get().strip()
+            try:
+                start, end = parse_date(start_entry), parse_date(end_entry)
+            except ValueError:
+                messagebox.showerror("Error", "Invalid date format. Use YYYY-MM-DD.")
+                return
+            pid = pid_entry.get().strip() or None
+            with measure("ui.search_notes") as m:
+                matches = self.note_index.search(query, patient_id=pid, start=start, end=end, limit=SEARCH_LIMIT)
+                results[:] = [match for match in matches if self.storage.has_patient(match[1])]
+                tree.delete(*tree.get_children())
+                for index, (note_id, patient_id, visit_date) in enumerate(results):
+                    tree.insert("", "end", iid=str(index), values=(visit_date or "", patient_id, note_id))
+                m.rows = len(results)
+            summary.config(text=f"{len(results)} matching notes" + (" (most recent shown)" if len(results) == SEARCH_LIMIT else ""))
+            self.log_usage(self.user.username, self.user.role, f"search_notes: {query}")
+
+        def show_selected(event=None):
+            selection = tree.selection()
+            if not selection:
+                return
+            note_id, patient_id, _ = results[int(selection[0])]
+            text = self.storage.note_store.get_text(note_id) if self.storage.has_patient(patient_id) else ""
+            note_body.config(state="normal")
+            note_body.delete("1.0", "end")
+            note_body.insert("1.0", text)
+            note_body.config(state="disabled")
+
+        tree.bind("<<TreeviewSelect>>", show_selected)
+        ttk.Button(form, text="Search", style=UITheme.BUTTON_STYLE, command=run_search).grid(
+            row=len(labels), column=0, columnspan=2, pady=10
+        )
+        summary.pack()
+        tree.pack(fill="x", padx=10)
+        note_body.pack(fill="both", expand=True, padx=10, pady=5)
+        ttk.Button(self.root, text="Back", style=UITheme.BUTTON_STYLE, command=self.show_menu).pack(pady=10)
+
+    def cohort_query(self):
+        self.clear_root()
+        self.root.geometry("900x750")
+        self.root.configure(bg=UITheme.BG_COLOR)
+        tk.Label(self.root, text="Cohort Query", font=UITheme.TITLE_FONT, bg=UITheme.BG_COLOR).pack(pady=10)
+
+        form = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        form.pack()
+        entries = {}
+        for idx, (criterion, label) in enumerate(CRITERIA_LABELS.items()):
+            tk.Label(form, text=label, font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(row=idx, column=0, sticky="e", pady=3, padx=6)
+            entry = tk.Entry(form, font=UITheme.FONT, width=40)
+            entry.grid(row=idx, column=1, pady=3, padx=6)
+            entries[criterion] = entry
+        tk.Label(form, text="Break down by", font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(
+            row=len(entries), column=0, sticky="e", pady=3, padx=6)
+        breakdown_box = ttk.Combobox(form, values=list(CATEGORY_CRITERIA), state="readonly", width=37)
+        breakdown_box.set("department")
+        breakdown_box.grid(row=len(entries), column=1, pady=3, padx=6)
+        tk.Label(form, text="Separate alternatives with commas; leave a field blank to match anything.",
+                 font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(row=len(entries) + 1, column=0, columnspan=2)
+
+        buttons = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        buttons.pack(pady=8)
+        summary = tk.Label(self.root, font=UITheme.FONT, bg=UITheme.BG_COLOR)
+        summary.pack()
+        columns = ("value", "visits", "share")
+        tree = ttk.Treeview(self.root, columns=columns, show="headings", height=10)
+        for column, heading in zip(columns, ("Value", "Visits", "Share")):
+            tree.heading(column, text=heading)
+            tree.column(column, width=200)
+        tree.pack(fill="x", padx=10, pady=5)
+        cohort = None
+
+        def run_query():
+            nonlocal cohort
+            fields = {criterion: entry.get() for criterion, entry in entries.items()}
+            try:
+                criteria = parse_criteria(fields)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            if self.cohort_index is None:
+                summary.config(text="Indexing visits...")
+                self.build_cohort_index(lambda: run_query() if summary.winfo_exists() else None)
+                return
+            with measure("ui.cohort_query") as m:
+                cohort = self.cohort_index.select(criteria)
+                visits = cohort.bit_count()
+                tree.delete(*tree.get_children())
+                for value, count in self.cohort_index.breakdown(cohort, breakdown_box.get()):
+                    tree.insert("", "end", values=(value or "(blank)", f"{count:,}", f"{count / visits:.1%}"))
+                m.rows = visits
+            summary.config(text=f"{visits:,} visits by {self.cohort_index.patient_count(cohort):,} patients")
+            description = ", ".join(f"{criterion}={text.strip()}" for criterion, text in fields.items() if text.strip())
+            self.log_usage(self.user.username, self.user.role, f"cohort_query: {description or 'all'}")
+
+        def show_cohort_visits():
+            if not cohort:
+                messagebox.showinfo("Info", "Run a query with at least one matching visit first.")
+                return
+            visits = []
+            for patient_id, visit_id, _ in self.cohort_index.visits(cohort, limit=COHORT_VISIT_LIMIT):
+                patient = self.storage.get_patient(patient_id)
+                visits.extend(visit for visit in (patient.visits if patient else []) if visit.visit_id == visit_id)
+            self.show_visits(f"Cohort visits ({len(visits):,} most recent of {cohort.bit_count():,})", visits)
+
+        ttk.Button(buttons, text="Run", style=UITheme.BUTTON_STYLE, command=run_query).pack(side="left", padx=5)
+        if self.user.can_access_phi():
+            ttk.Button(buttons, text="Show Visits", style=UITheme.BUTTON_STYLE,
+                       command=show_cohort_visits).pack(side="left", padx=5)
+        ttk.Button(buttons, text="Back", style=UITheme.BUTTON_STYLE, command=self.show_menu).pack(side="left", padx=5)
+
+    def explore_visits(self):
+        # The visits load has already imported pandas for management users, so this import is cheap
+        from data_cube import AXES, MONTH_ROLLUPS, parse_filters
+
+        self.clear_root()
+        self.root.geometry("1000x750")
+        self.root.configure(bg=UITheme.BG_COLOR)
+        tk.Label(self.root, text="Explore Visits", font=UITheme.TITLE_FONT, bg=UITheme.BG_COLOR).pack(pady=10)
+
+        form = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        form.pack()
+        groupings = AXES + list(MONTH_ROLLUPS)
+        tk.Label(form, text="Rows", font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(row=0, column=0, sticky="e", pady=3, padx=6)
+        rows_box = ttk.Combobox(form, values=groupings, state="readonly", width=37)
+        rows_box.set("Department")
+        rows_box.grid(row=0, column=1, pady=3, padx=6)
+        tk.Label(form, text="Columns", font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(row=1, column=0, sticky="e", pady=3, padx=6)
+        columns_box = ttk.Combobox(form, values=["(none)"] + groupings, state="readonly", width=37)
+        columns_box.set("Gender")
+        columns_box.grid(row=1, column=1, pady=3, padx=6)
+        entries = {}
+        for idx, dimension in enumerate(AXES, 2):
+            label = "Months (e.g. Q3 2016, 2016-07 to 2016-09)" if dimension == "Month" else dimension
+            tk.Label(form, text=label, font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(row=idx, column=0, sticky="e", pady=3, padx=6)
+            entry = tk.Entry(form, font=UITheme.FONT, width=40)
+            entry.grid(row=idx, column=1, pady=3, padx=6)
+            entries[dimension] = entry
+        tk.Label(form, text="Separate alternatives with commas; leave a filter blank to include everything.",
+                 font=UITheme.FONT, bg=UITheme.BG_COLOR).grid(row=len(AXES) + 2, column=0, columnspan=2)
+
+        buttons = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        buttons.pack(pady=8)
+        summary = tk.Label(self.root, font=UITheme.FONT, bg=UITheme.BG_COLOR)
+        summary.pack()
+        table_frame = tk.Frame(self.root, bg=UITheme.BG_COLOR)
+        table_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        tree = ttk.Treeview(table_frame, show="headings", height=12)
+        x_scrollbar = ttk.Scrollbar(table_frame, orient="horizontal", command=tree.xview)
+        tree.configure(xscrollcommand=x_scrollbar.set)
+        x_scrollbar.pack(side="bottom", fill="x")
+        tree.pack(fill="both", expand=True)
+        cube_job = None
+
+        def run_query():
+            nonlocal cube_job
+            try:
+                filters = parse_filters({dimension: entry.get() for dimension, entry in entries.items()})
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            if cube_job is None:
+                # The cube is brought up to date once per visit to this screen, on the loader thread
+                cube_job = self.loader.submit(self.storage.visit_cube)
+            if not cube_job.done():
+                summary.config(text="Counting visits...")
+                self.root.after(POLL_MS, lambda: run_query() if summary.winfo_exists() else None)
+                return
+            try:
+                cube = cube_job.result()
+            except Exception as e:
+                cube_job = None
+                messagebox.showerror("Error", f"Failed to load the visit cube: {e}")
+                return
+
+            rows, columns = rows_box.get(), columns_box.get()
+            try:
+                with measure("ui.explore_visits") as m:
+                    if columns == "(none)":
+                        table = cube.query([rows], filters).to_frame()
+                    else:
+                        table = cube.crosstab(rows, columns, filters)
+                    m.rows = len(table)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            headings = [rows] + [str(label) for label in table.columns] + (["Total"] if columns != "(none)" else [])
+            tree.delete(*tree.get_children())
+            tree.configure(columns=[str(i) for i in range(len(headings))])
+            for i, heading in enumerate(headings):
+                tree.heading(str(i), text=heading)
+                tree.column(str(i), width=160 if i == 0 else 90, stretch=False)
+            for label, counts in table.iterrows():
+                values = [int(count) for count in counts]
+                tree.insert("", "end", values=[label] + [f"{value:,}" for value in values] +
+                            ([f"{sum(values):,}"] if columns != "(none)" else []))
+            summary.config(text=f"{int(table.to_numpy().sum()):,} visits")
+            description = ", ".join(f"{dimension}={entry.get().strip()}" for dimension, entry in entries.items()
+                                    if entry.get().strip())
+            self.log_usage(self.user.username, self.user.role,
+                           f"explore_visits: {rows} x {columns}" + (f" where {description}" if description else ""))
+
+        ttk.Button(buttons, text="Run", style=UITheme.BUTTON_STYLE, command=run_query).pack(side="left", padx=5)
+        ttk.Button(buttons, text="Back", style=UITheme.BUTTON_STYLE, command=self.show_menu).pack(side="left", padx=5)
+
     def remove_patient(self):
         self.clear_root()
         self.root.configure(bg=UITheme.BG_COLOR)
@@ -325,7 +845,7 @@ class App:
 
         def submit():
             pid = pid_entry.get().strip()
-            if pid not in self.patients:
+            if not self.storage.has_patient(pid):
                 messagebox.showerror("Not Found", f"Patient {pid} does not exist.")
                 self.log_usage(self.user.username, self.user.role, f"remove_patient: {pid} NOT_FOUND")
                 self.show_menu()
@@ -333,17 +853,12 @@ class App:
 
             # Confirm removal
             if messagebox.askyesno("Confirm Removal", f"Are you sure you want to remove patient {pid}?"):
-                # Remove from memory
-                del self.patients[pid]
-
-                # Remove from CSV by rewriting the data (excluding the patient)
-                with open(DATA_FILE, mode='r', newline='', encoding='utf-8') as infile:
-                    reader = csv.reader(infile)
-                    rows = [row for row in reader if row[0] != pid]
-
-                with open(DATA_FILE, mode='w', newline='', encoding='utf-8') as outfile:
-                    writer = csv.writer(outfile)
-                    writer.writerows(rows)
+                with measure("ui.remove_patient"):
+                    self.storage.remove_patient(pid)
+                    self.loader.submit(self.unindex_patient, pid)
+                    self.loader.submit(self.storage.compact)  # rewrites the file once enough removals build up
+                    self.update_cohort_index(lambda index: index.remove_patient(pid))
+                self.stats_frame = None
 
                 self.log_usage(self.user.username, self.user.role, f"remove_patient: {pid}")
                 messagebox.showinfo("Success", f"Patient {pid} removed successfully.")
@@ -0,0 +1,223 @@
+import argparse
+import csv
+import json
+import os
+from collections import Counter, deque
+from datetime import datetime
+
+LOG_FILE = "usage_log.csv"
+STATE_FILE = "usage_analytics_state.json"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+BURST_WINDOW = 300    # seconds
+BURST_THRESHOLD = 5   # failed logins within BURST_WINDOW that count as a burst
+
+
+def action_name(action):
+    """"retrieve_patient: 123 NOT_FOUND" -> "retrieve_patient"."""
+    return action.split(":", 1)[0].strip()
+
+
+class UsageAnalyzer:
+    """Streaming aggregates over usage_log.csv.
+
+    Memory grows with the number of users, roles and action names, never with
+    the number of log lines. The state, including the byte offset reached,
+    can be saved and reloaded so that each run only reads lines appended
+    since the previous one.
+    """
+
+    def __init__(self):
+        self.user_actions = Counter()
+        self.user_span = {}          # username -> [first timestamp, last timestamp]
+        self.user_roles = {}
+        self.role_actions = Counter()
+        self.role_span = {}          # role -> [first timestamp, last timestamp]
+        self.hourly_actions = Counter()  # (hour of day, action name) -> count
+        self.failures = {}           # username -> recent failed-login timestamps
+        self.bursts = []             # [username, first failure, failures in window]
+        self.lines = 0
+        self.inode = None
+        self.offset = 0
+
+    def add(self, username, role, timestamp, action):
+        try:
+            when = datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp()
+        except ValueError:
+            return
+        self.lines += 1
+
+        if action == "LOGIN_FAILED":
+            self._record_failure(username, when)
+            return
+
+        self.user_actions[username] += 1
+        _widen(self.user_span, username, when)
+        self.user_roles[username] = role
+        self.role_actions[role] += 1
+        _widen(self.role_span, role, when)
+        self.hourly_actions[datetime.fromtimestamp(when).hour, action_name(action)] += 1
+
+    def _record_failure(self, username, when):
+        recent = self.failures.setdefault(username, deque(maxlen=BURST_THRESHOLD))
+        recent.append(when)
+        if len(recent) == BURST_THRESHOLD and recent[-1] - recent[0] <= BURST_WINDOW:
+            self.bursts.append([username, recent[0], len(recent)])
+            recent.clear()
+
+    # -------------------- Reading the log --------------------
+
+    def update(self, log_file=LOG_FILE):
+        """Process lines appended since the last update; returns the number read.
+
+        If the log was rotated since (see usage_log.py), the file read last
+        time is finished from its rotated copy, and any backups newer than it
+        are read in full, before the new log is started.
+        """
+        try:
+            stat = os.stat(log_file)
+        except FileNotFoundError:
+            return 0
+        before = self.lines
+        if stat.st_ino != self.inode:
+            if self.inode is not None:
+                for backup in self._unread_backups(log_file):
+                    self._read(backup, self.offset)
+                    self.offset = 0
+            self.inode, self.offset = stat.st_ino, 0
+        elif stat.st_size < self.offset:
+            self.offset = 0  # truncated
+
+        self.offset = self._read(log_file, self.offset)
+        return self.lines - before
+
+    def _unread_backups(self, log_file):
+        """Rotated copies of log_file not yet fully read, oldest first.
+
+        The first is the file read last time, still to be finished from
+        self.offset. If it has been rotated away entirely, every backup is
+        newer than it and the offset no longer applies.
+        """
+        backups = []
+        number = 1
+        while os.path.exists(f"{log_file}.{number}"):
+            backup = f"{log_file}.{number}"
+            backups.append(backup)
+            if os.stat(backup).st_ino == self.inode:
+                return backups[::-1]
+            number += 1
+        self.offset = 0
+        return backups[::-1]
+
+    def _read(self, path, offset):
+        """Process the complete lines of path after offset; returns the offset reached."""
+        with open(path, 'rb') as logfile:
+            logfile.seek(offset)
+            for line in logfile:
+                if not line.endswith(b'\n'):
+                    break  # partially written; pick it up next time
+                offset += len(line)
+                row = next(csv.reader([line.decode('utf-8', errors='replace')]), [])
+                if len(row) == 4:
+                    self.add(*row)
+        return offset
+
+    # -------------------- Reporting --------------------
+
+    def user_rates(self):
+        """[(username, role, actions, actions per day)] busiest first."""
+        return [(username, self.user_roles.get(username, ""), count, count / _active_days(self.user_span[username]))
+                for username, count in self.user_actions.most_common()]
+
+    def role_rates(self):
+        """[(role, actions, actions per day)] busiest first."""
+        return [(role, count, count / _active_days(self.role_span[role]))
+                for role, count in self.role_actions.most_common()]
+
+    def busiest_actions_by_hour(self):
+        """{hour: (action name, count)} for the most frequent action in each hour of the day."""
+        busiest = {}
+        for (hour, name), count in self.hourly_actions.items():
+            if hour not in busiest or count > busiest[hour][1]:
+                busiest[hour] = (name, count)
+        return dict(sorted(busiest.items()))
+
+    def report(self, top=10):
+        lines = [f"Log lines analysed: {self.lines}", "", "Actions by role (actions, per day):"]
+        for role, count, per_day in self.role_rates():
+            lines.append(f"  {role:<12} {count:>6} {per_day:8.1f}")
+        lines += ["", f"Top {top} users (actions, per day):"]
+        for username, role, count, per_day in self.user_rates()[:top]:
+            lines.append(f"  {username:<12} {role:<12} {count:>6} {per_day:8.1f}")
+        lines += ["", "Busiest action per hour:"]
+        for hour, (name, count) in self.busiest_actions_by_hour().items():
+            lines.append(f"  {hour:02d}:00  {name:<20} {count}")
+        lines += ["", f"Failed-login bursts ({BURST_THRESHOLD}+ within {BURST_WINDOW}s): {len(self.bursts)}"]
+        for username, start, count in self.bursts[-top:]:
+            lines.append(f"  {username:<12} {datetime.fromtimestamp(start).strftime(TIMESTAMP_FORMAT)}")
+        return "\n".join(lines)
+
+    # -------------------- Persistence --------------------
+
+    def save(self, path=STATE_FILE):
+        state = {
+            "inode": self.inode, "offset": self.offset, "lines": self.lines,
+            "user_actions": self.user_actions, "user_span": self.user_span,
+            "user_roles": self.user_roles, "role_actions": self.role_actions, "role_span": self.role_span,
+            "hourly_actions": [[hour, name, count] for (hour, name), count in self.hourly_actions.items()],
+            "failures": {username: list(times) for username, times in self.failures.items()},
+            "bursts": self.bursts,
+        }
+        temp_path = path + ".tmp"
+        with open(temp_path, mode='w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path=STATE_FILE):
+        analyzer = cls()
+        try:
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return analyzer
+        if "role_span" not in state:
+            return analyzer  # saved by an older version; start over from the whole log
+        analyzer.inode, analyzer.offset, analyzer.lines = state["inode"], state["offset"], state["lines"]
+        analyzer.user_actions = Counter(state["user_actions"])
+        analyzer.user_span = state["user_span"]
+        analyzer.user_roles = state["user_roles"]
+        analyzer.role_actions = Counter(state["role_actions"])
+        analyzer.role_span = state["role_span"]
+        analyzer.hourly_actions = Counter({(hour, name): count for hour, name, count in state["hourly_actions"]})
+        analyzer.failures = {username: deque(times, maxlen=BURST_THRESHOLD)
+                             for username, times in state["failures"].items()}
+        analyzer.bursts = state["bursts"]
+        return analyzer
+
+
+def _widen(spans, key, when):
+    span = spans.setdefault(key, [when, when])
+    span[0], span[1] = min(span[0], when), max(span[1], when)
+
+
+def _active_days(span):
+    first, last = span
+    return max((last - first) / 86400, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise usage_log.csv, resuming where the last run stopped.")
+    parser.add_argument("log_file", nargs="?", default=LOG_FILE)
+    parser.add_argument("--state", default=STATE_FILE, help="where the offset and aggregates are kept")
+    parser.add_argument("--reset", action="store_true", help="ignore saved state and read the whole log")
+    args = parser.parse_args()
+
+    analyzer = UsageAnalyzer() if args.reset else UsageAnalyzer.load(args.state)
+    read = analyzer.update(args.log_file)
+    analyzer.save(args.state)
+    print(f"Read {read} new lines from {args.log_file}\n")
+    print(analyzer.report())
+
+
+if __name__ == "__main__":
+    main()
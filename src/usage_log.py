@@ -0,0 +1,98 @@
+import atexit
+import csv
+import io
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+LOG_FILE = "usage_log.csv"
+MAX_PENDING = 10000      # rows buffered before log() blocks the caller
+FLUSH_INTERVAL = 1.0     # seconds between batch writes
+MAX_BYTES = int(os.environ.get("HOSPITAL_LOG_MAX_BYTES", "0"))  # 0 disables rotation
+BACKUP_COUNT = 5
+
+_STOP = object()
+
+
+class UsageLogger:
+    """Appends usage rows to the log from a background thread.
+
+    log() only enqueues the row; the worker collects rows for up to
+    FLUSH_INTERVAL seconds and writes them with a single open and append.
+    close() (also run at interpreter exit) drains the queue before returning.
+    """
+
+    def __init__(self, log_file=LOG_FILE, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue = queue.Queue(maxsize=MAX_PENDING)
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="usage-logger", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def log(self, username, role, action):
+        if self._closed:
+            return
+        self._queue.put([username, role, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), action])
+
+    def close(self):
+        """Flush everything still queued and stop the worker."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            rows = []
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while item is not _STOP:
+                rows.append(item)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if rows:
+                self._write(rows)
+            if item is _STOP:
+                return
+
+    def _write(self, rows):
+        text = io.StringIO(newline='')
+        csv.writer(text).writerows(rows)
+        data = text.getvalue()
+        try:
+            if self.max_bytes and os.path.exists(self.log_file) and os.path.getsize(self.log_file) + len(data) > self.max_bytes:
+                self._rotate()
+            with open(self.log_file, mode='a', newline='', encoding='utf-8') as csvfile:
+                csvfile.write(data)
+        except OSError as e:
+            print(f"Could not write usage log: {e}")
+
+    def _rotate(self):
+        # usage_log.csv -> usage_log.csv.1 -> ... -> usage_log.csv.<backup_count> (dropped)
+        for n in range(self.backup_count - 1, 0, -1):
+            source = f"{self.log_file}.{n}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.log_file}.{n + 1}")
+        os.replace(self.log_file, f"{self.log_file}.1")
+
+
+_loggers = {}
+
+
+def get_usage_logger(log_file=LOG_FILE):
+    """Return the shared logger for a log file, starting it on first use."""
+    logger = _loggers.get(log_file)
+    if logger is None:
+        logger = _loggers[log_file] = UsageLogger(log_file)
+    return logger
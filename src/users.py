@@ -1,4 +1,11 @@
 import csv
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from instrumentation import timed
 
 
 class User:
@@ -21,16 +28,183 @@ class User:
     def can_count_visits(self):
         return True  # All roles can count visits
 
+    def can_query_cohorts(self):
+        return self.role in ["clinician", "nurse", "management"]  # listing a cohort's visits needs can_access_phi
 
+    def needs_visit_rows(self):
+        return self.role != "admin"  # admins only count visits, which the saved rollups answer
+
+
+# -------------------- Credential Store --------------------
+
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = int(os.environ.get("HOSPITAL_HASH_ITERATIONS", "200000"))
+SESSION_TTL = 15 * 60  # seconds a verified login is remembered
+
+
+def hash_password(password, iterations=None, salt=None):
+    """Return a salted "pbkdf2_sha256$iterations$salt$hash" string."""
+    iterations = iterations or HASH_ITERATIONS
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), iterations)
+    return f"{HASH_SCHEME}${iterations}${salt}${digest.hex()}"
+
+
+def is_hashed(stored):
+    return stored.startswith(HASH_SCHEME + "$")
+
+
+def verify_password(stored, password):
+    """Check a password against a hash_password() string in constant time.
+
+    Anything else, including a malformed hash, never matches.
+    """
+    try:
+        scheme, iterations, salt, _ = stored.split("$")
+        if scheme != HASH_SCHEME:
+            return False
+        return hmac.compare_digest(hash_password(password, int(iterations), salt), stored)
+    except ValueError:
+        return False
+
+
+class CredentialStore:
+    """Credentials.csv indexed by username, reloaded when the file's mtime changes.
+
+    The password column holds hash_password() strings or, for rows not yet
+    migrated (see hash_credentials_file()), plaintext. A login against a
+    plaintext row still runs the hash, so it takes as long as any other,
+    and on success the hash replaces the plaintext in the file. Successful
+    logins are remembered for SESSION_TTL seconds under a keyed digest, so
+    repeated logins skip the deliberately slow hash.
+    """
+
+    def __init__(self, credentials_file):
+        self.path = credentials_file
+        self.users = {}
+        self.mtime = None
+        self._sessions = {}
+        self._session_key = secrets.token_bytes(32)
+        self._dummy_hash = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # serialises rehash() rewrites of the file
+
+    def _reload_if_changed(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        _, rows = _read_credentials(self.path)
+        self.users = {row['username']: (row['password'], row['role']) for row in rows}
+        self.mtime = mtime
+        self._sessions = {}
+
+    def authenticate(self, username, password):
+        """Return the user's role, or None. Raises FileNotFoundError if the file is missing."""
+        with self._lock:
+            self._reload_if_changed()
+            entry = self.users.get(username)
+            session = hmac.new(self._session_key, f"{username}\0{password}".encode("utf-8"), "sha256").digest()
+            cached = self._sessions.get(session)
+            if cached is not None and cached[1] > time.monotonic() and entry is not None:
+                return cached[0]
+
+        if entry is None:
+            # Spend the same hashing time as a real check so unknown usernames aren't revealed by timing
+            if self._dummy_hash is None:
+                self._dummy_hash = hash_password("")
+            verify_password(self._dummy_hash, password)
+            return None
+        stored, role = entry
+        if is_hashed(stored):
+            if not verify_password(stored, password):
+                return None
+        else:
+            rehashed = hash_password(password)  # the same KDF cost as checking a hashed row
+            if not hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8")):
+                return None
+            self._rehash(username, stored, rehashed)
+        with self._lock:
+            self._sessions[session] = (role, time.monotonic() + SESSION_TTL)
+        return role
+
+    def _rehash(self, username, stored, rehashed):
+        """Replace one user's plaintext password in the file (and the index) with its hash."""
+        with self._write_lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                fieldnames, rows = _read_credentials(self.path)
+                for row in rows:
+                    if row['username'] == username and row['password'] == stored:
+                        row['password'] = rehashed
+                _write_credentials(self.path, fieldnames, rows)
+                written = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                print(f"Could not save the hashed password to {self.path}: {e}")
+                return
+        with self._lock:
+            if self.mtime == mtime:  # the index matched the file just rewritten, so it can follow it
+                self.users[username] = (rehashed, self.users[username][1])
+                self.mtime = written
+
+
+_stores = {}
+
+
+def get_credential_store(credentials_file):
+    store = _stores.get(credentials_file)
+    if store is None:
+        store = _stores[credentials_file] = CredentialStore(credentials_file)
+    return store
+
+
+def _read_credentials(path):
+    with open(path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        return reader.fieldnames, list(reader)
+
+
+def _write_credentials(path, fieldnames, rows):
+    temp_path = path + ".tmp"
+    with open(temp_path, mode='w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(temp_path, path)
+
+
+def _hash_plaintext(rows):
+    """Hash the plaintext passwords of credential rows in place; returns how many there were."""
+    plaintext = [row for row in rows if not is_hashed(row['password'])]
+    for row in plaintext:
+        row['password'] = hash_password(row['password'])
+    return len(plaintext)
+
+
+def hash_credentials_file(credentials_file):
+    """Replace plaintext passwords in a credentials file with salted hashes (atomic rewrite).
+
+    The app also does this itself, one account at a time, as users log in.
+    """
+    fieldnames, rows = _read_credentials(credentials_file)
+    if _hash_plaintext(rows):
+        _write_credentials(credentials_file, fieldnames, rows)
+    return len(rows)
+
+
+@timed("authenticate_user")
 def authenticate_user(credentials_file, input_username, input_password):
     try:
-        with open(credentials_file, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if row['username'] == input_username and row['password'] == input_password:
-                    print(f"Login successful as '{row['role']}'")
-                    return User(input_username, row['role'])
+        role = get_credential_store(credentials_file).authenticate(input_username, input_password)
+        if role is not None:
+            print(f"Login successful as '{role}'")
+            return User(input_username, role)
     except FileNotFoundError:
         print("Credentials file not found.")
     print("Invalid username or password.")
     return None
+
+
+if __name__ == "__main__":
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else "Credentials.csv"
+    print(f"Hashed {hash_credentials_file(path)} passwords in {path}")
@@ -0,0 +1,103 @@
+import bisect
+from collections import Counter
+from datetime import datetime, date
+from functools import lru_cache
+
+VISIT_DATE_FORMAT = "%m/%d/%Y"
+
+
+@lru_cache(maxsize=65536)
+def parse_visit_date(visit_time):
+    """Parse a Visit_time string (M/D/YYYY) into a date, or None if it is invalid.
+
+    Only a few thousand distinct dates occur across millions of visits, so
+    results are cached and each string is parsed once.
+    """
+    try:
+        return datetime.strptime(visit_time.strip(), VISIT_DATE_FORMAT).date()
+    except (ValueError, AttributeError):
+        return None
+
+
+@lru_cache(maxsize=65536)
+def visit_ordinal(visit_time):
+    """Date ordinal of a Visit_time string, or 0 if it is invalid (sorts before every real date)."""
+    visit_date = parse_visit_date(visit_time)
+    return visit_date.toordinal() if visit_date else 0
+
+
+class VisitDateIndex:
+    """Visit counts keyed by date ordinal, shared by the CLI and the GUI.
+
+    Single-day counts are a dictionary lookup. Range and month counts use a
+    sorted list of distinct days with running totals, rebuilt lazily after
+    the index changes.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self._days = None
+        self._totals = None
+
+    def add(self, visit_time):
+        ordinal = visit_ordinal(visit_time)
+        if not ordinal:
+            return
+        self.counts[ordinal] += 1
+        self._days = None
+
+    def remove(self, visit_time):
+        ordinal = visit_ordinal(visit_time)
+        if not ordinal:
+            return
+        if self.counts[ordinal] <= 1:
+            self.counts.pop(ordinal, None)
+        else:
+            self.counts[ordinal] -= 1
+        self._days = None
+
+    def add_patient(self, patient):
+        for visit in patient.visits:
+            self.add(visit.visit_time)
+
+    def remove_patient(self, patient):
+        for visit in patient.visits:
+            self.remove(visit.visit_time)
+
+    def count_on(self, day):
+        """Number of visits on a single date."""
+        return self.counts.get(day.toordinal(), 0)
+
+    def count_between(self, start, end):
+        """Number of visits from start to end, both dates inclusive."""
+        if self._days is None:
+            self._rebuild()
+        lo = bisect.bisect_left(self._days, start.toordinal())
+        hi = bisect.bisect_right(self._days, end.toordinal())
+        return self._totals[hi] - self._totals[lo]
+
+    def count_in_month(self, year, month):
+        """Number of visits in a calendar month."""
+        first = date(year, month, 1)
+        if month == 12:
+            next_first = date(year + 1, 1, 1)
+        else:
+            next_first = date(year, month + 1, 1)
+        return self.count_between(first, date.fromordinal(next_first.toordinal() - 1))
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def _rebuild(self):
+        self._days = sorted(self.counts)
+        totals = [0]
+        for day in self._days:
+            totals.append(totals[-1] + self.counts[day])
+        self._totals = totals
+
+    @classmethod
+    def from_patients(cls, patients):
+        index = cls()
+        for patient in patients.values():
+            index.add_patient(patient)
+        return index
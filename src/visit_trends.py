@@ -0,0 +1,157 @@
+import json
+import os
+from collections import Counter
+from datetime import date
+from patient_repository import iter_removed_rows, iter_rows_with_offsets, load_tombstones, resume_offset, saved_source
+from visit_index import parse_visit_date
+
+GRANULARITIES = ["day", "week", "month"]
+TOTAL = "total"
+
+
+def period_key(granularity, visit_date):
+    """Bucket a date: day -> ordinal, week -> ordinal of its Monday, month -> year*12 + month-1."""
+    if granularity == "day":
+        return visit_date.toordinal()
+    if granularity == "week":
+        return visit_date.toordinal() - visit_date.weekday()
+    return visit_date.year * 12 + visit_date.month - 1
+
+
+def period_label(granularity, key):
+    if granularity == "month":
+        return f"{key // 12}-{key % 12 + 1:02d}"
+    return date.fromordinal(key).isoformat()
+
+
+class VisitRollups:
+    """Daily, weekly and monthly visit counts, in total and by department and chief complaint.
+
+    The rollups remember how far into Patient_data.csv they have read, so
+    refresh() only parses rows appended since the last call. A removal
+    (a new tombstone) subtracts the removed patient's rows; finding them
+    still reads the file, but only their rows are parsed. A compaction
+    changes the file's inode and forces a rebuild.
+    """
+
+    def __init__(self):
+        self.counts = {granularity: Counter() for granularity in GRANULARITIES}
+        self.source = None  # (inode, byte offset read up to, tombstone state)
+
+    def add(self, visit_time, department, complaint, visits=1):
+        """Count visits (negative to uncount them) for one date, department and complaint."""
+        visit_date = parse_visit_date(visit_time)
+        if visit_date is None:
+            return
+        for granularity, counts in self.counts.items():
+            key = period_key(granularity, visit_date)
+            for cell in ((key, TOTAL, ""), (key, "department", department), (key, "complaint", complaint)):
+                counts[cell] += visits
+                if not counts[cell]:
+                    del counts[cell]
+
+    def add_row(self, row, visits=1):
+        self.add(row["Visit_time"], row["Visit_department"], row["Chief_complaint"], visits)
+
+    def add_rows(self, rows, visits=1):
+        for row in rows:
+            self.add_row(row, visits)
+
+    def series(self, granularity="month", dimension=TOTAL, value=""):
+        """Return [(period label, visits)] in period order for one department, complaint or the total."""
+        counts = self.counts[granularity]
+        keys = sorted(key for key, dim, val in counts if dim == dimension and val == value)
+        return [(period_label(granularity, key), counts[key, dimension, value]) for key in keys]
+
+    def count_on(self, day):
+        """Number of visits on a single date."""
+        return self.counts["day"].get((day.toordinal(), TOTAL, ""), 0)
+
+    def top_values(self, dimension, n=5):
+        """The n departments or complaints with the most visits overall."""
+        totals = Counter()
+        for (key, dim, value), count in self.counts["month"].items():
+            if dim == dimension:
+                totals[value] += count
+        return [value for value, _ in totals.most_common(n)]
+
+    # -------------------- Keeping up with the data file --------------------
+
+    def refresh(self, data_file):
+        """Bring the rollups up to date with data_file; returns True if anything changed."""
+        try:
+            inode = os.stat(data_file).st_ino
+        except FileNotFoundError:
+            return False
+        removed = load_tombstones(data_file)
+        tombstones = sorted(removed.items())
+        offset = resume_offset(data_file, self.source, inode, removed)
+        if offset is None:
+            self.counts = {granularity: Counter() for granularity in GRANULARITIES}
+            offset = 0
+        else:
+            for row in iter_removed_rows(data_file, offset, dict(self.source[2]), removed):
+                self.add_row(row, -1)
+
+        end = offset
+        for start, end, row in iter_rows_with_offsets(data_file, offset):
+            if start < removed.get(row["Patient_ID"], -1):
+                continue
+            self.add_row(row)
+        changed = self.source != (inode, end, tombstones)
+        self.source = (inode, end, tombstones)
+        return changed
+
+    # -------------------- Persistence --------------------
+
+    def save(self, path):
+        rows = [[granularity, key, dim, value, count]
+                for granularity, counts in self.counts.items()
+                for (key, dim, value), count in counts.items() if count]
+        temp_path = path + ".tmp"
+        with open(temp_path, mode='w', encoding='utf-8') as f:
+            json.dump({"source": self.source, "counts": rows}, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        rollups = cls()
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return rollups
+        for granularity, key, dim, value, count in saved["counts"]:
+            rollups.counts[granularity][key, dim, value] = count
+        if saved["source"] is not None:
+            rollups.source = saved_source(saved["source"])
+        return rollups
+
+
+def rollup_file(data_file):
+    root, _ = os.path.splitext(data_file)
+    return f"{root}_rollups.json"
+
+
+def load_rollups(data_file, rollups=None):
+    """Return rollups for data_file, reading only rows appended since they were last saved."""
+    path = rollup_file(data_file)
+    if rollups is None:
+        rollups = VisitRollups.load(path)
+    if rollups.refresh(data_file):
+        rollups.save(path)
+    return rollups
+
+
+def month_range(first_label, last_label):
+    """All "YYYY-MM" labels from first to last inclusive, so gaps plot as zero."""
+    year, month = map(int, first_label.split("-"))
+    labels = []
+    while True:
+        label = f"{year}-{month:02d}"
+        labels.append(label)
+        if label >= last_label:
+            return labels
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
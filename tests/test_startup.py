@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_DIR)
+
+from benchmark import DEFERRED_MODULES, STARTUP_BUDGET, STARTUP_MODULES, login_window_time  # noqa: E402
+from datagen import generate_dataset  # noqa: E402
+
+# Imports a module in a fresh interpreter and prints which DEFERRED_MODULES it pulled in
+IMPORT_SCRIPT = """
+import json, sys
+import %s
+print(json.dumps(sorted(%r & {name.split('.')[0] for name in sys.modules})))
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SRC_DIR, env.get("PYTHONPATH")]))
+    return env
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("startup"))
+    generate_dataset(directory, 1000, users=10, note_words=50)
+    return directory
+
+
+@pytest.mark.parametrize("module", STARTUP_MODULES)
+def test_startup_does_not_import_statistics_stack(module, dataset):
+    child = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT % (module, set(DEFERRED_MODULES))], cwd=dataset,
+                           env=_env(), capture_output=True, text=True, check=True)
+    assert json.loads(child.stdout.splitlines()[-1]) == []
+
+
+def test_login_window_within_budget(dataset):
+    timing = login_window_time(dataset)
+    if timing is None:
+        pytest.skip("no display to draw the login window on")
+    seconds, loaded = timing
+    assert loaded == []
+    assert seconds <= STARTUP_BUDGET, f"login window took {seconds:.3f} s, over the {STARTUP_BUDGET} s budget"